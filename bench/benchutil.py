@@ -0,0 +1,85 @@
+# benchutil.py: Common set up for the OSPi Monitor benchmarks
+#
+# Copyright 2013 Sudaraka Wijesinghe <sudaraka.wijesinghe@gmail.com>
+#
+# This file is part of OpenSprinkler Pi Monitor (OSPi Monitor)
+#
+# OSPi Monitor is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# OSPi Monitor is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with OSPi Monitor.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import os
+import sys
+import tempfile
+
+# Source directory, so that the ospim package is importable from here
+SOURCE_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+
+def setup_environment(settings=None):
+    """
+    Create a temporary working directory with an ospim.conf that keeps every
+    data file inside it, and change in to it. This must be called before any
+    ospim object is created, since the configuration is read from the
+    working directory on first use.
+
+    settings is a dictionary of section => {option: value} overriding the
+    values from ospim.conf-dist.
+
+    Return the path of the working directory.
+    """
+
+    work_dir = tempfile.mkdtemp(prefix='ospim-bench-')
+
+    paths = {
+        'daemon': {
+            'pid_file': os.path.join(work_dir, 'ospimd.pid'),
+            'log_file': os.path.join(work_dir, 'ospim.log')
+        },
+        'server': {
+            'root_directory': os.path.join(SOURCE_DIR, 'html')
+        },
+        'gpio': {
+            'backend': 'simulated'
+        },
+        'opensprinkler': {
+            'zone_file': os.path.join(work_dir, 'zones.json')
+        },
+        'calendar': {
+            'schedule_file': os.path.join(work_dir, 'schedule.json')
+        }
+    }
+
+    for section, options in (settings or {}).items():
+        paths.setdefault(section, {}).update(options)
+
+    f = open(os.path.join(SOURCE_DIR, 'ospim.conf-dist'))
+    conf = f.read()
+    f.close()
+
+    for section, options in paths.items():
+        conf += '\n[%s]\n' % section
+        for option, value in options.items():
+            conf += '%s = %s\n' % (option, value)
+
+    f = open(os.path.join(work_dir, 'ospim.conf'), 'w')
+    f.write(conf)
+    f.close()
+
+    os.chdir(work_dir)
+
+    if SOURCE_DIR not in sys.path:
+        sys.path.insert(0, SOURCE_DIR)
+
+    return work_dir
+
@@ -0,0 +1,161 @@
+# calendar_server.py: Local stand-in for the Google Calendar API and ICS feeds
+#
+# Copyright 2013 Sudaraka Wijesinghe <sudaraka.wijesinghe@gmail.com>
+#
+# This file is part of OpenSprinkler Pi Monitor (OSPi Monitor)
+#
+# OSPi Monitor is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# OSPi Monitor is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with OSPi Monitor.  If not, see <http://www.gnu.org/licenses/>.
+#
+#
+# Serves a generated list of watering events as Google Calendar API v3 JSON
+# on /calendar/v3/calendars/<id>/events and as iCalendar on /calendar.ics,
+# with ETag support, so the event sources can be exercised offline.
+#
+
+import datetime
+import json
+import threading
+import time
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+
+def generate_events(count, zones=16, spacing=120, duration=600):
+    """
+    Return count events as (uid, summary, start, end) tuples. Events start
+    every spacing seconds from a few minutes ago, on zones "Zone 1" to
+    "Zone <zones>" in turn, and run for duration seconds.
+    """
+
+    first = datetime.datetime.now().replace(microsecond=0) - \
+        datetime.timedelta(minutes=5)
+    events = []
+
+    for i in range(count):
+        start = first + datetime.timedelta(seconds=i * spacing)
+        end = start + datetime.timedelta(seconds=duration)
+
+        events.append(('bench%06d' % i, 'Zone %d' % (i % zones + 1), start,
+                       end))
+
+    return events
+
+
+def _utc(local):
+    """ Format local datetime as UTC RFC 3339 time stamp """
+
+    return datetime.datetime.utcfromtimestamp(
+        time.mktime(local.timetuple())).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def google_json(events):
+    """ Return the events as Google Calendar API events list response """
+
+    return json.dumps({
+        'kind': 'calendar#events',
+        'items': [{
+            'id': uid,
+            'status': 'confirmed',
+            'summary': summary,
+            'start': {'dateTime': _utc(start)},
+            'end': {'dateTime': _utc(end)}
+        } for uid, summary, start, end in events]
+    })
+
+
+def ics(events):
+    """ Return the events as iCalendar data """
+
+    lines = ['BEGIN:VCALENDAR', 'VERSION:2.0', 'PRODID:-//ospim//bench//EN']
+
+    for uid, summary, start, end in events:
+        lines.extend([
+            'BEGIN:VEVENT',
+            'UID:' + uid,
+            'SUMMARY:' + summary,
+            'DTSTART:' + start.strftime('%Y%m%dT%H%M%S'),
+            'DTEND:' + end.strftime('%Y%m%dT%H%M%S'),
+            'END:VEVENT'
+        ])
+
+    lines.append('END:VCALENDAR')
+
+    return '\r\n'.join(lines) + '\r\n'
+
+
+class CalendarHandler(BaseHTTPRequestHandler):
+
+    """ Serve the current event list of the server """
+
+    def do_GET(self):
+        """ Send the events in the format the path asks for """
+
+        if self.path.startswith('/calendar/v3/calendars/'):
+            body = self.server.google_json
+            content_type = 'application/json'
+        elif self.path.startswith('/calendar.ics'):
+            body = self.server.ics
+            content_type = 'text/calendar'
+        else:
+            self.send_error(404)
+            return
+
+        self.server.requests += 1
+        etag = '"%d"' % self.server.version
+
+        if etag == self.headers.get('If-None-Match'):
+            self.send_response(304)
+            self.end_headers()
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', etag)
+        self.end_headers()
+
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        """ Keep the benchmark output clean """
+
+        pass
+
+
+def start_server():
+    """ Start the stand-in server on a free local port in a thread """
+
+    server = HTTPServer(('127.0.0.1', 0), CalendarHandler)
+    server.requests = 0
+    set_events(server, [])
+
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    return server
+
+
+def set_events(server, events):
+    """ Replace the events served, clients see a new ETag """
+
+    server.google_json = google_json(events)
+    server.ics = ics(events)
+    server.version = getattr(server, 'version', 0) + 1
+
+
+def base_url(server):
+    """ Return the http://host:port prefix of the server """
+
+    return 'http://127.0.0.1:%d' % server.server_address[1]
@@ -0,0 +1,94 @@
+#!/usr/bin/python -tt
+# compare.py: Compare two benchmark suite result files
+#
+# Copyright 2013 Sudaraka Wijesinghe <sudaraka.wijesinghe@gmail.com>
+#
+# This file is part of OpenSprinkler Pi Monitor (OSPi Monitor)
+#
+# OSPi Monitor is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# OSPi Monitor is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with OSPi Monitor.  If not, see <http://www.gnu.org/licenses/>.
+#
+#
+# Usage: compare.py before.json after.json
+#
+# Prints the median (and request rate) of every measurement found in both
+# files, with the change from before to after.
+#
+
+import json
+import sys
+
+
+def measurements(results, prefix=''):
+    """ Return name => measurement dictionary of the nested results """
+
+    found = {}
+
+    for name, value in results.items():
+        if not isinstance(value, dict):
+            continue
+
+        if 'median_ms' in value:
+            found[prefix + name] = value
+        else:
+            found.update(measurements(value, prefix + name + '.'))
+
+    return found
+
+
+def change(before, after):
+    """ Return the relative change as a percentage string """
+
+    if 0 == before:
+        return '      n/a'
+
+    return '%+8.1f%%' % ((after - before) * 100.0 / before)
+
+
+def load(path):
+    """ Load the results of a suite run """
+
+    f = open(path)
+    data = json.loads(f.read())
+    f.close()
+
+    return data
+
+
+if '__main__' == __name__:
+    if 3 != len(sys.argv):
+        print 'usage: %s before.json after.json' % sys.argv[0]
+        sys.exit(2)
+
+    before = load(sys.argv[1])
+    after = load(sys.argv[2])
+
+    print 'before: %s %s' % (before['meta']['revision'],
+                             before['meta']['time'])
+    print 'after:  %s %s' % (after['meta']['revision'],
+                             after['meta']['time'])
+
+    old = measurements(before['results'])
+    new = measurements(after['results'])
+
+    for name in sorted(set(old) & set(new)):
+        print '%-45s %9.3f -> %9.3f ms %s' % (
+            name, old[name]['median_ms'], new[name]['median_ms'],
+            change(old[name]['median_ms'], new[name]['median_ms']))
+
+        if 'requests_per_second' in old[name]:
+            rps_before = old[name]['requests_per_second']
+            rps_after = new[name]['requests_per_second']
+
+            print '%-45s %9.1f -> %9.1f /s %s' % (
+                '', rps_before, rps_after, change(rps_before, rps_after))
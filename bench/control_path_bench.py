@@ -0,0 +1,113 @@
+#!/usr/bin/python -tt
+# control_path_bench.py: Time and verify HTTP to shift register zone toggles
+#
+# Copyright 2013 Sudaraka Wijesinghe <sudaraka.wijesinghe@gmail.com>
+#
+# This file is part of OpenSprinkler Pi Monitor (OSPi Monitor)
+#
+# OSPi Monitor is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# OSPi Monitor is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with OSPi Monitor.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import httplib
+import sys
+import threading
+import time
+import urllib
+
+import benchutil
+
+benchutil.setup_environment()
+
+from ospim.gpio import OSPiMGPIO
+from ospim.storage import OSPiMSchedule, OSPiMZones
+from ospim.webserver import OSPiMHTTPServer, OSPiMRequestHandler
+
+
+def start_server():
+    """ Start the HTTP server with simulated GPIO on a free local port """
+
+    zone = OSPiMZones()
+    gpio = OSPiMGPIO(zone)
+    gpio.start_writer()
+
+    httpd = OSPiMHTTPServer(('127.0.0.1', 0), OSPiMRequestHandler)
+    httpd.set_gpio_handler(gpio)
+    httpd.set_zone_data(zone)
+    httpd.set_schedule_data(OSPiMSchedule())
+
+    thread = threading.Thread(target=httpd.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    return httpd, zone, gpio
+
+
+def post(port, command, parameters):
+    """ Send a POST command to the server and return the response body """
+
+    connection = httplib.HTTPConnection('127.0.0.1', port)
+    connection.request(
+        'POST', '/' + command, urllib.urlencode(parameters),
+        {'Content-Type': 'application/x-www-form-urlencoded'})
+
+    body = connection.getresponse().read()
+    connection.close()
+
+    return body
+
+
+if '__main__' == __name__:
+    toggles = 200
+    if 1 < len(sys.argv):
+        toggles = int(sys.argv[1])
+
+    httpd, zone, gpio = start_server()
+    port = httpd.server_address[1]
+    register = gpio._backend
+    zone_count = zone._data['zone_count']
+
+    latencies = []
+    mismatches = 0
+
+    for i in range(toggles):
+        zone_id = i % zone_count
+        status = (i // zone_count + 1) % 2
+
+        begin = time.time()
+        post(port, 'update-zone-status', {'zone': zone_id, 'status': status})
+
+        # Queued after the request's own write, so it completes after it
+        gpio.shift_register_write().wait(1)
+        latencies.append(time.time() - begin)
+
+        if register.outputs != zone.get_bits():
+            mismatches += 1
+
+    httpd.shutdown()
+
+    latencies.sort()
+    output_timing = register.timing.get('output', [0, 0.0])
+
+    print '%d toggles via /update-zone-status' % toggles
+    print 'toggle to latch min/median/max: %.3f / %.3f / %.3f ms' % (
+        latencies[0] * 1000,
+        latencies[len(latencies) // 2] * 1000,
+        latencies[-1] * 1000)
+    print 'latches:                %d' % register.latch_count
+    print 'GPIO outputs per latch: %.1f' % (
+        float(output_timing[0]) / max(1, register.latch_count))
+    print 'latched != zone data:   %d' % mismatches
+
+    if mismatches:
+        sys.exit(1)
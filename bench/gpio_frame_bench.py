@@ -0,0 +1,104 @@
+#!/usr/bin/python -tt
+# gpio_frame_bench.py: Compare shift register frame latency of GPIO backends
+#
+# Copyright 2013 Sudaraka Wijesinghe <sudaraka.wijesinghe@gmail.com>
+#
+# This file is part of OpenSprinkler Pi Monitor (OSPi Monitor)
+#
+# OSPi Monitor is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# OSPi Monitor is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with OSPi Monitor.  If not, see <http://www.gnu.org/licenses/>.
+#
+#
+# Usage: gpio_frame_bench.py [frames [zones [device]]]
+#
+# Without a device the mmap backend runs against a plain file with the GPIO
+# register layout. On a RaspberryPi pass /dev/gpiomem to measure the real
+# registers, the RPi.GPIO backend is measured too when it is available.
+#
+
+import os
+import sys
+import time
+
+import benchutil
+
+work_dir = benchutil.setup_environment()
+
+from ospim.gpiobackend import OSPiMGPIOBackend, OSPiMMmapGPIOBackend, \
+    OSPiMRPiGPIOBackend
+
+# Default pins from ospim.conf-dist
+PIN_CLK = 4
+PIN_NOE = 17
+PIN_DAT = 21
+PIN_LAT = 22
+
+
+def measure(backend, write_frame, frames, zones):
+    """ Return the average frame latency in milliseconds """
+
+    for pin in (PIN_CLK, PIN_NOE, PIN_DAT, PIN_LAT):
+        backend.setup(pin)
+
+    frame = int('01' * (zones // 2 + 1), 2) & ((1 << zones) - 1)
+
+    begin = time.time()
+
+    for i in range(frames):
+        write_frame(backend, PIN_CLK, PIN_DAT, PIN_LAT, frame, zones)
+
+    return (time.time() - begin) * 1000 / frames
+
+
+def mmap_backend(device):
+    """ Create mmap backend with BCM2835 register offsets """
+
+    return OSPiMMmapGPIOBackend(device, 4096, 0x00, 0x1c, 0x28)
+
+
+if '__main__' == __name__:
+    frames = 1000
+    zones = 16
+
+    if 1 < len(sys.argv):
+        frames = int(sys.argv[1])
+
+    if 2 < len(sys.argv):
+        zones = int(sys.argv[2])
+
+    if 3 < len(sys.argv):
+        device = sys.argv[3]
+    else:
+        device = os.path.join(work_dir, 'gpiomem')
+        f = open(device, 'wb')
+        f.write('\0' * 4096)
+        f.close()
+
+    print '%d frames of %d bits, mmap device %s' % (frames, zones, device)
+
+    try:
+        rpi = OSPiMRPiGPIOBackend()
+        rpi.initialize()
+        print 'RPi.GPIO:               %8.3f ms/frame' % measure(
+            rpi, OSPiMGPIOBackend.write_frame, frames, zones)
+        rpi.cleanup()
+    except Exception as e:
+        print 'RPi.GPIO:               not available (%s)' % str(e)
+
+    # Same frame sent as individual output() calls, like RPi.GPIO backend
+    print 'mmap, output() per pin: %8.3f ms/frame' % measure(
+        mmap_backend(device), OSPiMGPIOBackend.write_frame, frames, zones)
+
+    print 'mmap, batched frame:    %8.3f ms/frame' % measure(
+        mmap_backend(device), OSPiMMmapGPIOBackend.write_frame, frames,
+        zones)
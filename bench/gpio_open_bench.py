@@ -0,0 +1,80 @@
+#!/usr/bin/python -tt
+# gpio_open_bench.py: Count file opens and time spent per zone toggle
+#
+# Copyright 2013 Sudaraka Wijesinghe <sudaraka.wijesinghe@gmail.com>
+#
+# This file is part of OpenSprinkler Pi Monitor (OSPi Monitor)
+#
+# OSPi Monitor is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# OSPi Monitor is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with OSPi Monitor.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import __builtin__
+import sys
+import time
+
+import benchutil
+
+benchutil.setup_environment()
+
+from ospim.gpio import OSPiMGPIO
+from ospim.storage import OSPiMZones
+
+
+class OpenCounter(object):
+
+    """ Replaces the built-in open() to count the calls """
+
+    def __init__(self):
+        self.count = 0
+        self._open = __builtin__.open
+
+    def __enter__(self):
+        __builtin__.open = self._counting_open
+        return self
+
+    def __exit__(self, *args):
+        __builtin__.open = self._open
+
+    def _counting_open(self, *args, **kwargs):
+        self.count += 1
+        return self._open(*args, **kwargs)
+
+
+if '__main__' == __name__:
+    toggles = 1000
+    if 1 < len(sys.argv):
+        toggles = int(sys.argv[1])
+
+    zone = OSPiMZones()
+    gpio = OSPiMGPIO(zone)
+
+    # Same sequence as /update-zone-status request
+    with OpenCounter() as counter:
+        begin = time.time()
+
+        for i in range(toggles):
+            zone.set_status(i % zone._data['zone_count'], (i // 16 + 1) % 2)
+            gpio.shift_register_write()
+
+        elapsed = time.time() - begin
+
+    with OpenCounter() as latch_counter:
+        for i in range(toggles):
+            gpio.shift_register_write()
+
+    print '%d toggles' % toggles
+    print 'file opens per toggle:  %.2f' % (float(counter.count) / toggles)
+    print 'file opens per latch:   %.2f' % \
+        (float(latch_counter.count) / toggles)
+    print 'time per toggle:        %.3f ms' % (elapsed * 1000 / toggles)
@@ -0,0 +1,105 @@
+#!/usr/bin/python -tt
+# isotime_bench.py: Compare calendar time stamp parsing implementations
+#
+# Copyright 2013 Sudaraka Wijesinghe <sudaraka.wijesinghe@gmail.com>
+#
+# This file is part of OpenSprinkler Pi Monitor (OSPi Monitor)
+#
+# OSPi Monitor is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# OSPi Monitor is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with OSPi Monitor.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import datetime
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from ospim import isotime
+
+
+def strptime_parse(iso_datetime_string):
+    """ Previous GoogleCalender._iso_datetime_to_py implementation """
+
+    plus_pos = iso_datetime_string.find('+')
+    if plus_pos:
+        iso_datetime_string = iso_datetime_string[:plus_pos]
+
+    minus_pos = iso_datetime_string.rfind('-')
+    if minus_pos and 10 < minus_pos:
+        iso_datetime_string = iso_datetime_string[:minus_pos]
+
+    return datetime.datetime.strptime(
+        iso_datetime_string,
+        '%Y-%m-%dT%H:%M:%S'
+    )
+
+
+def event_feed(count):
+    """
+    Generate start/end time stamps like a Google Calendar feed of daily
+    watering events (singleEvents), 8 zones a day.
+    """
+
+    start = datetime.datetime(2013, 6, 1, 5, 0)
+    stamps = []
+
+    for i in range(count):
+        on = start + datetime.timedelta(days=i // 8, minutes=20 * (i % 8))
+        off = on + datetime.timedelta(minutes=20)
+
+        stamps.append(on.strftime('%Y-%m-%dT%H:%M:%S') + '+05:30')
+        stamps.append(off.strftime('%Y-%m-%dT%H:%M:%S') + '+05:30')
+
+    return stamps
+
+
+def measure(function, stamps, rounds):
+    """ Return the best time of parsing all stamps, out of given rounds """
+
+    best = None
+
+    for i in range(rounds):
+        begin = time.time()
+
+        for stamp in stamps:
+            function(stamp)
+
+        elapsed = time.time() - begin
+        if None == best or elapsed < best:
+            best = elapsed
+
+    return best
+
+
+if '__main__' == __name__:
+    count = 10000
+    if 1 < len(sys.argv):
+        count = int(sys.argv[1])
+
+    stamps = event_feed(count)
+
+    old = measure(strptime_parse, stamps, 3)
+
+    # First round fills the cache, as the first fetch of the feed would. The
+    # cache is sized to the feed like the schedule does on every update.
+    isotime.clear_cache()
+    isotime.reserve_cache(len(stamps))
+    cold = measure(isotime.iso_to_epoch, stamps, 1)
+    warm = measure(isotime.iso_to_epoch, stamps, 3)
+
+    print '%d time stamps (%d events)' % (len(stamps), count)
+    print 'strptime:          %8.2f ms' % (old * 1000)
+    print 'iso_to_epoch cold: %8.2f ms' % (cold * 1000)
+    print 'iso_to_epoch warm: %8.2f ms' % (warm * 1000)
@@ -0,0 +1,383 @@
+#!/usr/bin/python -tt
+# simulate.py: Fast-forward a watering schedule on a simulated clock
+#
+# Copyright 2013 Sudaraka Wijesinghe <sudaraka.wijesinghe@gmail.com>
+#
+# This file is part of OpenSprinkler Pi Monitor (OSPi Monitor)
+#
+# OSPi Monitor is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# OSPi Monitor is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with OSPi Monitor.  If not, see <http://www.gnu.org/licenses/>.
+#
+#
+# Usage: simulate.py [options], see simulate.py --help
+#
+# Replays an iCalendar file, or a generated daily watering program, through
+# the calendar thread, schedule, zone and sequencer code of the daemon
+# against the simulated shift register. The clock is simulated, so months of
+# schedule run in seconds.
+#
+# The calendar thread cycles every query_delay seconds as in the daemon.
+# Cycles where nothing can change (no event starts or ends) are skipped,
+# which gives the same zone transitions as running every cycle.
+#
+# Reports the run time of each zone against the planned (event) time, and
+# the latency of the zone transitions (latched on the shift register) from
+# the event start or end that caused them.
+#
+
+import argparse
+import datetime
+import json
+import os
+import time
+
+import benchutil
+import calendar_server
+
+# Longest simulated time between two cycles, even when nothing is planned
+MAX_STEP = 3600
+
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+def parse_arguments():
+    """ Return the command line options """
+
+    parser = argparse.ArgumentParser(
+        description='Run a watering schedule on a simulated clock')
+
+    parser.add_argument('--ics', help='iCalendar file to replay, a daily '
+                        'program is generated when not given')
+    parser.add_argument('--start', help='simulation start, YYYY-MM-DD '
+                        '(default today)')
+    parser.add_argument('--days', type=int, default=90,
+                        help='number of days to simulate (default 90)')
+    parser.add_argument('--zones', type=int, default=16,
+                        help='number of zones (default 16)')
+    parser.add_argument('--programs', default='06:00,18:00',
+                        help='start times of the generated daily program '
+                        '(default 06:00,18:00)')
+    parser.add_argument('--duration', type=int, default=10,
+                        help='minutes each zone runs in the generated '
+                        'program (default 10)')
+    parser.add_argument('--overlap', type=int, default=0,
+                        help='minutes each generated zone run overlaps the '
+                        'next one (default 0)')
+    parser.add_argument('--query-delay', type=int, default=60,
+                        help='seconds between calendar cycles (default 60)')
+    parser.add_argument('--max-concurrent', type=int, default=0,
+                        help='zones allowed to run at once, 0 for no limit')
+    parser.add_argument('--master-zone', type=int, default=0,
+                        help='master valve zone number, 0 for none')
+    parser.add_argument('--json', help='write the report to this file')
+
+    return parser.parse_args()
+
+
+def generate_program(start, days, zones, programs, duration, overlap):
+    """
+    Return the events of a daily program as (uid, summary, start, end)
+    tuples, each program runs the zones one after the other
+    """
+
+    events = []
+    length = datetime.timedelta(minutes=duration)
+    step = datetime.timedelta(minutes=duration - overlap)
+
+    for day in range(days):
+        date = start.date() + datetime.timedelta(days=day)
+
+        for program, begin in enumerate(programs.split(',')):
+            hour, minute = [int(part) for part in begin.split(':')]
+            turn_on = datetime.datetime.combine(
+                date, datetime.time(hour, minute))
+
+            for zone in range(zones):
+                events.append(('sim%04d%02d%03d' % (day, program, zone),
+                               'Zone %d' % (zone + 1), turn_on,
+                               turn_on + length))
+                turn_on += step
+
+    return events
+
+
+def summary(values):
+    """ Return the count and median/p95/max of the values """
+
+    if not values:
+        return {'count': 0}
+
+    values = sorted(values)
+
+    return {
+        'count': len(values),
+        'median': values[len(values) // 2],
+        'p95': values[min(len(values) - 1, int(len(values) * .95))],
+        'max': values[-1]
+    }
+
+
+class Simulation(object):
+
+    """ Calendar thread objects of the daemon driven by a simulated clock """
+
+    def __init__(self, clock, ics, zone_count, query_delay):
+        """ Create the daemon objects, the clock must be set already """
+
+        from ospim.calendar import OSPiCalendarThread
+        from ospim.gpio import OSPiMGPIO
+        from ospim.ical import OSPiMICalendarSource
+        from ospim.storage import OSPiMSchedule, OSPiMZones
+
+        self.clock = clock
+        self.query_delay = query_delay
+
+        self.zone = OSPiMZones()
+        self.zone.set_count(zone_count)
+
+        # Writes are done right away without the writer thread
+        self.gpio = OSPiMGPIO(self.zone)
+        self.register = self.gpio._backend
+
+        self.schedule = OSPiMSchedule()
+
+        self.thread = OSPiCalendarThread()
+        self.thread.set_schedule_data(self.schedule)
+        self.thread.set_zone_data(self.zone)
+        self.thread.set_gpio_handler(self.gpio)
+        self.thread.set_event_source(OSPiMICalendarSource(ics))
+        self.thread.prepare()
+
+        # Events seen in the schedule, id => (zone id, turn on, turn off),
+        # kept for a day after they end
+        self.events = {}
+        self.ended = set()
+
+        # Latched outputs after the last cycle
+        self.outputs = [0] * zone_count
+
+        # Zone id => time the zone turned on, while it is on
+        self.on_since = {}
+
+        self.runtime = [0.0] * zone_count
+        self.planned = [0.0] * zone_count
+        self.switched_on = [0] * zone_count
+        self.early_off = [0] * zone_count
+        self.on_latency = []
+        self.off_latency = []
+        self.cycle_time = []
+        self.cycles = 0
+
+    def run(self, end):
+        """ Run the calendar cycles until the end time """
+
+        first = self.clock.now()
+
+        while self.clock.now() < end:
+            begin = time.time()
+            self.thread.run_cycle()
+            self.cycle_time.append(time.time() - begin)
+            self.cycles += 1
+
+            self._remember_events()
+            self._record_transitions()
+
+            self.clock.set(min(end, self._next_cycle(first)))
+
+        # Zones still running at the end
+        for zone_id, since in self.on_since.items():
+            self.runtime[zone_id] += self._seconds(since, end)
+
+    def report(self):
+        """ Return the results as a dictionary """
+
+        return {
+            'cycles': self.cycles,
+            'zones': [{
+                'zone': zone_id + 1,
+                'runs': self.switched_on[zone_id],
+                'early_off': self.early_off[zone_id],
+                'runtime_hours': self.runtime[zone_id] / 3600,
+                'planned_hours': self.planned[zone_id] / 3600
+            } for zone_id in range(len(self.runtime))],
+            'on_latency_seconds': summary(self.on_latency),
+            'off_latency_seconds': summary(self.off_latency),
+            'cycle_ms': summary([t * 1000 for t in self.cycle_time])
+        }
+
+    def _remember_events(self):
+        """ Keep the events of the schedule, it drops them once over """
+
+        for event_id, event in self.schedule._data['events'].items():
+            if event_id in self.events or event_id in self.ended:
+                continue
+
+            turn_on = datetime.datetime.strptime(event['turn_on'],
+                                                 TIME_FORMAT)
+            turn_off = datetime.datetime.strptime(event['turn_off'],
+                                                  TIME_FORMAT)
+
+            self.events[event_id] = (event['zone_id'], turn_on, turn_off)
+            self.planned[event['zone_id']] += self._seconds(turn_on,
+                                                            turn_off)
+
+        forget = self.clock.now() - datetime.timedelta(days=1)
+
+        for event_id, (zone_id, turn_on, turn_off) in self.events.items():
+            if turn_off < forget:
+                del self.events[event_id]
+                self.ended.add(event_id)
+
+    def _record_transitions(self):
+        """ Compare the latched outputs with the last cycle """
+
+        if not self.register.latched:
+            return
+
+        outputs = self.register.outputs
+        self.register.reset_statistics()
+
+        now = self.clock.now()
+
+        for zone_id, (before, after) in enumerate(zip(self.outputs,
+                                                      outputs)):
+            if before == after:
+                continue
+
+            if after:
+                self.on_since[zone_id] = now
+                self.switched_on[zone_id] += 1
+
+                # Latency from the start of the event that is running
+                starts = [on for z, on, off in self.events.values()
+                          if zone_id == z and on <= now <= off]
+                if starts:
+                    self.on_latency.append(self._seconds(min(starts), now))
+            else:
+                self.runtime[zone_id] += self._seconds(
+                    self.on_since.pop(zone_id, now), now)
+
+                events = [(on, off) for z, on, off in self.events.values()
+                          if zone_id == z and on <= now]
+
+                # Turned off before the end of a running event
+                if [e for e in events if now < e[1]]:
+                    self.early_off[zone_id] += 1
+
+                # Latency from the end of the last event of the zone
+                elif events:
+                    self.off_latency.append(self._seconds(
+                        max(e[1] for e in events), now))
+
+        self.outputs = outputs
+
+    def _next_cycle(self, first):
+        """
+        Return the time of the first cycle, on the query_delay grid from the
+        first cycle, at or after the next time something can change
+        """
+
+        now = self.clock.now()
+        change = now + datetime.timedelta(seconds=MAX_STEP)
+
+        for zone_id in self.schedule.get_timeline().zones():
+            moment = self.schedule.get_next_change(zone_id)
+
+            if None != moment and now < moment < change:
+                change = moment
+
+        for run in self.thread._sequencer.status()['running']:
+            ends = datetime.datetime.strptime(run['ends'][:19], TIME_FORMAT)
+            if now < ends < change:
+                change = ends
+
+        cycles = (self._seconds(first, change) + self.query_delay - 1) // \
+            self.query_delay
+
+        return first + datetime.timedelta(seconds=cycles * self.query_delay)
+
+    def _seconds(self, begin, end):
+        """ Number of seconds from begin to end """
+
+        return (end - begin).total_seconds()
+
+
+if '__main__' == __name__:
+    options = parse_arguments()
+
+    if None == options.start:
+        start = datetime.datetime.combine(datetime.date.today(),
+                                          datetime.time())
+    else:
+        start = datetime.datetime.strptime(options.start, '%Y-%m-%d')
+
+    end = start + datetime.timedelta(days=options.days)
+
+    ics = options.ics and os.path.abspath(options.ics)
+
+    work_dir = benchutil.setup_environment({
+        'calendar': {'query_delay': options.query_delay},
+        'opensprinkler': {
+            'max_concurrent': options.max_concurrent,
+            'master_zone': options.master_zone
+        }
+    })
+
+    from ospim.clock import OSPiMSimulatedClock, set_clock
+
+    if None == ics:
+        ics = os.path.join(work_dir, 'program.ics')
+
+        f = open(ics, 'w')
+        f.write(calendar_server.ics(generate_program(
+            start, options.days, options.zones, options.programs,
+            options.duration, options.overlap)))
+        f.close()
+
+    clock = OSPiMSimulatedClock(start)
+    set_clock(clock)
+
+    simulation = Simulation(clock, ics, options.zones, options.query_delay)
+
+    begin = time.time()
+    simulation.run(end)
+    elapsed = time.time() - begin
+
+    report = simulation.report()
+    report['simulated_days'] = options.days
+    report['elapsed_seconds'] = elapsed
+
+    print 'Simulated %d days (%s to %s) in %.1f seconds, %d cycles' % (
+        options.days, start.date(), end.date(), elapsed, report['cycles'])
+    print
+
+    print '%6s %6s %10s %12s %12s' % ('zone', 'runs', 'early off',
+                                      'runtime h', 'planned h')
+    for row in report['zones']:
+        print '%6d %6d %10d %12.2f %12.2f' % (
+            row['zone'], row['runs'], row['early_off'], row['runtime_hours'],
+            row['planned_hours'])
+    print
+
+    for name in ('on_latency_seconds', 'off_latency_seconds', 'cycle_ms'):
+        values = report[name]
+
+        if values['count']:
+            print '%-20s median %9.3f  p95 %9.3f  max %9.3f  (%d)' % (
+                name, values['median'], values['p95'], values['max'],
+                values['count'])
+
+    if None != options.json:
+        f = open(options.json, 'w')
+        f.write(json.dumps(report, indent=2, sort_keys=True))
+        f.close()
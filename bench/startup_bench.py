@@ -0,0 +1,134 @@
+#!/usr/bin/python -tt
+# startup_bench.py: Time the daemon start up and stop from a cold process
+#
+# Copyright 2013 Sudaraka Wijesinghe <sudaraka.wijesinghe@gmail.com>
+#
+# This file is part of OpenSprinkler Pi Monitor (OSPi Monitor)
+#
+# OSPi Monitor is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# OSPi Monitor is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with OSPi Monitor.  If not, see <http://www.gnu.org/licenses/>.
+#
+#
+# Usage: startup_bench.py [runs]
+#
+# Each run starts ospimd.py in a new process, measures the time until the
+# HTTP port accepts connections, then measures how long "ospimd.py stop"
+# takes until the daemon is gone.
+#
+
+import os
+import socket
+import subprocess
+import sys
+import time
+
+import benchutil
+
+
+def free_port():
+    """ Return a local TCP port that is not in use """
+
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+
+    return port
+
+
+def wait_for_port(port, timeout):
+    """ Wait until the port accepts connections, return False on timeout """
+
+    end = time.time() + timeout
+
+    while time.time() < end:
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            s.connect(('127.0.0.1', port))
+            return True
+        except socket.error:
+            time.sleep(.001)
+        finally:
+            s.close()
+
+    return False
+
+
+def ospimd(command):
+    """ Run ospimd.py with the command and wait for it to exit """
+
+    subprocess.call([sys.executable,
+                     os.path.join(benchutil.SOURCE_DIR, 'ospimd.py'),
+                     command])
+
+
+def import_time(module):
+    """ Seconds to import the module in a new interpreter """
+
+    begin = time.time()
+    subprocess.call([sys.executable, '-c', 'import ' + module],
+                    cwd=benchutil.SOURCE_DIR)
+
+    return time.time() - begin
+
+
+def summary(values):
+    """ Return min / median / max of the values in milliseconds """
+
+    values = sorted(values)
+
+    return '%8.1f / %8.1f / %8.1f ms' % (
+        values[0] * 1000,
+        values[len(values) // 2] * 1000,
+        values[-1] * 1000)
+
+
+if '__main__' == __name__:
+    runs = 5
+    if 1 < len(sys.argv):
+        runs = int(sys.argv[1])
+
+    port = free_port()
+    work_dir = benchutil.setup_environment({
+        'server': {'address': '127.0.0.1', 'port': port}
+    })
+    pid_file = os.path.join(work_dir, 'ospimd.pid')
+
+    listening = []
+    stopping = []
+
+    for i in range(runs):
+        begin = time.time()
+        ospimd('start')
+
+        if not wait_for_port(port, 30):
+            print 'ospimd did not start listening on port %d' % port
+            sys.exit(1)
+
+        listening.append(time.time() - begin)
+
+        begin = time.time()
+        ospimd('stop')
+        stopping.append(time.time() - begin)
+
+        if os.path.exists(pid_file):
+            print 'ospimd did not remove its pid file on stop'
+            sys.exit(1)
+
+    print '%d cold starts, min / median / max' % runs
+    print 'python startup:         %s' % summary(
+        [import_time('sys') for i in range(runs)])
+    print 'import ospim.daemon:    %s' % summary(
+        [import_time('ospim.daemon') for i in range(runs)])
+    print 'start to listening:     %s' % summary(listening)
+    print 'stop command:           %s' % summary(stopping)
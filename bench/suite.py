@@ -0,0 +1,417 @@
+#!/usr/bin/python -tt
+# suite.py: Offline benchmark suite of the daemon hot paths
+#
+# Copyright 2013 Sudaraka Wijesinghe <sudaraka.wijesinghe@gmail.com>
+#
+# This file is part of OpenSprinkler Pi Monitor (OSPi Monitor)
+#
+# OSPi Monitor is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# OSPi Monitor is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with OSPi Monitor.  If not, see <http://www.gnu.org/licenses/>.
+#
+#
+# Usage: suite.py [results.json [pollers]]
+#
+# Runs without network or hardware: GPIO is the simulated shift register and
+# the calendar is served by calendar_server.py on localhost. Measures
+#
+#   http_polling     /get-zones and /get-schedule under concurrent pollers
+#   toggle_to_latch  /update-zone-status until the bits are latched
+#   calendar_cycle   one OSPiCalendarThread cycle with 10, 1k and 10k events
+#   storage_write    OSPiMStorage.write of zones and schedules
+#   cold_start       ospimd.py start until listening, and ospimd.py stop
+#
+# Results are written as JSON (default bench-results.json), compare two runs
+# with compare.py.
+#
+
+import datetime
+import httplib
+import json
+import os
+import platform
+import subprocess
+import sys
+import threading
+import time
+import urllib
+
+import benchutil
+import calendar_server
+import startup_bench
+
+# Number of events of the calendar cycle measurements
+EVENT_COUNTS = (10, 1000, 10000)
+
+# Events in the schedule while measuring /get-schedule
+POLLING_EVENTS = 1000
+
+
+def stats(seconds):
+    """ Return count and min/median/p95/max milliseconds of the timings """
+
+    values = sorted(seconds)
+
+    def percentile(p):
+        return values[min(len(values) - 1, int(len(values) * p))] * 1000
+
+    return {
+        'count': len(values),
+        'min_ms': values[0] * 1000,
+        'median_ms': percentile(.5),
+        'p95_ms': percentile(.95),
+        'max_ms': values[-1] * 1000
+    }
+
+
+def timed(function, rounds):
+    """ Return the timings of calling the function rounds times """
+
+    timings = []
+
+    for i in range(rounds):
+        begin = time.time()
+        function()
+        timings.append(time.time() - begin)
+
+    return timings
+
+
+def post(port, command, parameters=None):
+    """ Send a POST command to the server and return the response body """
+
+    connection = httplib.HTTPConnection('127.0.0.1', port)
+    connection.request(
+        'POST', '/' + command, urllib.urlencode(parameters or {}),
+        {'Content-Type': 'application/x-www-form-urlencoded'})
+
+    body = connection.getresponse().read()
+    connection.close()
+
+    return body
+
+
+def create_calendar_thread(zone, gpio, schedule, source):
+    """ Calendar thread objects wired like the daemon, without starting it """
+
+    from ospim.calendar import OSPiCalendarThread
+
+    thread = OSPiCalendarThread()
+    thread.set_schedule_data(schedule)
+    thread.set_zone_data(zone)
+    thread.set_gpio_handler(gpio)
+    thread.set_event_source(source)
+    thread.prepare()
+
+    return thread
+
+
+def create_source(kind, server):
+    """ Create an event source reading from the stand-in server """
+
+    if 'ics' == kind:
+        from ospim.ical import OSPiMICalendarSource
+
+        return OSPiMICalendarSource(
+            calendar_server.base_url(server) + '/calendar.ics')
+
+    from ospim.calendar import GoogleCalender
+
+    source = GoogleCalender()
+    source.base_api_url = calendar_server.base_url(server) + \
+        '/calendar/v3/calendars/'
+
+    return source
+
+
+def empty_schedule():
+    """ Schedule store without any events from earlier measurements """
+
+    from ospim.storage import OSPiMSchedule
+
+    schedule = OSPiMSchedule()
+    schedule._data = {'calendar_id': 'bench', 'events': {}}
+    schedule._timeline = None
+
+    return schedule
+
+
+def source_kinds():
+    """ Event sources that can be measured here """
+
+    kinds = ['ics']
+
+    try:
+        import httplib2
+        kinds.append('google')
+    except ImportError:
+        pass
+
+    return kinds
+
+
+def measure_calendar_cycle(server, zone, gpio, rounds):
+    """
+    Time the first cycle (events are new) and the following cycles (events
+    are unchanged) of the calendar thread for each source and event count
+    """
+
+    results = {}
+
+    for kind in source_kinds():
+        results[kind] = {}
+
+        for count in EVENT_COUNTS:
+            calendar_server.set_events(
+                server, calendar_server.generate_events(count))
+
+            schedule = empty_schedule()
+            thread = create_calendar_thread(zone, gpio, schedule,
+                                            create_source(kind, server))
+
+            first = timed(thread.run_cycle, 1)
+            repeat = timed(thread.run_cycle, rounds)
+
+            results[kind][str(count)] = {
+                'events_cached': len(schedule._data['events']),
+                'first_cycle': stats(first),
+                'repeat_cycle': stats(repeat)
+            }
+
+    return results
+
+
+def measure_storage_write(server, zone, gpio, rounds):
+    """ Time OSPiMStorage.write of zone data and of schedules """
+
+    results = {}
+
+    for zone_count in (16, 256):
+        zone.set_count(zone_count)
+        results['zones_%d' % zone_count] = stats(timed(zone.write, rounds))
+
+    zone.set_count(16)
+
+    for count in EVENT_COUNTS:
+        calendar_server.set_events(
+            server, calendar_server.generate_events(count))
+
+        schedule = empty_schedule()
+        create_calendar_thread(zone, gpio, schedule,
+                               create_source('ics', server)).run_cycle()
+
+        results['schedule_%d' % count] = stats(
+            timed(schedule.write, max(3, rounds * 10 // count)))
+
+    return results
+
+
+def measure_polling(port, command, pollers, requests):
+    """
+    Run the pollers in parallel, each sending requests commands, and return
+    the request rate and latency
+    """
+
+    timings = []
+    lock = threading.Lock()
+
+    def poll():
+        own = timed(lambda: post(port, command), requests)
+
+        with lock:
+            timings.extend(own)
+
+    threads = [threading.Thread(target=poll) for i in range(pollers)]
+
+    begin = time.time()
+
+    for thread in threads:
+        thread.start()
+
+    for thread in threads:
+        thread.join()
+
+    elapsed = time.time() - begin
+
+    result = stats(timings)
+    result['pollers'] = pollers
+    result['requests_per_second'] = len(timings) / elapsed
+
+    return result
+
+
+def measure_toggles(port, zone, gpio, toggles):
+    """ Time zone toggles through HTTP until the bits are latched """
+
+    register = gpio._backend
+    zone_count = zone._data['zone_count']
+
+    timings = []
+    mismatches = 0
+
+    for i in range(toggles):
+        zone_id = i % zone_count
+        status = (i // zone_count + 1) % 2
+
+        begin = time.time()
+        post(port, 'update-zone-status', {'zone': zone_id, 'status': status})
+
+        # Queued after the request's own write, so it completes after it
+        gpio.shift_register_write().wait(1)
+        timings.append(time.time() - begin)
+
+        if register.outputs != zone.get_bits():
+            mismatches += 1
+
+    result = stats(timings)
+    result['mismatches'] = mismatches
+
+    return result
+
+
+def measure_cold_start(port, runs):
+    """ Time ospimd.py start until listening and ospimd.py stop """
+
+    listening = []
+    stopping = []
+
+    for i in range(runs):
+        begin = time.time()
+        startup_bench.ospimd('start')
+
+        if not startup_bench.wait_for_port(port, 30):
+            raise Exception('ospimd did not start listening')
+
+        listening.append(time.time() - begin)
+
+        stopping.append(timed(lambda: startup_bench.ospimd('stop'), 1)[0])
+
+    return {
+        'start_to_listening': stats(listening),
+        'stop': stats(stopping)
+    }
+
+
+def revision():
+    """ Return the git revision of the source, None if not available """
+
+    try:
+        return subprocess.Popen(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=benchutil.SOURCE_DIR, stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE).communicate()[0].strip() or None
+    except OSError:
+        return None
+
+
+def print_results(results, prefix=''):
+    """ Print the results, one line per measurement """
+
+    for name, value in sorted(results.items()):
+        if isinstance(value, dict) and 'median_ms' not in value:
+            print_results(value, prefix + name + '.')
+        elif isinstance(value, dict):
+            line = '%-45s median %9.3f ms  p95 %9.3f ms' % (
+                prefix + name, value['median_ms'], value['p95_ms'])
+
+            if 'requests_per_second' in value:
+                line += '  %8.1f req/s' % value['requests_per_second']
+
+            print line
+
+
+if '__main__' == __name__:
+    output = 'bench-results.json'
+    pollers = 4
+
+    if 1 < len(sys.argv):
+        output = os.path.abspath(sys.argv[1])
+
+    if 2 < len(sys.argv):
+        pollers = int(sys.argv[2])
+
+    daemon_port = startup_bench.free_port()
+    benchutil.setup_environment({
+        'server': {'address': '127.0.0.1', 'port': daemon_port}
+    })
+
+    if not os.path.isabs(output):
+        output = os.path.join(benchutil.SOURCE_DIR, output)
+
+    from ospim.gpio import OSPiMGPIO
+    from ospim.storage import OSPiMZones
+    from ospim.webserver import OSPiMHTTPServer, OSPiMRequestHandler
+
+    # Keep the output readable, the request log goes to stderr
+    OSPiMRequestHandler.log_message = lambda self, format, *args: None
+
+    calendar = calendar_server.start_server()
+
+    zone = OSPiMZones()
+    gpio = OSPiMGPIO(zone)
+    gpio.start_writer()
+
+    results = {
+        'calendar_cycle': measure_calendar_cycle(calendar, zone, gpio, 5),
+        'storage_write': measure_storage_write(calendar, zone, gpio, 100)
+    }
+
+    # Daemon HTTP server with a schedule of POLLING_EVENTS events
+    calendar_server.set_events(
+        calendar, calendar_server.generate_events(POLLING_EVENTS))
+
+    schedule = empty_schedule()
+    create_calendar_thread(zone, gpio, schedule,
+                           create_source('ics', calendar)).run_cycle()
+
+    httpd = OSPiMHTTPServer(('127.0.0.1', 0), OSPiMRequestHandler)
+    httpd.set_gpio_handler(gpio)
+    httpd.set_zone_data(zone)
+    httpd.set_schedule_data(schedule)
+
+    server_thread = threading.Thread(target=httpd.serve_forever)
+    server_thread.daemon = True
+    server_thread.start()
+
+    port = httpd.server_address[1]
+
+    results['http_polling'] = {
+        'get_zones': measure_polling(port, 'get-zones', pollers, 200),
+        'get_schedule': measure_polling(port, 'get-schedule', pollers, 50)
+    }
+    results['toggle_to_latch'] = measure_toggles(port, zone, gpio, 200)
+
+    httpd.shutdown()
+    gpio.close()
+
+    results['cold_start'] = measure_cold_start(daemon_port, 3)
+
+    f = open(output, 'w')
+    f.write(json.dumps({
+        'meta': {
+            'time': datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+            'revision': revision(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'pollers': pollers
+        },
+        'results': results
+    }, indent=2, sort_keys=True))
+    f.close()
+
+    print_results(results)
+    print 'toggle_to_latch mismatches: %d' % \
+        results['toggle_to_latch']['mismatches']
+    print 'Results written to ' + output
+
+    if results['toggle_to_latch']['mismatches']:
+        sys.exit(1)
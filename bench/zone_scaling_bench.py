@@ -0,0 +1,82 @@
+#!/usr/bin/python -tt
+# zone_scaling_bench.py: Zone toggle latency for growing number of zones
+#
+# Copyright 2013 Sudaraka Wijesinghe <sudaraka.wijesinghe@gmail.com>
+#
+# This file is part of OpenSprinkler Pi Monitor (OSPi Monitor)
+#
+# OSPi Monitor is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# OSPi Monitor is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with OSPi Monitor.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import os
+import sys
+import time
+
+import benchutil
+
+work_dir = benchutil.setup_environment()
+
+from ospim.gpio import OSPiMGPIO
+from ospim.gpiobackend import OSPiMMmapGPIOBackend
+from ospim.storage import OSPiMZones
+
+
+def toggle_latency(zone, gpio, toggles):
+    """
+    Return the average time (ms) of a zone toggle and of the latch alone,
+    spreading the toggles over all zones
+    """
+
+    zone_count = zone._data['zone_count']
+
+    toggle_time = 0.0
+    latch_time = 0.0
+
+    for i in range(toggles):
+        zone_id = (i * 7) % zone_count
+
+        begin = time.time()
+        zone.set_status(zone_id, 1 - zone._data['zone'][zone_id]['status'])
+        latch_begin = time.time()
+        gpio.shift_register_write()
+        end = time.time()
+
+        toggle_time += end - begin
+        latch_time += end - latch_begin
+
+    return toggle_time * 1000 / toggles, latch_time * 1000 / toggles
+
+
+if '__main__' == __name__:
+    toggles = 500
+    if 1 < len(sys.argv):
+        toggles = int(sys.argv[1])
+
+    device = os.path.join(work_dir, 'gpiomem')
+    f = open(device, 'wb')
+    f.write('\0' * 4096)
+    f.close()
+
+    zone = OSPiMZones()
+    gpio = OSPiMGPIO(
+        zone, OSPiMMmapGPIOBackend(device, 4096, 0x00, 0x1c, 0x28))
+
+    print '%d toggles, mmap backend on %s' % (toggles, device)
+    print 'zones  toggle ms  latch ms'
+
+    for zone_count in (16, 32, 64, 128, 256):
+        zone.set_count(zone_count)
+        toggle, latch = toggle_latency(zone, gpio, toggles)
+
+        print '%5d  %9.3f  %8.3f' % (zone_count, toggle, latch)
@@ -21,15 +21,21 @@
 
 import datetime
 import hashlib
-import httplib2
 import json
 import logging
+import random
 import sys
 import threading
 import time
 import urllib
 
-from .config import ospim_conf
+from .clock import get_clock
+from .config import OSPiMConfigOption, get_config
+from .ical import OSPiMICalendarSource
+from .isotime import epoch_to_local, iso_to_epoch
+from .sequencer import OSPiMSequencer
+from .source import OSPiMEventSource, parse_retry_after
+from .wakeup import OSPiMWakeup
 
 
 # =============================================================================
@@ -38,8 +44,12 @@ if '__main__' == __name__:
     sys.exit(1)
 
 
+# Log messages of this module, the level can be set per module
+logger = logging.getLogger(__name__)
+
+
 # =============================================================================
-class GoogleCalender:
+class GoogleCalender(OSPiMEventSource):
 
     """
     Subroutines for accessing Google Calender API v3 via RESTful interface
@@ -49,75 +59,157 @@ class GoogleCalender:
     base_api_url = 'https://www.googleapis.com/calendar/v3/calendars/'
 
     # Google API access key
-    api_key = ospim_conf.get('calendar', 'api_key')
+    api_key = OSPiMConfigOption('calendar', 'api_key')
+
+    # Where the recurring events get expanded in to single instances,
+    # 'google' (API singleEvents) or 'local'
+    recurrence_expansion = OSPiMConfigOption('calendar',
+                                             'recurrence_expansion')
+
+    def is_ready(self, cache):
+        """ Google API can only be queried when there is a calendar Id """
+
+        return None != cache._data['calendar_id'] \
+            and 1 < len(cache._data['calendar_id'])
 
     def fetch_events(self, cache):
-        """ Return a dictionary of upcoming events """
+        """
+        Fetch the upcoming events in to the schedule cache. Return False on
+        communication error.
+        """
 
         # Get the current time stamp in UTC and convert to ISO format
         # compatible with Google API YYYY-MM-DDTHH:II:SS.zzzZ
-        time_stamp = datetime.datetime.utcnow().isoformat()
+        time_stamp = get_clock().utcnow().isoformat()
         dot_pos = time_stamp.find('T')
         time_stamp = time_stamp[:dot_pos] + 'T00:00:00.000Z'
 
-        # Fetch scheduled events from now and on wards
+        # End of the horizon window in the same format
+        window_end = datetime.datetime.utcfromtimestamp(
+            time.mktime(self._horizon_window()[1].timetuple()))
+        time_max = window_end.isoformat() + '.000Z'
+
+        # Fetch scheduled events from now up to the end of the horizon
         event_list = self._get_json(
-            cache._data['calendar_id'], {'timeMin': time_stamp}
+            cache._data['calendar_id'],
+            {'timeMin': time_stamp, 'timeMax': time_max}
         )
 
         # In case of a communication error, ignore updating records
         if None == event_list:
-            return
-            #event_list = []
+            return False
 
         return_list = {}
 
+        if self.expand_locally():
+            event_list = self._expand_recurring(event_list, return_list)
+
         for event in event_list:
             if 'summary' not in event:
                 continue
 
-            start_time = self._iso_datetime_to_py(event['start']['dateTime'])
-            end_time = self._iso_datetime_to_py(event['end']['dateTime'])
+            start_time = self._event_time(event['start'])
+            end_time = self._event_time(event['end'])
+
+            self._add_event(return_list, event['id'], event['summary'],
+                            start_time, end_time)
+
+        cache.update(return_list, True)
+
+        return True
+
+    def expand_locally(self):
+        """
+        Return True when recurring events must be expanded locally instead of
+        by the Google API (singleEvents)
+        """
+
+        return 'local' == self.recurrence_expansion
+
+    def _expand_recurring(self, event_list, return_list):
+        """
+        Add the instances of recurring master events that fall inside the
+        horizon window to the return_list, honoring the modified or cancelled
+        instances (exceptions) returned by the API.
+
+        Return the list of remaining single events.
+        """
+
+        masters = []
+        single_events = []
+        exceptions = {}
+
+        for event in event_list:
+            if 'recurrence' in event:
+                masters.append(event)
+            elif 'recurringEventId' in event:
+                original_start = self._event_time(
+                    event['originalStartTime'])
+                exceptions[self._instance_id(event['recurringEventId'],
+                                             original_start)] = event
+            elif 'cancelled' != event.get('status'):
+                single_events.append(event)
+
+        for master in masters:
+            if 'summary' not in master:
+                continue
 
-            if datetime.datetime.now() > end_time:
+            signature = hashlib.md5(json.dumps([
+                master.get('updated'),
+                master['recurrence'],
+                master['start'],
+                master['end']
+            ], sort_keys=True)).hexdigest()
+
+            self._add_recurring_event(
+                return_list,
+                master['id'],
+                signature,
+                master['summary'],
+                self._event_time(master['start']),
+                self._event_time(master['end']),
+                master['recurrence'],
+                exceptions,
+                self._wall_offset(master['start'])
+            )
+
+        for instance_id, event in exceptions.items():
+            if 'cancelled' == event.get('status') or 'start' not in event:
                 continue
 
-            # Flag to indicate whether the event is running
-            # (zone is on or not)
-            is_running = 0
-            if datetime.datetime.now() >= start_time and \
-                    datetime.datetime.now() <= end_time:
-                is_running = 1
-
-            return_list[event['id']] = {
-                'zone_name': event['summary'],
-                'zone_id': None,
-                'turn_on': str(start_time),
-                'turn_off': str(end_time),
-                'running': is_running
-            }
+            event = dict(event)
+            event['id'] = instance_id
+            single_events.append(event)
 
-        cache.update(return_list, True)
+        self._recurrence.retain([master['id'] for master in masters])
 
-    def _iso_datetime_to_py(self, iso_datetime_string):
+        return single_events
+
+    def _event_time(self, event_time):
         """
-        Convert ISO time stamp from Google API to Python datetime object
+        Convert start/end time object of an event from Google API to local
+        Python datetime object. All-day events have only the date.
         """
 
-        # Drop the timezone part (GMT + time zones)
-        plus_pos = iso_datetime_string.find('+')
-        if plus_pos:
-            iso_datetime_string = iso_datetime_string[:plus_pos]
+        if 'dateTime' in event_time:
+            return epoch_to_local(iso_to_epoch(event_time['dateTime']))
 
-        # Drop the timezone part (GMT - time zones)
-        minus_pos = iso_datetime_string.rfind('-')
-        if minus_pos and 10 < minus_pos:
-            iso_datetime_string = iso_datetime_string[:minus_pos]
+        return epoch_to_local(iso_to_epoch(event_time['date']))
 
-        return datetime.datetime.strptime(
-            iso_datetime_string,
-            '%Y-%m-%dT%H:%M:%S'
-        )
+    def _wall_offset(self, event_time):
+        """
+        Return the local time less the calendar wall clock time of an event
+        start/end time object, recurrence date-times with TZID are in the
+        calendar wall clock time
+        """
+
+        if 'dateTime' not in event_time:
+            return datetime.timedelta()
+
+        wall = datetime.datetime.strptime(event_time['dateTime'][:19],
+                                          '%Y-%m-%dT%H:%M:%S')
+
+        return self._event_time(event_time) - wall
 
     def _get_json(self, calendar_id, parameters=None):
         """
@@ -132,17 +224,33 @@ class GoogleCalender:
         elif 'key' not in parameters:
             parameters['key'] = self.api_key
 
-        parameters['singleEvents'] = 'True'
-        parameters['orderBy'] = 'startTime'
+        # Ordering by start time is only allowed with single events, and the
+        # local expansion doesn't need it
+        if not self.expand_locally():
+            parameters['singleEvents'] = 'True'
+            parameters['orderBy'] = 'startTime'
 
         url += '?' + urllib.urlencode(parameters)
 
+        self.retry_after = None
+
         try:
-            http = httplib2.Http()
+            # Only the Google calendar source needs it, load on first use
+            import httplib2
+
+            http = httplib2.Http(timeout=self._http_timeout())
             json_string = http.request(url, 'GET')
+
+            # Rate limited or temporarily unavailable
+            if 400 <= json_string[0].status:
+                self.retry_after = parse_retry_after(
+                    json_string[0].get('retry-after'))
+
+                raise Exception('HTTP status %d' % json_string[0].status)
+
             json_obj = json.loads(json_string[1])
         except Exception as e:
-            logging.error('Failed to fetch or decode calendar data: ' + str(e))
+            logger.error('Failed to fetch or decode calendar data: ' + str(e))
             return None
 
         if 'items' not in json_obj:
@@ -151,6 +259,102 @@ class GoogleCalender:
         return json_obj['items']
 
 
+# =============================================================================
+class OSPiMCircuitBreaker(object):
+
+    """
+    Keeps track of the failing event source queries and decide when the next
+    query can be attempted.
+
+    After a failure the next attempt is delayed exponentially (with jitter, or
+    as long as the server asked via Retry-After). When the number of
+    consecutive failures reaches the threshold the breaker is "open", then a
+    single trial query is allowed after the delay ("half-open"), which close
+    the breaker again on success.
+    """
+
+    def __init__(self, base_delay, max_delay, threshold):
+        """ Initialize breaker in closed state """
+
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.threshold = threshold
+
+        self.state = 'closed'
+        self.failures = 0
+        self.next_attempt = 0
+        self.last_error = None
+        self.last_success = None
+
+    def allow(self):
+        """ Return True if a query can be attempted now """
+
+        if get_clock().time() < self.next_attempt:
+            return False
+
+        if 'open' == self.state:
+            self.state = 'half-open'
+            logger.info('[calendar:breaker] Trying to query again')
+
+        return True
+
+    def record_success(self):
+        """ Reset the breaker after a successful query """
+
+        if 'closed' != self.state:
+            logger.info('[calendar:breaker] Closed after %d failure(s)' %
+                        self.failures)
+
+        self.state = 'closed'
+        self.failures = 0
+        self.next_attempt = 0
+        self.last_success = get_clock().time()
+
+    def record_failure(self, retry_after=None, error=None):
+        """ Schedule the next attempt after a failed query """
+
+        self.failures += 1
+        self.last_error = error
+
+        delay = min(self.max_delay,
+                    self.base_delay * (2 ** min(self.failures, 30)))
+        delay = random.uniform(delay / 2.0, delay)
+
+        if None != retry_after:
+            delay = max(delay, retry_after)
+
+        self.next_attempt = get_clock().time() + delay
+
+        if self.threshold <= self.failures and 'open' != self.state:
+            logger.warning(
+                '[calendar:breaker] Open after %d failure(s), next attempt '
+                'in %d seconds' % (self.failures, delay))
+
+        if self.threshold <= self.failures:
+            self.state = 'open'
+
+    def status(self):
+        """ Return the breaker state as a dictionary """
+
+        return {
+            'state': self.state,
+            'failures': self.failures,
+            'next_attempt': self.next_attempt or None,
+            'last_error': self.last_error,
+            'last_success': self.last_success
+        }
+
+
+# =============================================================================
+def create_event_source():
+    """ Create the schedule event source selected in configuration """
+
+    if 'ics' == get_config().calendar.source:
+        return OSPiMICalendarSource()
+
+    return GoogleCalender()
+
+
 # =============================================================================
 class OSPiCalendarThread(threading.Thread):
 
@@ -162,10 +366,24 @@ class OSPiCalendarThread(threading.Thread):
     # Number of seconds to wait between queries
     # This also server a second purpose, to indicate that thread must keep on
     # running while > 0
-    query_delay = ospim_conf.getint('calendar', 'query_delay')
+    query_delay = OSPiMConfigOption('calendar', 'query_delay')
+
+    # Longest delay between failing queries, in seconds
+    max_backoff = OSPiMConfigOption('calendar', 'max_backoff')
+
+    # Number of consecutive failures that open the circuit breaker
+    breaker_threshold = OSPiMConfigOption('calendar',
+                                          'breaker_threshold')
+
+    # Schedule event source object
+    _source = None
+
+    # Event source created by a configuration reload, replaces _source at
+    # the start of the next cycle
+    _pending_source = None
 
-    # Google calender access object
-    gcal = GoogleCalender()
+    # Failing query tracker
+    _breaker = None
 
     # Schedule data local storage
     _schedule = None
@@ -176,6 +394,22 @@ class OSPiCalendarThread(threading.Thread):
     # GPIO communication handler
     _gpio = None
 
+    # Concurrent zone limiter
+    _sequencer = None
+
+    def __init__(self):
+        """ Initialize the thread, it doesn't keep the daemon running """
+
+        super(OSPiCalendarThread, self).__init__(name='ospim-calendar')
+
+        self.daemon = True
+
+        # Set by stop() to wake up the thread and end it
+        self._stop_event = OSPiMWakeup()
+
+        # Guards _pending_source, set from the reload (main) thread
+        self._source_lock = threading.Lock()
+
     def set_gpio_handler(self, gpio_handler):
         """ Set GPIO handler object """
 
@@ -194,77 +428,193 @@ class OSPiCalendarThread(threading.Thread):
 
         self._schedule = schedule_data
 
+    def set_event_source(self, source):
+        """ Set schedule event source object """
+
+        self._source = source
+
+    def set_sequencer(self, sequencer):
+        """ Set concurrent zone sequencer object """
+
+        self._sequencer = sequencer
+
+    def get_status(self):
+        """ Return the status of the event source queries """
+
+        if None == self._breaker:
+            return {'state': 'closed', 'failures': 0}
+
+        return self._breaker.status()
+
     def stop(self):
         """
-        Set the query_delay to zero, so that run loop will exit and
-        end the thread.
+        Wake up the thread from waiting for the next query, so that run loop
+        will exit and end the thread.
+        """
+
+        self._stop_event.set()
+
+    def apply_config(self, changed):
+        """
+        Apply the options changed by a configuration reload, list of
+        (section, option). A new event source is created when the source
+        changed, the circuit breaker keeps its state with the new limits.
+        The new source is used from the next cycle, the current one finishes
+        with the old source.
         """
 
-        self.query_delay = 0
+        options = set(option for section, option in changed
+                      if 'calendar' == section)
+
+        if options & set(['source', 'ics_location']):
+            source = create_event_source()
+
+            with self._source_lock:
+                self._pending_source = source
+
+            logger.info('[calendar:reload] Event source replaced from the '
+                        'next query')
+
+        if None != self._breaker:
+            self._breaker.base_delay = self._get_query_delay()
+            self._breaker.max_delay = self.max_backoff
+            self._breaker.threshold = self.breaker_threshold
 
     def run(self):
         """ Execute the calendar lookup routines """
 
-        # Make sure we wait at least a minute
-        if 10 > self.query_delay and 0 < self.query_delay:
-            self.query_delay = 10
-
-        # Continue as long as we have query_delay > 0
-        while 0 < self.query_delay:
-            # Only run the Google Calendar API query if there is a calendar Id
-            # present.
-            try:
-                if None != self._schedule._data['calendar_id'] \
-                        and 1 < len(self._schedule._data['calendar_id']):
-                    zone_hash = hashlib.md5(json.dumps(self._zone._data))
-
-                    self.gcal.fetch_events(self._schedule)
-                    self._zone.clear_long_running_zones()
-
-                    # Update zone status from schedule
-                    self._update_zone_from_schedule(zone_hash)
-
-            except Exception, e:
-                logging.error('[calendar:run] ' + str(e))
-
-            # Here we sleep bunch of 1 second intervals that will add up to
-            # query_delay so when the stop() is called the thread will exit
-            # sooner without waiting for remainder of the query_delay
-            delay_count = 0
-            while delay_count < self.query_delay:
-                delay_count += 1
-                time.sleep(1)
-
-    def _update_zone_from_schedule(self, zone_hash):
+        self.prepare()
+
+        # Continue as long as we have query_delay > 0 and stop() is not called
+        while 0 < self.query_delay and not self._stop_event.is_set():
+            self.run_cycle()
+
+            # Sleep until the next query, stop() wakes it up right away
+            self._stop_event.wait(self._get_query_delay())
+
+    def _get_query_delay(self):
+        """ Number of seconds between the queries, at least 10 """
+
+        return max(10, self.query_delay)
+
+    def prepare(self):
+        """
+        Create the event source, sequencer and circuit breaker that were not
+        set, before the first run_cycle()
+        """
+
+        if None == self._source:
+            self._source = create_event_source()
+
+        if None == self._sequencer:
+            self._sequencer = OSPiMSequencer()
+
+        self._breaker = OSPiMCircuitBreaker(self._get_query_delay(),
+                                            self.max_backoff,
+                                            self.breaker_threshold)
+
+    def run_cycle(self):
+        """ Query the event source once and update the zone status """
+
+        # Take the event source of a configuration reload
+        with self._source_lock:
+            if None != self._pending_source:
+                self._source = self._pending_source
+                self._pending_source = None
+
+        # Only run the event source query if it has been configured (i.e.
+        # Google calendar Id is present).
+        try:
+            if self._source.is_ready(self._schedule):
+                zone_bits = self._zone.get_bitmask()
+
+                # While the source is failing, keep driving the zones
+                # from the events cached in the schedule
+                if not self._fetch_events():
+                    self._schedule.refresh_running()
+
+                # The daemon is turning the zones off, leave them off
+                if self._stop_event.is_set():
+                    return
+
+                self._zone.clear_long_running_zones()
+
+                # Update zone status from schedule
+                self._update_zone_from_schedule(zone_bits)
+
+        except Exception, e:
+            logger.error('[calendar:run] ' + str(e))
+
+        # Periodic safety write of the zone status to the device
+        if None != self._gpio:
+            self._gpio.relatch()
+            self._gpio.log_summary()
+
+    def _fetch_events(self):
+        """
+        Query the event source unless the circuit breaker holds it back.
+        Return True when the schedule was updated.
+        """
+
+        if not self._breaker.allow():
+            return False
+
+        try:
+            if self._source.fetch_events(self._schedule):
+                self._breaker.record_success()
+                return True
+
+            error = 'Failed to fetch events'
+        except Exception as e:
+            error = str(e)
+            logger.error('[calendar:fetch] ' + error)
+
+        self._breaker.record_failure(self._source.retry_after, error)
+
+        return False
+
+    def _update_zone_from_schedule(self, zone_bits):
         """
         Find the currently running zones from scheduled events and update local
-        zone status data.
-        If the zone data changed, also send the new data to GPIO.
+        zone status data for the zones that need to change.
+        If the zone status differs from zone_bits (status before this cycle),
+        save the zone data and send the new status to GPIO once.
         """
 
-        just_turned_on = []
-        schedule_data = self._schedule.get_sorted()
+        zones = self._zone._data['zone']
 
-        for e in schedule_data['events']:
-            # Already turned on in this loop
-            if e['zone_id'] in just_turned_on:
-                continue
+        # Zones allowed to run now, within the concurrent zone limit
+        active = self._sequencer.update(
+            self._schedule.get_active_zones(),
+            dict((z, zone.get('priority', 0)) for z, zone in enumerate(zones)))
+        changed = False
 
-            if 1 == e['running']:
-                just_turned_on.append(e['zone_id'])
+        for zone_id, zone in enumerate(zones):
+            if zone_id >= self._zone._data['zone_count']:
+                break
 
-                if 0 == self._zone._data['zone'][e['zone_id']]['status'] and \
-                    1 == self._zone._data['zone'][e['zone_id']]['manual_off'] \
-                        and e['turn_on'] < \
-                        self._zone._data['zone'][e['zone_id']]['start_time'] \
-                        and e['turn_off'] > \
-                        self._zone._data['zone'][e['zone_id']]['start_time']:
+            if zone_id in active:
+                # Already running under the schedule
+                if 1 == zone['status'] and 'S' == zone['state_owner']:
+                    continue
 
+                # Zone was manually turned off while the event was running
+                if 0 == zone['status'] and 1 == zone['manual_off'] and \
+                        [e for e in active[zone_id]
+                         if e[0] < zone['start_time'] < e[1]]:
+                    # Give the slot to the next zone in the queue
+                    self._sequencer.cancel(zone_id)
                     continue
 
-            self._zone.set_status(e['zone_id'], e['running'], 'S')
+                self._zone.set_status(zone_id, 1, 'S', False)
+                changed = True
+
+            elif 1 == zone['status'] and 'S' == zone['state_owner']:
+                self._zone.set_status(zone_id, 0, 'S', False)
+                changed = True
 
-        new_hash = hashlib.md5(json.dumps(self._zone._data))
+        if changed:
+            self._zone.write()
 
-        if new_hash.hexdigest() != zone_hash.hexdigest():
+        if self._zone.get_bitmask() != zone_bits:
             self._gpio.shift_register_write()
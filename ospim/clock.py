@@ -0,0 +1,116 @@
+# clock.py: Source of the current time for the schedule and zone logic
+#
+# Copyright 2013 Sudaraka Wijesinghe <sudaraka.wijesinghe@gmail.com>
+#
+# This file is part of OpenSprinkler Pi Monitor (OSPi Monitor)
+#
+# OSPi Monitor is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# OSPi Monitor is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with OSPi Monitor.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+import datetime
+import sys
+import threading
+import time
+
+
+# =============================================================================
+# Make sure this script doesn't get executed directly
+if '__main__' == __name__:
+    sys.exit(1)
+
+
+# =============================================================================
+class OSPiMClock(object):
+
+    """
+    Wall clock. Everything that decides by the time of day when zones turn
+    on and off asks the clock returned by get_clock(), so a simulation can
+    replace it with OSPiMSimulatedClock.
+    """
+
+    def now(self):
+        """ Return the current local time as datetime """
+
+        return datetime.datetime.now()
+
+    def utcnow(self):
+        """ Return the current UTC time as datetime """
+
+        return datetime.datetime.utcnow()
+
+    def time(self):
+        """ Return the current time as seconds since the epoch """
+
+        return time.time()
+
+
+# =============================================================================
+class OSPiMSimulatedClock(OSPiMClock):
+
+    """ Clock that stands still until it is moved forward """
+
+    def __init__(self, start):
+        """ Initialize the clock to the given local datetime """
+
+        self._lock = threading.Lock()
+        self._now = start
+
+    def now(self):
+        """ Return the simulated local time """
+
+        with self._lock:
+            return self._now
+
+    def utcnow(self):
+        """ Return the simulated UTC time """
+
+        return datetime.datetime.utcfromtimestamp(self.time())
+
+    def time(self):
+        """ Return the simulated time as seconds since the epoch """
+
+        now = self.now()
+
+        return time.mktime(now.timetuple()) + now.microsecond / 1000000.0
+
+    def set(self, now):
+        """ Move the clock to the given local datetime """
+
+        with self._lock:
+            self._now = now
+
+    def advance(self, seconds):
+        """ Move the clock forward by the given number of seconds """
+
+        with self._lock:
+            self._now += datetime.timedelta(seconds=seconds)
+
+
+# Clock returned by get_clock()
+_clock = OSPiMClock()
+
+
+def get_clock():
+    """ Return the clock in use """
+
+    return _clock
+
+
+def set_clock(clock):
+    """ Replace the clock, i.e. with OSPiMSimulatedClock """
+
+    global _clock
+
+    _clock = clock
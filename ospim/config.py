@@ -19,11 +19,238 @@
 #
 
 import ConfigParser
+import logging
 import os
 
-ospim_conf = ConfigParser.ConfigParser()
-ospim_conf.read([
+
+# Log messages of this module, the level can be set per module
+logger = logging.getLogger(__name__)
+
+# Configuration files, settings in the later files override the earlier ones
+_config_files = [
     '/etc/ospim.conf',
     os.path.expanduser('~/.config/ospim/ospim.conf'),
     './ospim.conf'
-])
+]
+
+
+def _number(value):
+    """ Convert decimal or 0x prefixed hexadecimal string to integer """
+
+    return int(value, 0)
+
+
+def _positive(value):
+    """ Convert string to integer that must be at least 1 """
+
+    number = int(value)
+
+    if 1 > number:
+        raise ValueError('%d is less than 1' % number)
+
+    return number
+
+
+# Type and default value of each option, section => option => (type,
+# default). Options without a default (None) must be in the configuration
+# file, the defaults are for the settings that were introduced after the
+# initial release, so that the existing configuration files continue to work.
+# Invalid values of the options with a default fall back to the default.
+_options = {
+    'daemon': {
+        'pid_file': (str, None),
+        'log_file': (str, None),
+        'log_format': (str, 'text'),
+        'log_level': (str, 'info'),
+        'log_levels': (str, ''),
+        'log_rate_limit': (int, '60'),
+        'log_queue_size': (int, '10000'),
+        'stop_timeout': (int, '10'),
+        'profile_dir': (str, ''),
+        'profile_interval': (float, '0.01')
+    },
+    'server': {
+        'address': (str, None),
+        'port': (int, None),
+        'root_directory': (str, None)
+    },
+    'opensprinkler': {
+        'zone_file': (str, None),
+        'zones_per_board': (_positive, '8'),
+        'max_zones': (int, '256'),
+        'max_concurrent': (int, '0'),
+        'master_zone': (int, '0')
+    },
+    'gpio': {
+        'backend': (str, 'rpi'),
+        'relatch_interval': (int, '300'),
+        'summary_interval': (int, '3600'),
+        'reconnect_delay': (int, '5'),
+        'reconnect_max_delay': (int, '300'),
+        'mmap_device': (str, '/dev/gpiomem'),
+        'mmap_size': (_number, '4096'),
+        'mmap_fsel_offset': (_number, '0x00'),
+        'mmap_set_offset': (_number, '0x1c'),
+        'mmap_clr_offset': (_number, '0x28'),
+        'pin_clk': (int, None),
+        'pin_noe': (int, None),
+        'pin_lat': (int, None),
+        'pin_dat': (int, None)
+    },
+    'calendar': {
+        'source': (str, 'google'),
+        'ics_location': (str, ''),
+        'schedule_file': (str, None),
+        'query_delay': (int, None),
+        'max_backoff': (int, '3600'),
+        'breaker_threshold': (int, '5'),
+        'fetch_timeout': (int, '5'),
+        'api_key': (str, None),
+        'recurrence_expansion': (str, 'google'),
+        'horizon_days': (int, '14')
+    }
+}
+
+# Options that are only used while the daemon starts, reload_config() keeps
+# their current value and the change takes effect on restart
+_restart_options = {
+    'daemon': ('pid_file', 'log_file', 'log_format', 'log_queue_size',
+               'profile_dir'),
+    'server': ('address', 'port'),
+    'opensprinkler': ('zone_file',),
+    'gpio': ('backend', 'mmap_device', 'mmap_size', 'mmap_fsel_offset',
+             'mmap_set_offset', 'mmap_clr_offset', 'pin_clk', 'pin_noe',
+             'pin_lat', 'pin_dat'),
+    'calendar': ('schedule_file',)
+}
+
+
+# =============================================================================
+class OSPiMConfigSection(object):
+
+    """ Options of a configuration section as typed attributes """
+
+    pass
+
+
+# =============================================================================
+class OSPiMConfig(object):
+
+    """
+    Application configuration, read from the configuration files once and
+    converted to the type of each option. Sections are attributes holding
+    the options as attributes, i.e. config.gpio.pin_clk
+    """
+
+    def __init__(self, files=None):
+        """ Read the given configuration files, or the default ones """
+
+        # Absolute paths, the daemon changes the working directory before
+        # the files are read again
+        self.files = [os.path.abspath(f) for f in files or _config_files]
+
+        parser = ConfigParser.ConfigParser()
+        parser.read(self.files)
+
+        for section, options in _options.items():
+            values = OSPiMConfigSection()
+
+            for option, (convert, default) in options.items():
+                if parser.has_option(section, option):
+                    value = parser.get(section, option)
+                elif None != default:
+                    value = default
+                else:
+                    raise ConfigParser.NoOptionError(option, section)
+
+                try:
+                    value = convert(value)
+                except ValueError as e:
+                    if None == default:
+                        raise
+
+                    logger.warning('Invalid %s.%s (%s), using %s' %
+                                   (section, option, str(e), default))
+                    value = convert(default)
+
+                setattr(values, option, value)
+
+            setattr(self, section, values)
+
+    def get(self, section, option):
+        """ Return the value of the option in the section """
+
+        return getattr(getattr(self, section), option)
+
+
+# =============================================================================
+class OSPiMConfigOption(object):
+
+    """
+    Class attribute that takes its value from the application configuration
+    when accessed, so that nothing is read while the modules are imported.
+    Setting the attribute on an instance overrides it for that instance.
+    """
+
+    def __init__(self, section, option):
+        """ Initialize with the section and option name of the value """
+
+        self.section = section
+        self.option = option
+
+    def __get__(self, instance, owner):
+        """ Return the configured value """
+
+        return get_config().get(self.section, self.option)
+
+
+# Configuration loaded by get_config()
+_config = None
+
+
+def get_config():
+    """ Return the application configuration, read on the first call """
+
+    global _config
+
+    if None == _config:
+        _config = OSPiMConfig()
+
+    return _config
+
+
+def reload_config():
+    """
+    Read the configuration files again and replace the application
+    configuration, options read through OSPiMConfigOption get the new value
+    on their next use. Options in _restart_options keep the current value.
+
+    Return the lists of changed and of held back options as (section,
+    option) tuples. If the files can't be read the exception is raised and
+    the current configuration stays in use.
+    """
+
+    global _config
+
+    current = get_config()
+    config = OSPiMConfig(current.files)
+
+    changed = []
+    held_back = []
+
+    for section, options in sorted(_options.items()):
+        for option in sorted(options):
+            value = current.get(section, option)
+
+            if value == config.get(section, option):
+                continue
+
+            if option in _restart_options.get(section, ()):
+                setattr(getattr(config, section), option, value)
+                held_back.append((section, option))
+            else:
+                changed.append((section, option))
+
+    _config = config
+
+    return changed, held_back
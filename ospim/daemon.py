@@ -23,17 +23,17 @@
 #
 
 import atexit
+import errno
 import logging
 import os
+import select
 import signal
 import sys
 import time
 
-from .config import ospim_conf
-from .webserver import OSPiMHTTPServer, OSPiMRequestHandler
-from .gpio import OSPiMGPIO
-from .storage import OSPiMZones, OSPiMSchedule
-from .calendar import OSPiCalendarThread
+from .config import OSPiMConfigOption, get_config, reload_config
+from .logger import reload_logging
+from .wakeup import OSPiMWakeup
 
 
 # Make sure this script doesn't get executed directly
@@ -41,6 +41,10 @@ if '__main__' == __name__:
     sys.exit(1)
 
 
+# Log messages of this module, the level can be set per module
+logger = logging.getLogger(__name__)
+
+
 class OSPiMDaemon:
     """
     OSPi Monitor daemon
@@ -58,6 +62,18 @@ class OSPiMDaemon:
     # Calender lookup thread
     _cal_thread = None
 
+    # Set by SIGTERM to end the main loop (OSPiMWakeup)
+    _shutdown = None
+
+    # CPU and memory profiler, controlled with SIGUSR1 and SIGUSR2
+    _profiler = None
+
+    # Set by SIGHUP to reload the configuration in the main loop
+    _reload_requested = False
+
+    # Number of seconds to wait for the daemon or its threads to exit
+    stop_timeout = OSPiMConfigOption('daemon', 'stop_timeout')
+
     def __init__(self):
         """
         Initialize daemon settings
@@ -72,7 +88,7 @@ class OSPiMDaemon:
         self.stdin = devnull
         self.stdout = devnull
         self.stderr = devnull
-        self.pid_file = ospim_conf.get('daemon', 'pid_file')
+        self.pid_file = get_config().daemon.pid_file
 
     def start(self):
         """
@@ -83,14 +99,14 @@ class OSPiMDaemon:
         pid = self._get_pid()
 
         if pid:
-            logging.warning('PID file %s already exists.' % self.pid_file)
-            logging.warning('Start procedure aborted')
+            logger.warning('PID file %s already exists.' % self.pid_file)
+            logger.warning('Start procedure aborted')
             sys.stderr.write('ospimd already running.\n')
             sys.exit(1)
 
         # Call subroutines to fork daemon process and run daemon code
         self._fork_daemon()
-        logging.info('ospimd started!')
+        logger.info('ospimd started!')
         self.run()
 
     def _fork_daemon(self):
@@ -105,7 +121,7 @@ class OSPiMDaemon:
                 # Exit first parent
                 sys.exit(0)
         except OSError as e:
-            logging.error('Error on fork #1: %d - %s' % (e.errno, e.strerror))
+            logger.error('Error on fork #1: %d - %s' % (e.errno, e.strerror))
             sys.stderr.write(
                 'Failed to start daemon. See log file for details.')
             sys.exit(1)
@@ -121,7 +137,7 @@ class OSPiMDaemon:
                 # Exit second parent
                 sys.exit(0)
         except OSError as e:
-            logging.error('Error on fork #2: %d - %s' % (e.errno, e.strerror))
+            logger.error('Error on fork #2: %d - %s' % (e.errno, e.strerror))
             sys.stderr.write(
                 'Failed to start daemon. See log file for details.')
             sys.exit(1)
@@ -147,12 +163,40 @@ class OSPiMDaemon:
         signal.signal(signal.SIGTERM, self.sigterm_handler)
 
     def sigterm_handler(self, signum, frame):
-        """ Catch the SIGTERM to exit gracefully by triggering atexit. """
+        """
+        Catch the SIGTERM to exit gracefully, the main loop wakes up and
+        exits by triggering atexit.
+        """
 
-        while self._cal_thread.is_alive():
-            self._cal_thread.stop()
+        if None == self._shutdown:
+            sys.exit(0)
 
-        sys.exit(0)
+        self._shutdown.set()
+
+    def sigusr1_handler(self, signum, frame):
+        """ Start or stop the CPU profile """
+
+        try:
+            error = self._profiler.toggle_cpu()[1]
+            if None != error:
+                logger.warning('[daemon:sigusr1] ' + error)
+        except Exception as e:
+            logger.error('[daemon:sigusr1] ' + str(e))
+
+    def sigusr2_handler(self, signum, frame):
+        """ Take a memory snapshot """
+
+        try:
+            error = self._profiler.memory_snapshot()[1]
+            if None != error:
+                logger.warning('[daemon:sigusr2] ' + error)
+        except Exception as e:
+            logger.error('[daemon:sigusr2] ' + str(e))
+
+    def sighup_handler(self, signum, frame):
+        """ Reload the configuration once the main loop wakes up """
+
+        self._reload_requested = True
 
     def cleanup_instance(self):
         """
@@ -168,7 +212,7 @@ class OSPiMDaemon:
         try:
             os.remove(self.pid_file)
         except:
-            logging.warning('Failed to remove PID file.')
+            logger.warning('Failed to remove PID file.')
 
     def stop(self):
         """
@@ -179,22 +223,31 @@ class OSPiMDaemon:
         pid = self._get_pid()
 
         if not pid:
-            logging.warning(
+            logger.warning(
                 'Could not locate PID file %s during the stop procedure' %
                 self.pid_file
             )
-            logging.warning('Stop procedure aborted')
+            logger.warning('Stop procedure aborted')
             sys.stderr.write('ospimd is not running.\n')
 
             # return here instead of exit so we allow the execution to continue
             # for a restart
             return
 
-        # Terminate the process
+        # Terminate the process, and kill it if it doesn't exit in time
         try:
-            while True:
-                os.kill(pid, signal.SIGTERM)
-                time.sleep(.1)
+            os.kill(pid, signal.SIGTERM)
+
+            if not self._wait_for_exit(pid, self.stop_timeout):
+                logger.warning('ospimd did not stop in %d seconds, killing' %
+                               self.stop_timeout)
+
+                os.kill(pid, signal.SIGKILL)
+                self._wait_for_exit(pid, self.stop_timeout)
+
+            # Killed daemon can't remove its pid file
+            if os.path.exists(self.pid_file):
+                os.remove(self.pid_file)
         except OSError as e:
             e = str(e)
 
@@ -202,12 +255,12 @@ class OSPiMDaemon:
                 if os.path.exists(self.pid_file):
                     os.remove(self.pid_file)
             else:
-                logging.error(str(e))
+                logger.error(str(e))
                 sys.stderr.write('Stop procedure aborted.\n')
                 print str(e)
                 sys.exit(1)
 
-        logging.info('ospimd stopped!')
+        logger.info('ospimd stopped!')
 
     def restart(self):
         """
@@ -217,6 +270,24 @@ class OSPiMDaemon:
         self.stop()
         self.start()
 
+    def reload(self):
+        """
+        Make the running daemon read the configuration files again
+        """
+
+        pid = self._get_pid()
+
+        if not pid:
+            sys.stderr.write('ospimd is not running.\n')
+            sys.exit(1)
+
+        try:
+            os.kill(pid, signal.SIGHUP)
+        except OSError as e:
+            logger.error(str(e))
+            sys.stderr.write('Reload procedure aborted.\n')
+            sys.exit(1)
+
     def run(self):
         """
         Run the main loop
@@ -224,34 +295,157 @@ class OSPiMDaemon:
         functionality
         """
 
+        # Only the running daemon needs these, start and stop commands don't
+        from .calendar import OSPiCalendarThread
+        from .gpio import OSPiMGPIO
+        from .profiler import OSPiMProfiler
+        from .sequencer import OSPiMSequencer
+        from .storage import OSPiMZones, OSPiMSchedule
+        from .webserver import OSPiMHTTPServer, OSPiMRequestHandler
+
+        self._shutdown = OSPiMWakeup()
+
         try:
             server_address = (
-                ospim_conf.get('server', 'address'),
-                ospim_conf.getint('server', 'port')
+                get_config().server.address,
+                get_config().server.port
             )
 
             httpd = OSPiMHTTPServer(server_address, OSPiMRequestHandler)
 
-            self._gpio = OSPiMGPIO()
             self._zone = OSPiMZones()
+            self._gpio = OSPiMGPIO(self._zone)
+            self._gpio.start_writer()
             self._schedule = OSPiMSchedule()
+            sequencer = OSPiMSequencer()
 
             httpd.set_gpio_handler(self._gpio)
             httpd.set_zone_data(self._zone)
             httpd.set_schedule_data(self._schedule)
+            httpd.set_sequencer(sequencer)
 
             self._cal_thread = OSPiCalendarThread()
             self._cal_thread.set_schedule_data(self._schedule)
             self._cal_thread.set_zone_data(self._zone)
             self._cal_thread.set_gpio_handler(self._gpio)
+            self._cal_thread.set_sequencer(sequencer)
             self._cal_thread.start()
+
+            httpd.set_calendar_thread(self._cal_thread)
+
+            self._profiler = OSPiMProfiler()
+            httpd.set_profiler(self._profiler)
+
+            if self._profiler.is_enabled():
+                signal.signal(signal.SIGUSR1, self.sigusr1_handler)
+                signal.signal(signal.SIGUSR2, self.sigusr2_handler)
+
+            signal.signal(signal.SIGHUP, self.sighup_handler)
         except Exception as e:
-            logging.error('Failed to create HTTP Server: %s\n' %
-                          str(e))
+            logger.error('Failed to create HTTP Server: %s\n' %
+                         str(e))
             sys.exit(1)
 
-        while True:
-            httpd.handle_request()
+        self._serve(httpd)
+
+        # Give the calendar thread a moment to finish the current cycle. It
+        # is a daemon thread, a query hanging on the network must not keep
+        # the zones on until the stop command kills the process.
+        self._cal_thread.stop()
+        self._cal_thread.join(self.stop_timeout / 4.0)
+
+        httpd.server_close()
+
+        sys.exit(0)
+
+    def _serve(self, httpd):
+        """
+        Handle HTTP requests until SIGTERM sets the shutdown flag. Nothing
+        runs while there are no requests.
+        """
+
+        # Only called when a request is waiting, never block in it
+        httpd.timeout = 0
+
+        self._shutdown.wake_on_signals()
+
+        while not self._shutdown.is_set():
+            if self._reload_requested:
+                self._reload_requested = False
+                self._reload_config()
+
+            try:
+                readable = select.select([httpd, self._shutdown], [], [])[0]
+            except select.error as e:
+                # Interrupted by a signal, check the shutdown flag
+                if errno.EINTR != e.args[0]:
+                    raise
+
+                continue
+
+            if self._shutdown in readable:
+                self._shutdown.drain()
+
+            if httpd in readable:
+                httpd.handle_request()
+
+    def _reload_config(self):
+        """
+        Read the configuration files again and apply the changes to the
+        running components. Zones, schedule and GPIO are left as they are,
+        options that need a restart keep their current value.
+        """
+
+        try:
+            changed, held_back = reload_config()
+        except Exception as e:
+            logger.error('[daemon:reload] Configuration not reloaded: ' +
+                         str(e))
+            return
+
+        for section, option in held_back:
+            logger.warning('[daemon:reload] %s.%s changes on restart' %
+                           (section, option))
+
+        if 0 == len(changed):
+            logger.info('[daemon:reload] No changes to apply')
+            return
+
+        logger.info('[daemon:reload] Applying ' + ', '.join(
+            '%s.%s' % (section, option) for section, option in changed))
+
+        try:
+            reload_logging(get_config())
+            self._cal_thread.apply_config(changed)
+        except Exception as e:
+            logger.error('[daemon:reload] ' + str(e))
+
+    def _wait_for_exit(self, pid, timeout):
+        """
+        Wait until the process exits, at most timeout seconds. Return True if
+        the process is gone, or it has removed its pid file which is the last
+        thing it does before exit.
+        """
+
+        end = time.time() + timeout
+        delay = .001
+
+        while time.time() < end:
+            if not os.path.exists(self.pid_file):
+                return True
+
+            try:
+                os.kill(pid, 0)
+            except OSError as e:
+                if errno.ESRCH == e.errno:
+                    return True
+
+                raise
+
+            time.sleep(delay)
+            delay = min(delay * 2, .1)
+
+        return False
 
     def _get_pid(self):
         """
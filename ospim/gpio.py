@@ -21,9 +21,12 @@
 
 import logging
 import sys
+import threading
+import time
 
-import RPi.GPIO as GPIO
-from .config import ospim_conf
+from .clock import get_clock
+from .config import OSPiMConfigOption
+from .gpiobackend import create_backend
 from .storage import OSPiMZones
 
 
@@ -32,53 +35,342 @@ if '__main__' == __name__:
     sys.exit(1)
 
 
+# Log messages of this module, the level can be set per module
+logger = logging.getLogger(__name__)
+
+
+class OSPiMLatchFuture(object):
+
+    """
+    Result of a shift register write request queued to OSPiMGPIOWriter.
+    """
+
+    def __init__(self):
+        """ Initialize a pending result """
+
+        self._done = threading.Event()
+        self._result = None
+
+    def set_result(self, result):
+        """ Store the result of the write and wake up the waiters """
+
+        self._result = result
+        self._done.set()
+
+    def done(self):
+        """ Return True if the request has been processed """
+
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        """
+        Wait until the request is processed. Return True if the bits were
+        written to the device (or already there), False on failure and None
+        on timeout.
+        """
+
+        self._done.wait(timeout)
+
+        return self._result
+
+
+class OSPiMGPIOWriter(threading.Thread):
+
+    """
+    The only thread that drives the GPIO pins once started. Write requests
+    from any thread are queued, and all requests queued while a write is in
+    progress are merged in to a single write of the newest state.
+    """
+
+    def __init__(self, gpio):
+        """ Initialize the writer for the given OSPiMGPIO """
+
+        super(OSPiMGPIOWriter, self).__init__(name='ospim-gpio-writer')
+
+        self.daemon = True
+
+        self._gpio = gpio
+        self._condition = threading.Condition()
+        self._running = True
+
+        # Merged pending request
+        self._pending = False
+        self._bits = None
+        self._force = False
+        self._futures = []
+
+    def submit(self, bits=None, force=False):
+        """
+        Queue a write request and return OSPiMLatchFuture of it. Explicit bits
+        replace the bits of a pending request; without bits the zone status
+        at the time of the write is used.
+        """
+
+        future = OSPiMLatchFuture()
+
+        with self._condition:
+            if not self._pending:
+                self._bits = None
+                self._force = False
+
+            if None != bits:
+                self._bits = bits
+
+            self._force = self._force or force
+            self._futures.append(future)
+            self._pending = True
+
+            self._condition.notify()
+
+        return future
+
+    def stop(self, timeout=None):
+        """ Write any pending request and end the thread """
+
+        with self._condition:
+            self._running = False
+            self._condition.notify()
+
+        self.join(timeout)
+
+    def run(self):
+        """ Process the write requests """
+
+        while True:
+            with self._condition:
+                while self._running and not self._pending:
+                    self._condition.wait()
+
+                if not self._pending:
+                    return
+
+                bits, force, futures = \
+                    self._bits, self._force, self._futures
+
+                self._pending = False
+                self._futures = []
+
+            result = self._gpio._shift_register_write(bits, force)
+
+            for future in futures:
+                future.set_result(result)
+
+
+class OSPiMGPIOStatistics(object):
+
+    """
+    Timing and error counters of the shift register writes.
+    """
+
+    # Upper limits (milliseconds) of the latch latency histogram buckets,
+    # last bucket counts everything above the last limit
+    histogram_limits = (0.1, 0.5, 1, 5, 10, 50, 100)
+
+    def __init__(self):
+        """ Initialize empty counters """
+
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """ Clear all the counters """
+
+        with self._lock:
+            self.latches = 0
+            self.bits = 0
+            self.latch_time = 0.0
+            self.latch_time_max = 0.0
+            self.failed_outputs = 0
+            self.reconnect_attempts = 0
+            self.last_latch = None
+            self.last_failure = None
+            self.histogram = [0] * (len(self.histogram_limits) + 1)
+
+    def record_latch(self, seconds, count):
+        """ Add a successful write of count bits that took seconds """
+
+        milliseconds = seconds * 1000
+
+        with self._lock:
+            self.latches += 1
+            self.bits += count
+            self.latch_time += seconds
+            self.latch_time_max = max(self.latch_time_max, seconds)
+            self.last_latch = time.time()
+
+            bucket = 0
+            while bucket < len(self.histogram_limits) and \
+                    milliseconds > self.histogram_limits[bucket]:
+                bucket += 1
+
+            self.histogram[bucket] += 1
+
+    def record_failure(self, error):
+        """ Add a failed GPIO output """
+
+        with self._lock:
+            self.failed_outputs += 1
+            self.last_failure = str(error)
+
+    def record_reconnect(self):
+        """ Add an attempt to initialize the GPIO again """
+
+        with self._lock:
+            self.reconnect_attempts += 1
+
+    def status(self):
+        """ Return the counters as a dictionary """
+
+        with self._lock:
+            labels = ['<=%sms' % l for l in self.histogram_limits] + \
+                ['>%sms' % self.histogram_limits[-1]]
+
+            return {
+                'latches': self.latches,
+                'bits': self.bits,
+                'frame_ms_avg': self._average(self.latch_time, self.latches),
+                'frame_ms_max': self.latch_time_max * 1000,
+                'bit_ms_avg': self._average(self.latch_time, self.bits),
+                'failed_outputs': self.failed_outputs,
+                'reconnect_attempts': self.reconnect_attempts,
+                'last_latch': self.last_latch,
+                'last_failure': self.last_failure,
+                'histogram': dict(zip(labels, self.histogram))
+            }
+
+    def summary(self):
+        """ Return the counters as a single log line """
+
+        status = self.status()
+
+        return ('latches=%(latches)d frame_ms_avg=%(frame_ms_avg).3f '
+                'frame_ms_max=%(frame_ms_max).3f bit_ms_avg=%(bit_ms_avg).4f '
+                'failed_outputs=%(failed_outputs)d '
+                'reconnect_attempts=%(reconnect_attempts)d' % status)
+
+    def _average(self, seconds, count):
+        """ Return seconds / count in milliseconds, 0 when count is 0 """
+
+        if 0 == count:
+            return 0.0
+
+        return seconds * 1000 / count
+
+
 class OSPiMGPIO:
 
     """
-    Makes GPIO calls on RaspberryPi to operate OpenSprinkler hardware
+    Makes GPIO calls on RaspberryPi to operate OpenSprinkler hardware, via
+    the backend selected in [gpio] configuration.
     """
 
     # Indicator to the status of GPIO communication availability
     connected = True
 
+    # Zone data object, source of the zone status bits
+    _zone = None
+
+    # GPIO backend (OSPiMGPIOBackend)
+    _backend = None
+
+    # (frame, bit count) sent with the last successful write, and when
+    _last_frame = None
+    _last_latch_time = 0
+
+    # Thread that drives the pins, when started (OSPiMGPIOWriter)
+    _writer = None
+
+    # Set by close(), nothing is written to the shift register after the
+    # final frame
+    _closed = False
+
+    # Write timing and error counters (OSPiMGPIOStatistics)
+    statistics = None
+
+    # When the statistics summary was logged last
+    _last_summary_time = 0
+
+    # When the GPIO became unavailable, None while connected
+    _disconnected_since = None
+
+    # Total seconds of the past unavailable periods
+    _unavailable_time = 0.0
+
+    # Current reconnect backoff delay, and when to try next
+    _reconnect_delay = 0
+    _next_reconnect = 0
+
+    # Reconnect backoff, first delay and maximum delay in seconds
+    reconnect_delay = OSPiMConfigOption('gpio', 'reconnect_delay')
+    reconnect_max_delay = OSPiMConfigOption('gpio', 'reconnect_max_delay')
+
+    # Number of seconds after which the same bits are written again
+    relatch_interval = OSPiMConfigOption('gpio', 'relatch_interval')
+
+    # Number of seconds between the statistics summary log lines
+    summary_interval = OSPiMConfigOption('gpio', 'summary_interval')
+
     # GPIO Pins used for serial communication
-    _pin_clk = ospim_conf.getint('gpio', 'pin_clk')
-    _pin_noe = ospim_conf.getint('gpio', 'pin_noe')
-    _pin_dat = ospim_conf.getint('gpio', 'pin_dat')
-    _pin_lat = ospim_conf.getint('gpio', 'pin_lat')
+    _pin_clk = OSPiMConfigOption('gpio', 'pin_clk')
+    _pin_noe = OSPiMConfigOption('gpio', 'pin_noe')
+    _pin_dat = OSPiMConfigOption('gpio', 'pin_dat')
+    _pin_lat = OSPiMConfigOption('gpio', 'pin_lat')
 
-    def __init__(self):
+    def __init__(self, zone_data=None, backend=None):
         """
         Initialize GPIO on RaspberryPi to interface with OpenSprinkler shift
         register.
+
+        zone_data is the zone data store object shared with the rest of the
+        daemon, it is loaded from the disk file when not given.
+
+        backend is the OSPiMGPIOBackend to use instead of the configured one.
         """
-        try:
-            GPIO.cleanup()
 
-            GPIO.setmode(GPIO.BCM)
+        if None == zone_data:
+            zone_data = OSPiMZones()
 
-            GPIO.setup(self._pin_clk, GPIO.OUT)
-            GPIO.setup(self._pin_noe, GPIO.OUT)
+        self._zone = zone_data
+        self.statistics = OSPiMGPIOStatistics()
 
-            self.shift_register_disable()
+        # Serializes the writes with close(), the calendar thread may still
+        # be writing while the daemon exits
+        self._write_lock = threading.RLock()
+        self._last_summary_time = get_clock().time()
 
-            GPIO.setup(self._pin_dat, GPIO.OUT)
-            GPIO.setup(self._pin_lat, GPIO.OUT)
+        # The configured backend is created again on reconnect, a given one
+        # is only initialized again
+        self._backend = backend
+        self._own_backend = None == backend
 
-            # Write the current status of zones to start with
-            self.shift_register_write()
+        self._connect()
 
-            self.shift_register_enable()
-        except Exception as e:
-            self.connected = False
-            logging.error('[__init__] Failed to communicate with \
-                OpenSprinkler: %s' % str(e))
+    def start_writer(self):
+        """
+        Start the writer thread, all the writes are done by it from then on
+        """
+
+        if None == self._writer:
+            self._writer = OSPiMGPIOWriter(self)
+            self._writer.start()
 
     def close(self, bits=None):
-        """ Write the latest zone status from data file and cleanup GPIO """
+        """
+        Write the latest zone status from data file (or the given bits) and
+        cleanup GPIO. Later writes are ignored, so that a thread still
+        running can't change the outputs after the final frame.
+        """
+
+        if None != self._writer:
+            self._writer.stop()
+            self._writer = None
+
+        with self._write_lock:
+            self._shift_register_write(bits, True)
+            self._closed = True
 
-        self.shift_register_write(bits)
-        GPIO.cleanup()
+            if None != self._backend:
+                self._backend.cleanup()
 
     def shift_register_enable(self):
         """ Set OpenSprinkler shift register status to Enable """
@@ -87,11 +379,9 @@ class OSPiMGPIO:
             return
 
         try:
-            GPIO.output(self._pin_noe, False)
+            self._backend.output(self._pin_noe, False)
         except Exception as e:
-            self.connected = False
-            logging.error('[sr_enable] Failed to communicate with \
-                OpenSprinkler: %s' % str(e))
+            self._connection_lost('sr_enable', e)
 
     def shift_register_disable(self):
         """ Set OpenSprinkler shift register status to Disable """
@@ -100,42 +390,228 @@ class OSPiMGPIO:
             return
 
         try:
-            GPIO.output(self._pin_noe, True)
+            self._backend.output(self._pin_noe, True)
         except Exception as e:
-            self.connected = False
-            logging.error('[sr_disable] Failed to communicate with \
-                OpenSprinkler: %s' % str(e))
+            self._connection_lost('sr_disable', e)
 
-    def shift_register_write(self, bits=None):
-        """ Send zone status bits to OpenSprinkler """
+    def relatch(self):
+        """
+        Write the current zone status again if the relatch_interval has passed
+        since the last write, to recover from any glitch on the hardware.
+        While the GPIO is unavailable this tries to reconnect.
+        """
 
-        if not self.connected:
-            return
+        since_latch = get_clock().time() - self._last_latch_time
+
+        if not self.connected or 0 < self.relatch_interval and \
+                since_latch >= self.relatch_interval:
+            self.shift_register_write(None, True)
+
+    def get_status(self):
+        """ Return the connection status and write statistics """
+
+        status = self.statistics.status()
+        status['connected'] = self.connected
+        status['unavailable_seconds'] = 0.0
+        status['unavailable_total'] = self._unavailable_time
+
+        if None != self._disconnected_since:
+            status['unavailable_seconds'] = \
+                get_clock().time() - self._disconnected_since
+            status['unavailable_total'] += status['unavailable_seconds']
+
+        return status
+
+    def log_summary(self):
+        """
+        Log the write statistics if the summary_interval has passed since the
+        last summary.
+        """
+
+        if 0 < self.summary_interval and get_clock().time() - \
+                self._last_summary_time >= self.summary_interval:
+            self._last_summary_time = get_clock().time()
+            logger.info('[gpio] ' + self.statistics.summary())
+
+    def shift_register_write(self, bits=None, force=False):
+        """
+        Request sending zone status bits to OpenSprinkler, and return
+        OSPiMLatchFuture to wait on the result if needed.
+
+        When the writer thread is running the request is queued to it,
+        otherwise the bits are written right away.
+        """
+
+        if None != self._writer and self._writer.is_alive():
+            return self._writer.submit(bits, force)
+
+        future = OSPiMLatchFuture()
+        future.set_result(self._shift_register_write(bits, force))
+
+        return future
+
+    def _shift_register_write(self, bits=None, force=False):
+        """
+        Send zone status bits to OpenSprinkler. Return True when the bits
+        are on the device.
+
+        bits is a list of zone status (first to last zone) or the zone status
+        packed in to an integer (bit n is zone n), the current zone status is
+        used when not given.
+
+        Nothing is sent when the bits are the same as the last write, unless
+        force is True, or after close().
+        """
+
+        with self._write_lock:
+            if self._closed:
+                return False
+
+            return self._write(bits, force)
+
+    def _write(self, bits, force):
+        """ Send the zone status bits, see _shift_register_write() """
+
+        # Initialize the GPIO again, this writes the current zone status
+        if not self.connected and not self._reconnect():
+            return False
 
         if None == bits:
-            bits = []
-            data = OSPiMZones()._data
+            frame = self._zone.get_bitmask()
+            count = self._zone._data['zone_count']
+        else:
+            frame, count = self._to_frame(bits)
 
-            for i in range(data['zone_count']):
-                bits.append(data['zone'][i]['status'])
+        if not force and (frame, count) == self._last_frame:
+            return True
 
-        logging.info('[sr_write] Writing: %s' % bits)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('[sr_write] Writing: %s' % ''.join(
+                str((frame >> i) & 1) for i in range(count)))
 
         try:
-            GPIO.output(self._pin_clk, False)
-            GPIO.output(self._pin_lat, False)
+            begin = time.time()
 
             # Send bits to OpenSprinkler via GPIO
             # Note: Order of the zones we have on the data structure is
             # big-endian (first to last), and for the serial communication it
-            # has to be little-endian (last to first). Hence the len - pos -1
-            for bit_pos in range(len(bits)):
-                GPIO.output(self._pin_clk, False)
-                GPIO.output(self._pin_dat, bits[len(bits) - bit_pos - 1])
-                GPIO.output(self._pin_clk, True)
+            # has to be little-endian (last to first). Backend sends the
+            # highest bit (last zone) first.
+            self._backend.write_frame(self._pin_clk, self._pin_dat,
+                                      self._pin_lat, frame, count)
+
+            self._last_frame = (frame, count)
+            self._last_latch_time = get_clock().time()
 
-            GPIO.output(self._pin_lat, True)
+            self.statistics.record_latch(time.time() - begin, count)
         except Exception as e:
-            self.connected = False
-            logging.error('[sr_write] Failed to communicate with \
-                OpenSprinkler: %s' % str(e))
+            self._connection_lost('sr_write', e)
+
+            return False
+
+        return True
+
+    def _connect(self):
+        """
+        Initialize the GPIO pins and write the current zone status to the
+        shift register. Return True on success.
+        """
+
+        self.connected = True
+
+        try:
+            if None == self._backend:
+                self._backend = create_backend(self._pin_clk, self._pin_noe,
+                                               self._pin_dat, self._pin_lat)
+
+            self._backend.initialize()
+
+            self._backend.setup(self._pin_clk)
+            self._backend.setup(self._pin_noe)
+
+            self.shift_register_disable()
+
+            self._backend.setup(self._pin_dat)
+            self._backend.setup(self._pin_lat)
+
+            # Write the current status of zones to start with
+            self._shift_register_write(None, True)
+
+            self.shift_register_enable()
+        except Exception as e:
+            self._connection_lost('connect', e)
+
+        return self.connected
+
+    def _reconnect(self):
+        """
+        Initialize the GPIO again when the backoff delay since the last
+        failure has passed. Return True when connected.
+        """
+
+        if self.connected:
+            return True
+
+        if get_clock().time() < self._next_reconnect:
+            return False
+
+        self.statistics.record_reconnect()
+
+        if self._own_backend and None != self._backend:
+            try:
+                self._backend.cleanup()
+            except Exception as e:
+                logger.error('[gpio:reconnect] ' + str(e))
+
+            self._backend = None
+
+        if not self._connect():
+            return False
+
+        downtime = get_clock().time() - self._disconnected_since
+        self._unavailable_time += downtime
+        self._disconnected_since = None
+
+        logger.warning('[gpio] Reconnected to OpenSprinkler after %.1f '
+                       'seconds' % downtime)
+
+        return True
+
+    def _connection_lost(self, operation, error):
+        """ Mark the GPIO unavailable and schedule the next reconnect """
+
+        was_connected = self.connected
+
+        self.connected = False
+        self.statistics.record_failure(error)
+
+        logger.error('[%s] Failed to communicate with OpenSprinkler: %s' %
+                     (operation, str(error)))
+
+        # Already scheduled by an earlier failure of the same attempt
+        if not was_connected:
+            return
+
+        now = get_clock().time()
+
+        if None == self._disconnected_since:
+            self._disconnected_since = now
+            self._reconnect_delay = self.reconnect_delay
+        else:
+            self._reconnect_delay = min(self._reconnect_delay * 2,
+                                        self.reconnect_max_delay)
+
+        self._next_reconnect = now + self._reconnect_delay
+
+    def _to_frame(self, bits):
+        """ Convert bits given to shift_register_write to (frame, count) """
+
+        if isinstance(bits, (int, long)):
+            return bits, self._zone._data['zone_count']
+
+        frame = 0
+        for zone_id, bit in enumerate(bits):
+            if bit:
+                frame |= 1 << zone_id
+
+        return frame, len(bits)
@@ -0,0 +1,369 @@
+# gpiobackend.py: GPIO backends that drive the OpenSprinkler shift register
+#
+# Copyright 2013 Sudaraka Wijesinghe <sudaraka.wijesinghe@gmail.com>
+#
+# This file is part of OpenSprinkler Pi Monitor (OSPi Monitor)
+#
+# OSPi Monitor is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# OSPi Monitor is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with OSPi Monitor.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+import collections
+import mmap
+import os
+import struct
+import sys
+import time
+
+from .config import get_config
+
+
+# =============================================================================
+# Make sure this script doesn't get executed directly
+if '__main__' == __name__:
+    sys.exit(1)
+
+
+# =============================================================================
+class OSPiMGPIOBackend(object):
+
+    """
+    Interface of the GPIO backends used by OSPiMGPIO. Pins are identified by
+    their BCM number.
+    """
+
+    def initialize(self):
+        """
+        Reset the GPIO to a known state before the pins are set up.
+        This method should be overridden in the sub-classes.
+        """
+        pass
+
+    def setup(self, pin):
+        """
+        Configure the given pin as an output.
+        This method must be overridden in the sub-classes.
+        """
+
+        raise NotImplementedError()
+
+    def output(self, pin, value):
+        """
+        Set the level of the given output pin.
+        This method must be overridden in the sub-classes.
+        """
+
+        raise NotImplementedError()
+
+    def write_frame(self, pin_clk, pin_dat, pin_lat, frame, count):
+        """
+        Clock the lowest count bits of the frame in to the shift register,
+        highest bit first, and latch them to the outputs.
+
+        Sub-classes may override this to send the whole frame in a faster way
+        than individual output() calls.
+        """
+
+        self.output(pin_clk, False)
+        self.output(pin_lat, False)
+
+        for bit_pos in range(count - 1, -1, -1):
+            self.output(pin_clk, False)
+            self.output(pin_dat, (frame >> bit_pos) & 1)
+            self.output(pin_clk, True)
+
+        self.output(pin_lat, True)
+
+    def cleanup(self):
+        """
+        Release the GPIO resources.
+        This method should be overridden in the sub-classes.
+        """
+        pass
+
+
+# =============================================================================
+class OSPiMRPiGPIOBackend(OSPiMGPIOBackend):
+
+    """ Drives the RaspberryPi GPIO pins with the RPi.GPIO module """
+
+    def __init__(self):
+        """ Load RPi.GPIO, only available on a RaspberryPi """
+
+        import RPi.GPIO
+
+        self._gpio = RPi.GPIO
+
+    def initialize(self):
+        """ Clear previous GPIO setup and use BCM pin numbers """
+
+        self._gpio.cleanup()
+        self._gpio.setmode(self._gpio.BCM)
+
+    def setup(self, pin):
+        """ Configure the given pin as an output """
+
+        self._gpio.setup(pin, self._gpio.OUT)
+
+    def output(self, pin, value):
+        """ Set the level of the given output pin """
+
+        self._gpio.output(pin, value)
+
+    def cleanup(self):
+        """ Release the GPIO pins """
+
+        self._gpio.cleanup()
+
+
+# =============================================================================
+class OSPiMMmapGPIOBackend(OSPiMGPIOBackend):
+
+    """
+    Drives the GPIO pins by writing directly to the BCM2835 style GPIO
+    registers through a memory map of /dev/gpiomem (or any file with the same
+    register layout).
+
+    Each pin change is a single 32 bit write to the set or clear register,
+    without going through RPi.GPIO.
+    """
+
+    # 32 bit little-endian register value
+    _register = struct.Struct('<I')
+
+    def __init__(self, device, size, fsel_offset, set_offset, clr_offset):
+        """ Map the GPIO register block of the given device """
+
+        self._fsel_offset = fsel_offset
+        self._set_offset = set_offset
+        self._clr_offset = clr_offset
+
+        fd = os.open(device, os.O_RDWR | os.O_SYNC)
+        try:
+            self._map = mmap.mmap(fd, size, mmap.MAP_SHARED,
+                                  mmap.PROT_READ | mmap.PROT_WRITE)
+        finally:
+            os.close(fd)
+
+    def setup(self, pin):
+        """ Set the function select bits of the pin to output (001) """
+
+        offset = self._fsel_offset + (pin // 10) * 4
+        shift = (pin % 10) * 3
+
+        value = self._register.unpack_from(self._map, offset)[0]
+        value = (value & ~(7 << shift)) | (1 << shift)
+
+        self._register.pack_into(self._map, offset, value & 0xffffffff)
+
+    def output(self, pin, value):
+        """ Write the pin bit to the set (high) or clear (low) register """
+
+        offset = (self._set_offset if value else self._clr_offset) + \
+            (pin // 32) * 4
+
+        self._register.pack_into(self._map, offset, 1 << (pin % 32))
+
+    def write_frame(self, pin_clk, pin_dat, pin_lat, frame, count):
+        """
+        Send the whole frame with precomputed register offsets and masks,
+        avoiding any per bit method calls.
+        """
+
+        pack_into = self._register.pack_into
+        registers = self._map
+
+        clk_set, clk_clr, clk_mask = self._pin_registers(pin_clk)
+        dat_set, dat_clr, dat_mask = self._pin_registers(pin_dat)
+        lat_set, lat_clr, lat_mask = self._pin_registers(pin_lat)
+
+        pack_into(registers, clk_clr, clk_mask)
+        pack_into(registers, lat_clr, lat_mask)
+
+        for bit_pos in range(count - 1, -1, -1):
+            pack_into(registers, clk_clr, clk_mask)
+            pack_into(registers, dat_set if (frame >> bit_pos) & 1
+                      else dat_clr, dat_mask)
+            pack_into(registers, clk_set, clk_mask)
+
+        pack_into(registers, lat_set, lat_mask)
+
+    def cleanup(self):
+        """ Unmap the registers """
+
+        if None != self._map:
+            self._map.close()
+            self._map = None
+
+    def _pin_registers(self, pin):
+        """ Return (set offset, clear offset, bit mask) of the pin """
+
+        bank = (pin // 32) * 4
+
+        return (self._set_offset + bank, self._clr_offset + bank,
+                1 << (pin % 32))
+
+
+# =============================================================================
+class OSPiMSimulatedShiftRegister(OSPiMGPIOBackend):
+
+    """
+    Simulates a chain of 74HC595 style shift registers connected to the
+    clock, output enable, data and latch pins, without any hardware.
+
+    On the rising edge of the clock the data pin level is shifted in to the
+    register, and on the rising edge of the latch the register is copied to
+    the outputs. Like the real part the register keeps its content after
+    the latch, bits shifted past the last output are dropped. Clocked bits,
+    the last latched outputs and the time spent in each operation are
+    recorded for inspection.
+    """
+
+    # Number of latched outputs kept in the latched history
+    history = 1000
+
+    def __init__(self, pin_clk, pin_noe, pin_dat, pin_lat, length=None):
+        """
+        Initialize an empty register connected to the given pins. Length is
+        the number of outputs of the chain, when None the chain is as long as
+        the longest frame clocked in between two latches.
+        """
+
+        self._pin_clk = pin_clk
+        self._pin_noe = pin_noe
+        self._pin_dat = pin_dat
+        self._pin_lat = pin_lat
+
+        # Current pin levels, pin => level
+        self.levels = {}
+
+        # Number of outputs of the chain, see __init__
+        self.length = length
+
+        # Shift register content, first element is the first output (Q0)
+        self.register = []
+
+        # Bits clocked in since the last latch, in clocked order
+        self.clocked_bits = []
+
+        # Output levels after each of the last latches, in latch order
+        self.latched = collections.deque(maxlen=self.history)
+
+        # Number of latches since the statistics were reset
+        self.latch_count = 0
+
+        # Operation name => [number of calls, total seconds]
+        self.timing = {}
+
+    @property
+    def outputs(self):
+        """ Output levels of the last latch, first output first """
+
+        if not self.latched:
+            return []
+
+        return self.latched[-1]
+
+    @property
+    def enabled(self):
+        """ Outputs are enabled while the output enable pin is low """
+
+        return not self.levels.get(self._pin_noe, True)
+
+    def initialize(self):
+        """ Reset the pin levels """
+
+        begin = time.time()
+
+        self.levels = {}
+
+        self._record('initialize', begin)
+
+    def setup(self, pin):
+        """ Configure the given pin as an output (low) """
+
+        begin = time.time()
+
+        self.levels[pin] = False
+
+        self._record('setup', begin)
+
+    def output(self, pin, value):
+        """ Set the pin level and simulate the register on rising edges """
+
+        begin = time.time()
+
+        value = bool(value)
+        rising = value and not self.levels.get(pin, False)
+        self.levels[pin] = value
+
+        if rising and pin == self._pin_clk:
+            bit = int(self.levels.get(self._pin_dat, False))
+            self.register.insert(0, bit)
+            self.clocked_bits.append(bit)
+
+            if None != self.length:
+                del self.register[self.length:]
+
+        elif rising and pin == self._pin_lat:
+            if None == self.length:
+                # Shifted out of the chain, never clocked in again
+                del self.register[max(len(self.clocked_bits),
+                                      len(self.outputs)):]
+
+            self.latched.append(list(self.register))
+            self.latch_count += 1
+            self.clocked_bits = []
+
+        self._record('output', begin)
+
+    def cleanup(self):
+        """ Reset the pin levels """
+
+        self.levels = {}
+
+    def reset_statistics(self):
+        """ Clear the recorded latches and timing """
+
+        self.latched.clear()
+        self.latch_count = 0
+        self.timing = {}
+
+    def _record(self, operation, begin):
+        """ Add the time since begin to the operation timing """
+
+        entry = self.timing.setdefault(operation, [0, 0.0])
+        entry[0] += 1
+        entry[1] += time.time() - begin
+
+
+# =============================================================================
+def create_backend(pin_clk, pin_noe, pin_dat, pin_lat):
+    """ Create the GPIO backend selected in configuration """
+
+    gpio_conf = get_config().gpio
+
+    if 'simulated' == gpio_conf.backend:
+        return OSPiMSimulatedShiftRegister(pin_clk, pin_noe, pin_dat, pin_lat)
+
+    if 'mmap' == gpio_conf.backend:
+        return OSPiMMmapGPIOBackend(
+            gpio_conf.mmap_device,
+            gpio_conf.mmap_size,
+            gpio_conf.mmap_fsel_offset,
+            gpio_conf.mmap_set_offset,
+            gpio_conf.mmap_clr_offset
+        )
+
+    return OSPiMRPiGPIOBackend()
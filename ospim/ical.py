@@ -0,0 +1,414 @@
+# ical.py: iCalendar (ICS) file or URL as the source of schedule events
+#
+# Copyright 2013 Sudaraka Wijesinghe <sudaraka.wijesinghe@gmail.com>
+#
+# This file is part of OpenSprinkler Pi Monitor (OSPi Monitor)
+#
+# OSPi Monitor is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# OSPi Monitor is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with OSPi Monitor.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from __future__ import absolute_import
+
+import bisect
+import datetime
+import hashlib
+import json
+import logging
+import os
+import re
+import sys
+import urllib2
+
+from .clock import get_clock
+from .config import OSPiMConfigOption
+from .recurrence import parse_ical_datetime
+from .source import OSPiMEventSource, parse_retry_after
+
+
+# =============================================================================
+# Make sure this script doesn't get executed directly
+if '__main__' == __name__:
+    sys.exit(1)
+
+
+# Log messages of this module, the level can be set per module
+logger = logging.getLogger(__name__)
+
+
+# Properties of a VEVENT that may appear more than once
+_MULTI_VALUE = ('RRULE', 'EXDATE', 'RDATE')
+
+# DURATION value pattern (i.e. PT1H30M, P1D)
+_DURATION = re.compile(
+    r'^([+-])?P(?:(\d+)W)?(?:(\d+)D)?(?:T(?:(\d+)H)?(?:(\d+)M)?(?:(\d+)S)?)?$')
+
+
+# =============================================================================
+class OSPiMICalendarSource(OSPiMEventSource):
+
+    """
+    Reads the schedule events from a local iCalendar (ICS) file or a plain
+    HTTP feed.
+
+    The data is parsed as a stream one event at a time, and it is only
+    re-parsed when the file modification time (or the HTTP ETag /
+    Last-Modified) changes.
+    """
+
+    # Path or http(s) URL of the ICS data
+    location = OSPiMConfigOption('calendar', 'ics_location')
+
+    def __init__(self, location=None):
+        """ Initialize the source with given or configured location """
+
+        super(OSPiMICalendarSource, self).__init__()
+
+        if None != location:
+            self.location = location
+
+        # Signature (mtime/size or ETag/Last-Modified) of the last parse
+        self._signature = None
+
+        # Compact list of the events from last parse, sorted by start time
+        self._events = []
+
+        # Start times of the events, to find the end of the horizon window
+        self._starts = []
+
+        # Earliest end of the last instance of the parsed events, the
+        # finished events are dropped once it passes
+        self._next_end = None
+
+        # Instance ids of the modified or cancelled recurring event instances
+        self._exceptions = set()
+
+    def is_ready(self, cache):
+        """ Source is usable when a location is configured """
+
+        return 0 < len(self.location)
+
+    def fetch_events(self, cache):
+        """
+        Read upcoming events from the ICS data and update the cache. Return
+        False when the data could not be read.
+        """
+
+        self.retry_after = None
+
+        try:
+            if self._is_url():
+                self._read_url()
+            else:
+                self._read_file()
+        except Exception as e:
+            logger.error('Failed to fetch or parse ICS data from %s: %s' %
+                         (self.location, str(e)))
+            return False
+
+        # Drop the events that are over, the ones left all start before
+        # the horizon window ends or are yet to come
+        if None != self._next_end and get_clock().now() > self._next_end:
+            self._set_events(self._events, False)
+
+        return_list = {}
+
+        # Events that start after the horizon window are kept parsed here,
+        # they are added as the window moves on
+        events = self._events[:bisect.bisect_left(
+            self._starts, self._horizon_window()[1])]
+
+        for event in events:
+            if event['cancelled']:
+                continue
+
+            if None != event['recurrence_id']:
+                self._add_event(
+                    return_list,
+                    self._instance_id(event['uid'], event['recurrence_id']),
+                    event['summary'], event['start'], event['end'])
+            elif event['recurrence']:
+                self._add_recurring_event(
+                    return_list, event['uid'], event['signature'],
+                    event['summary'], event['start'], event['end'],
+                    event['recurrence'], self._exceptions)
+            else:
+                self._add_event(return_list, event['uid'], event['summary'],
+                                event['start'], event['end'])
+
+        self._recurrence.retain([e['uid'] for e in events if e['recurrence']])
+
+        cache.update(return_list, True)
+
+        return True
+
+    def _is_url(self):
+        """ Check if the location is a HTTP URL rather than a file path """
+
+        return self.location.lower().startswith(('http://', 'https://'))
+
+    def _read_file(self):
+        """ Parse the local file if it was modified since the last read """
+
+        stat = os.stat(self.location)
+        signature = (stat.st_mtime, stat.st_size)
+
+        if signature == self._signature:
+            return
+
+        f = open(self.location, 'r')
+        try:
+            self._set_events(self._parse(f))
+        finally:
+            f.close()
+
+        self._signature = signature
+
+    def _read_url(self):
+        """ Download and parse the feed unless the server reports no change """
+
+        request = urllib2.Request(self.location)
+
+        if None != self._signature:
+            etag, last_modified = self._signature
+
+            if etag:
+                request.add_header('If-None-Match', etag)
+
+            if last_modified:
+                request.add_header('If-Modified-Since', last_modified)
+
+        try:
+            response = urllib2.urlopen(request,
+                                       timeout=self._http_timeout())
+        except urllib2.HTTPError as e:
+            if 304 == e.code:
+                return
+
+            self.retry_after = parse_retry_after(e.info().getheader(
+                'Retry-After'))
+
+            raise
+
+        try:
+            self._set_events(self._parse(response))
+        finally:
+            response.close()
+
+        self._signature = (response.info().getheader('ETag'),
+                           response.info().getheader('Last-Modified'))
+
+    def _parse(self, stream):
+        """
+        Build the compact event list from the line stream. Events that are
+        already over are dropped while parsing, except the modified instances
+        of the recurring events that _set_events() needs for the exceptions.
+        """
+
+        events = []
+        now = get_clock().now()
+
+        for properties in self._iter_events(stream):
+            try:
+                event = self._compact_event(properties)
+            except Exception as e:
+                logger.warning('[ical:parse] Ignoring bad event: %s' %
+                               str(e))
+                continue
+
+            if None == event:
+                continue
+
+            if None == event['recurrence_id'] and \
+                    None != event['last_end'] and now > event['last_end']:
+                continue
+
+            events.append(event)
+
+        return events
+
+    def _set_events(self, events, parsed=True):
+        """
+        Keep the parsed events that are not over, sorted by start time. When
+        parsed is False the events are the current ones less the finished,
+        and the exceptions are kept from the last parse.
+        """
+
+        now = get_clock().now()
+
+        # A modified instance replaces the original instance even after it
+        # is over (i.e. moved to an earlier day), so the exceptions are taken
+        # from all the parsed events before the finished ones are dropped
+        if parsed:
+            self._exceptions = set(
+                self._instance_id(event['uid'], event['recurrence_id'])
+                for event in events if None != event['recurrence_id'])
+
+        self._events = sorted(
+            [e for e in events if None == e['last_end'] or
+             now <= e['last_end']],
+            key=lambda event: event['start'])
+        self._starts = [event['start'] for event in self._events]
+
+        ends = [e['last_end'] for e in self._events
+                if None != e['last_end']]
+        self._next_end = min(ends) if ends else None
+
+    def _iter_events(self, stream):
+        """
+        Generate a dictionary of properties for each VEVENT in the stream.
+        Property values are (parameters, value) tuples.
+        """
+
+        properties = None
+
+        for line in self._unfold(stream):
+            name, parameters, value = self._split_line(line)
+
+            if 'BEGIN' == name and 'VEVENT' == value.upper():
+                properties = {}
+            elif 'END' == name and 'VEVENT' == value.upper():
+                if None != properties:
+                    yield properties
+                properties = None
+            elif None != properties:
+                if name in _MULTI_VALUE:
+                    properties.setdefault(name, []).append(
+                        (parameters, value))
+                else:
+                    properties[name] = (parameters, value)
+
+    def _unfold(self, stream):
+        """ Join the folded (continued) content lines of the stream """
+
+        buffered = None
+
+        for line in stream:
+            line = line.decode('utf-8', 'replace').rstrip('\r\n')
+
+            if line[:1] in (' ', '\t'):
+                if None != buffered:
+                    buffered += line[1:]
+                continue
+
+            if buffered:
+                yield buffered
+
+            buffered = line
+
+        if buffered:
+            yield buffered
+
+    def _split_line(self, line):
+        """ Split a content line in to name, parameter dictionary and value """
+
+        head, value = line.split(':', 1) if ':' in line else (line, '')
+        parts = head.split(';')
+
+        parameters = {}
+        for part in parts[1:]:
+            if '=' in part:
+                key, param = part.split('=', 1)
+                parameters[key.upper()] = param.strip('"')
+
+        return parts[0].upper(), parameters, value
+
+    def _compact_event(self, properties):
+        """ Convert VEVENT properties to the compact event dictionary """
+
+        if 'UID' not in properties or 'DTSTART' not in properties:
+            return None
+
+        start = self._to_datetime(*properties['DTSTART'])
+
+        if 'DTEND' in properties:
+            end = self._to_datetime(*properties['DTEND'])
+        elif 'DURATION' in properties:
+            end = start + self._to_timedelta(properties['DURATION'][1])
+        elif 'DATE' == properties['DTSTART'][0].get('VALUE'):
+            end = start + datetime.timedelta(days=1)
+        else:
+            end = start
+
+        recurrence_id = None
+        if 'RECURRENCE-ID' in properties:
+            recurrence_id = self._to_datetime(*properties['RECURRENCE-ID'])
+
+        recurrence = []
+        for name in _MULTI_VALUE:
+            for parameters, value in properties.get(name, []):
+                head = ';'.join([name] + ['%s=%s' % p
+                                          for p in parameters.items()])
+                recurrence.append('%s:%s' % (head, value))
+
+        last_end = end
+        if recurrence and None == recurrence_id:
+            last_end = self._recurrence.last_end(start, end, recurrence)
+
+        signature = None
+        if recurrence:
+            signature = hashlib.md5(json.dumps([
+                properties.get('SEQUENCE', (None, ''))[1],
+                properties.get('LAST-MODIFIED', (None, ''))[1],
+                str(start),
+                str(end),
+                recurrence
+            ])).hexdigest()
+
+        return {
+            'uid': properties['UID'][1],
+            'summary': self._unescape(properties.get('SUMMARY',
+                                                     (None, ''))[1]),
+            'start': start,
+            'end': end,
+            'recurrence_id': recurrence_id,
+            'recurrence': recurrence,
+            'signature': signature,
+            'last_end': last_end,
+            'cancelled': 'CANCELLED' == properties.get(
+                'STATUS', (None, ''))[1].upper()
+        }
+
+    def _to_datetime(self, parameters, value):
+        """
+        Convert DATE/DATE-TIME value to local Python datetime object. UTC
+        values are converted to local time, values with TZID are taken as
+        local wall clock time (see parse_ical_datetime()).
+        """
+
+        return parse_ical_datetime(value)
+
+    def _to_timedelta(self, value):
+        """ Convert DURATION value to Python timedelta object """
+
+        match = _DURATION.match(value.strip().upper())
+        if None == match:
+            raise ValueError('Invalid duration: %s' % value)
+
+        weeks, days, hours, minutes, seconds = \
+            [int(v or 0) for v in match.groups()[1:]]
+
+        duration = datetime.timedelta(weeks=weeks, days=days, hours=hours,
+                                      minutes=minutes, seconds=seconds)
+
+        if '-' == match.group(1):
+            duration = -duration
+
+        return duration
+
+    def _unescape(self, text):
+        """ Remove the escaping of TEXT property values """
+
+        return re.sub(r'\\([\\;,nN])',
+                      lambda m: '\n' if m.group(1) in 'nN' else m.group(1),
+                      text)
@@ -0,0 +1,137 @@
+# isotime.py: Fast ISO-8601 time stamp parsing for calendar events
+#
+# Copyright 2013 Sudaraka Wijesinghe <sudaraka.wijesinghe@gmail.com>
+#
+# This file is part of OpenSprinkler Pi Monitor (OSPi Monitor)
+#
+# OSPi Monitor is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# OSPi Monitor is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with OSPi Monitor.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from __future__ import absolute_import
+
+import calendar
+import datetime
+import re
+import sys
+import time
+
+
+# =============================================================================
+# Make sure this script doesn't get executed directly
+if '__main__' == __name__:
+    sys.exit(1)
+
+
+# YYYY-MM-DD[THH:MM[:SS[.fff]][Z|+HH:MM|-HHMM]]
+_ISO_PATTERN = re.compile(
+    r'^(\d{4})-(\d{2})-(\d{2})'
+    r'(?:[T ](\d{2}):(\d{2})(?::(\d{2})(?:[.,](\d+))?)?'
+    r'(Z|[+-]\d{2}(?::?\d{2})?)?)?$'
+)
+
+# Number of time stamps memoized in one generation of the cache, raised by
+# reserve_cache() to fit the feed
+_cache_size = 10000
+
+# Memoized results, time stamp string => epoch. When the current generation
+# is full it becomes the previous one, the stamps still in use are moved
+# back to the current generation as they are looked up and the rest are
+# dropped with the previous generation.
+_cache = {}
+_previous = {}
+
+
+def reserve_cache(count):
+    """
+    Make the cache hold at least the given number of time stamps, so that
+    all the stamps of a feed that size are found on the following fetches
+    """
+
+    global _cache_size
+
+    _cache_size = max(_cache_size, count)
+
+
+def clear_cache():
+    """ Forget all the memoized time stamps """
+
+    global _previous
+
+    _cache.clear()
+    _previous = {}
+
+
+def iso_to_epoch(value):
+    """
+    Convert ISO-8601 date or date-time string to seconds since the epoch
+    (UTC).
+
+    Date-times with Z or an UTC offset are converted exactly. Date-times
+    without an offset and date only values (all-day events) are taken as
+    local time.
+    """
+
+    try:
+        return _cache[value]
+    except KeyError:
+        pass
+
+    if value in _previous:
+        return _store(value, _previous[value])
+
+    match = _ISO_PATTERN.match(value.strip())
+    if None == match:
+        raise ValueError('Invalid ISO-8601 time stamp: %s' % value)
+
+    year, month, day, hour, minute, second, fraction, offset = \
+        match.groups()
+
+    fields = (int(year), int(month), int(day),
+              int(hour or 0), int(minute or 0), int(second or 0))
+
+    if None == offset:
+        epoch = time.mktime(fields + (0, 0, -1))
+    else:
+        epoch = calendar.timegm(fields)
+
+        if 'Z' != offset:
+            sign = -1 if '-' == offset[0] else 1
+            digits = offset[1:].replace(':', '')
+            epoch -= sign * (int(digits[:2]) * 3600 +
+                             int(digits[2:] or 0) * 60)
+
+    if fraction:
+        epoch += float('0.' + fraction)
+
+    return _store(value, epoch)
+
+
+def _store(value, epoch):
+    """ Memoize the epoch of the time stamp, start a new generation if full """
+
+    global _cache, _previous
+
+    if len(_cache) >= _cache_size:
+        _previous = _cache
+        _cache = {}
+
+    _cache[value] = epoch
+
+    return epoch
+
+
+def epoch_to_local(epoch):
+    """ Convert seconds since the epoch to local Python datetime object """
+
+    return datetime.datetime.fromtimestamp(epoch)
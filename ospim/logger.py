@@ -0,0 +1,338 @@
+# logger.py: Non-blocking log output with a background writer thread
+#
+# Copyright 2013 Sudaraka Wijesinghe <sudaraka.wijesinghe@gmail.com>
+#
+# This file is part of OpenSprinkler Pi Monitor (OSPi Monitor)
+#
+# OSPi Monitor is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# OSPi Monitor is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with OSPi Monitor.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+import datetime
+import json
+import logging
+import os
+import Queue
+import sys
+import threading
+import time
+
+
+# =============================================================================
+# Make sure this script doesn't get executed directly
+if '__main__' == __name__:
+    sys.exit(1)
+
+
+# Format of the plain text log lines
+TEXT_FORMAT = '%(asctime)s [%(levelname)s] %(message)s'
+TEXT_DATE_FORMAT = '%Y-%m-%d %I:%M:%S %p'
+
+
+# =============================================================================
+class OSPiMJSONFormatter(logging.Formatter):
+
+    """ Formats the log records as JSON objects, one per line """
+
+    def format(self, record):
+        """ Return the record as a JSON string """
+
+        entry = {
+            'time': datetime.datetime.fromtimestamp(
+                record.created).isoformat(),
+            'level': record.levelname,
+            'logger': record.name,
+            'thread': record.threadName,
+            'message': record.getMessage()
+        }
+
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+
+        return json.dumps(entry, sort_keys=True)
+
+
+# =============================================================================
+class OSPiMRateLimitFilter(logging.Filter):
+
+    """
+    Drops the warnings and errors that repeat the same message within the
+    interval (seconds). The next record of the message after the interval
+    tells how many were dropped.
+    """
+
+    # Number of distinct messages tracked before the old ones are dropped
+    max_messages = 1000
+
+    def __init__(self, interval):
+        """ Initialize the filter for the given interval """
+
+        logging.Filter.__init__(self)
+
+        self.interval = interval
+
+        self._lock = threading.Lock()
+
+        # (logger, level, message) => [time passed, number dropped since]
+        self._messages = {}
+
+    def filter(self, record):
+        """ Return False if the record must be dropped """
+
+        if 0 >= self.interval or logging.WARNING > record.levelno:
+            return True
+
+        message = record.getMessage()
+        key = (record.name, record.levelno, message)
+        now = time.time()
+
+        with self._lock:
+            entry = self._messages.get(key)
+
+            if None != entry and now - entry[0] < self.interval:
+                entry[1] += 1
+                return False
+
+            if len(self._messages) >= self.max_messages:
+                self._forget(now)
+
+            self._messages[key] = [now, 0]
+
+        if None != entry and 0 < entry[1]:
+            record.msg = '%s (repeated %d more times)' % (message, entry[1])
+            record.args = None
+
+        return True
+
+    def _forget(self, now):
+        """ Remove the messages that are not held back any more """
+
+        for key, entry in self._messages.items():
+            if now - entry[0] >= self.interval:
+                del self._messages[key]
+
+
+# =============================================================================
+class OSPiMLogWriter(threading.Thread):
+
+    """ Takes the records from the queue and passes them to the handlers """
+
+    def __init__(self, queue_handler):
+        """ Initialize the writer of the given OSPiMQueueHandler """
+
+        super(OSPiMLogWriter, self).__init__(name='ospim-log-writer')
+
+        self.daemon = True
+
+        self._queue_handler = queue_handler
+        self._queue = queue_handler.queue
+
+    def run(self):
+        """ Write records until None is queued """
+
+        reported = 0
+
+        while True:
+            record = self._queue.get()
+
+            if None == record:
+                return
+
+            self._queue_handler.handle_queued(record)
+
+            # Tell about the records lost while the queue was full
+            dropped = self._queue_handler.dropped
+            if dropped != reported:
+                self._queue_handler.handle_queued(logging.makeLogRecord({
+                    'name': __name__,
+                    'levelno': logging.WARNING,
+                    'levelname': 'WARNING',
+                    'msg': '%d log records dropped, log queue full' % (
+                        dropped - reported)
+                }))
+
+                reported = dropped
+
+
+# =============================================================================
+class OSPiMQueueHandler(logging.Handler):
+
+    """
+    Puts the log records in to a queue and returns right away, a background
+    OSPiMLogWriter passes them to the actual handlers (i.e. the log file).
+    When the queue is full the records are dropped and counted, logging
+    never blocks the caller.
+
+    The writer thread is started on the first record of each process, so
+    the handler keeps working after the daemon forks.
+    """
+
+    def __init__(self, handlers, queue_size=10000):
+        """ Initialize with the handlers that write the records """
+
+        logging.Handler.__init__(self)
+
+        self.handlers = handlers
+        self.queue_size = queue_size
+        self.queue = None
+        self.dropped = 0
+
+        self._pid = None
+        self._writer = None
+        self._start_lock = threading.Lock()
+
+    def emit(self, record):
+        """ Queue the record for the writer thread """
+
+        try:
+            self._start_writer()
+            self.queue.put_nowait(self._prepare(record))
+        except Queue.Full:
+            self.dropped += 1
+        except Exception:
+            self.handleError(record)
+
+    def handle_queued(self, record):
+        """ Pass a record to the handlers, called by the writer thread """
+
+        for handler in self.handlers:
+            if record.levelno >= handler.level:
+                handler.handle(record)
+
+    def close(self):
+        """ Write the queued records and close the handlers """
+
+        with self._start_lock:
+            if None != self._writer and os.getpid() == self._pid:
+                self.queue.put(None)
+                self._writer.join(5)
+
+            self._writer = None
+            self._pid = None
+
+        for handler in self.handlers:
+            handler.close()
+
+        logging.Handler.close(self)
+
+    def _start_writer(self):
+        """ Start the writer thread if this process doesn't have one yet """
+
+        if os.getpid() == self._pid:
+            return
+
+        with self._start_lock:
+            if os.getpid() == self._pid:
+                return
+
+            # The queue and handler locks inherited over fork may be held by
+            # a thread that doesn't exist in this process
+            for handler in self.handlers:
+                handler.createLock()
+
+            self.queue = Queue.Queue(self.queue_size)
+            self._writer = OSPiMLogWriter(self)
+            self._writer.start()
+            self._pid = os.getpid()
+
+    def _prepare(self, record):
+        """
+        Merge the arguments in to the message and format the exception in
+        the calling thread, they may change before the record is written
+        """
+
+        record.msg = record.getMessage()
+        record.args = None
+
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(
+                record.exc_info)
+            record.exc_info = None
+
+        return record
+
+
+# =============================================================================
+def parse_levels(levels):
+    """
+    Parse the per-subsystem log levels, "calendar=debug, gpio=warning", in
+    to a dictionary of logger name => level
+    """
+
+    result = {}
+
+    for item in levels.split(','):
+        if '=' not in item:
+            continue
+
+        name, level = [part.strip() for part in item.split('=', 1)]
+        result['ospim.' + name] = logging.getLevelName(level.upper())
+
+    return result
+
+
+def apply_levels(config):
+    """ Set the log level of the root logger and the subsystem loggers """
+
+    logging.getLogger().setLevel(
+        logging.getLevelName(config.daemon.log_level.upper()))
+
+    # Subsystems that are no longer listed follow the root logger again
+    for name, item in logging.Logger.manager.loggerDict.items():
+        if name.startswith('ospim.') and isinstance(item, logging.Logger):
+            item.setLevel(logging.NOTSET)
+
+    for name, level in parse_levels(config.daemon.log_levels).items():
+        if isinstance(level, int):
+            logging.getLogger(name).setLevel(level)
+
+
+def setup_logging(config):
+    """
+    Send the log records to the log file through a queue, in the
+    configured format (text or JSON lines), levels and repeated error rate
+    limit. Raises IOError when the log file can't be opened.
+    """
+
+    file_handler = logging.FileHandler(config.daemon.log_file)
+
+    if 'json' == config.daemon.log_format:
+        file_handler.setFormatter(OSPiMJSONFormatter())
+    else:
+        file_handler.setFormatter(logging.Formatter(TEXT_FORMAT,
+                                                    TEXT_DATE_FORMAT))
+
+    queue_handler = OSPiMQueueHandler([file_handler],
+                                      config.daemon.log_queue_size)
+    queue_handler.addFilter(OSPiMRateLimitFilter(config.daemon.log_rate_limit))
+
+    logging.getLogger().addHandler(queue_handler)
+
+    apply_levels(config)
+
+    return queue_handler
+
+
+def reload_logging(config):
+    """ Apply the log levels and the rate limit of a reloaded configuration """
+
+    apply_levels(config)
+
+    for handler in logging.getLogger().handlers:
+        for item in handler.filters:
+            if isinstance(item, OSPiMRateLimitFilter):
+                item.interval = config.daemon.log_rate_limit
@@ -0,0 +1,301 @@
+# profiler.py: CPU and memory profiling of the running daemon
+#
+# Copyright 2013 Sudaraka Wijesinghe <sudaraka.wijesinghe@gmail.com>
+#
+# This file is part of OpenSprinkler Pi Monitor (OSPi Monitor)
+#
+# OSPi Monitor is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# OSPi Monitor is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with OSPi Monitor.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+import gc
+import logging
+import os
+import sys
+import threading
+import time
+
+from .config import OSPiMConfigOption
+
+
+# =============================================================================
+# Make sure this script doesn't get executed directly
+if '__main__' == __name__:
+    sys.exit(1)
+
+
+# Log messages of this module, the level can be set per module
+logger = logging.getLogger(__name__)
+
+
+# =============================================================================
+class OSPiMSamplingProfiler(threading.Thread):
+
+    """
+    Samples the stack of every thread at a fixed interval, so the HTTP,
+    calendar and GPIO writer threads are all covered without restarting
+    them under a profiler.
+    """
+
+    def __init__(self, interval):
+        """ Initialize the profiler to sample every interval seconds """
+
+        super(OSPiMSamplingProfiler, self).__init__(name='ospim-profiler')
+
+        self.daemon = True
+
+        self._interval = interval
+        self._stop_event = threading.Event()
+
+        # Folded stack => number of samples
+        self.stacks = {}
+        self.samples = 0
+        self.started = None
+
+    def stop(self):
+        """ Stop sampling and wait for the thread to end """
+
+        self._stop_event.set()
+        self.join()
+
+    def run(self):
+        """ Take the samples until stopped """
+
+        self.started = time.time()
+        own_id = threading.current_thread().ident
+
+        while not self._stop_event.is_set():
+            names = dict((t.ident, t.name) for t in threading.enumerate())
+
+            for thread_id, frame in sys._current_frames().items():
+                if own_id == thread_id:
+                    continue
+
+                stack = []
+                while None != frame:
+                    code = frame.f_code
+                    stack.append('%s:%s:%d' % (
+                        os.path.basename(code.co_filename), code.co_name,
+                        frame.f_lineno))
+                    frame = frame.f_back
+
+                stack.append(names.get(thread_id, str(thread_id)))
+                stack.reverse()
+
+                key = ';'.join(stack)
+                self.stacks[key] = self.stacks.get(key, 0) + 1
+
+            self.samples += 1
+            time.sleep(self._interval)
+
+    def write(self, path):
+        """
+        Write the samples in the folded stack format (one "frame;frame;...
+        count" line per stack), read by flamegraph.pl and speedscope.
+        """
+
+        f = open(path, 'w')
+
+        for stack, count in sorted(self.stacks.items()):
+            f.write('%s %d\n' % (stack.replace(' ', '_'), count))
+
+        f.close()
+
+
+# =============================================================================
+class OSPiMProfiler(object):
+
+    """
+    Starts and stops the CPU profile and takes the memory snapshots of the
+    running daemon on request, and writes the results in to the configured
+    directory.
+
+    Memory snapshots use tracemalloc when it is available, otherwise the
+    number of live objects of each type are compared.
+    """
+
+    # Directory for the profile results, profiling is disabled when empty
+    profile_dir = OSPiMConfigOption('daemon', 'profile_dir')
+
+    # Number of seconds between the CPU profile samples
+    profile_interval = OSPiMConfigOption('daemon', 'profile_interval')
+
+    def __init__(self):
+        """ Initialize with no profile running """
+
+        self._lock = threading.Lock()
+        self._cpu = None
+
+        # Last memory snapshot, to compare the next one with
+        self._snapshot = None
+
+    def is_enabled(self):
+        """ Return True when the profile directory is configured """
+
+        return 0 < len(self.profile_dir)
+
+    def status(self):
+        """ Return the state of the profilers as a dictionary """
+
+        return {
+            'enabled': self.is_enabled(),
+            'cpu_running': None != self._cpu,
+            'memory_baseline': None != self._snapshot,
+            'tracemalloc': None != self._tracemalloc()
+        }
+
+    def toggle_cpu(self):
+        """
+        Start the CPU profile, or stop it if it is running. Return (path,
+        error) like stop_cpu(), path is None when the profile was started.
+        """
+
+        if None == self._cpu:
+            return None, self.start_cpu()
+
+        return self.stop_cpu()
+
+    def start_cpu(self):
+        """ Start the CPU profile, return None or an error message """
+
+        if not self.is_enabled():
+            return 'Profiling is not enabled'
+
+        with self._lock:
+            if None != self._cpu:
+                return 'CPU profile is already running'
+
+            self._cpu = OSPiMSamplingProfiler(self.profile_interval)
+            self._cpu.start()
+
+        logger.info('[profiler] CPU profile started')
+
+    def stop_cpu(self):
+        """
+        Stop the CPU profile and write it to the profile directory. Return
+        (file path, None), or (None, error message).
+        """
+
+        with self._lock:
+            cpu = self._cpu
+            self._cpu = None
+
+        if None == cpu:
+            return None, 'CPU profile is not running'
+
+        cpu.stop()
+
+        path = self._path('cpu', 'folded')
+        cpu.write(path)
+
+        logger.info('[profiler] CPU profile of %d samples in %.1f seconds '
+                    'written to %s' % (cpu.samples,
+                                       time.time() - cpu.started, path))
+
+        return path, None
+
+    def memory_snapshot(self):
+        """
+        Take a memory snapshot and write the difference to the previous one
+        (or the top allocations of the first one) to the profile directory.
+        Return (file path, None), or (None, error message).
+        """
+
+        if not self.is_enabled():
+            return None, 'Profiling is not enabled'
+
+        tracemalloc = self._tracemalloc()
+        path = self._path('memory', 'txt')
+
+        with self._lock:
+            if None != tracemalloc:
+                lines = self._tracemalloc_snapshot(tracemalloc, path)
+            else:
+                lines = self._object_snapshot()
+
+        f = open(path, 'w')
+        f.write('\n'.join(lines) + '\n')
+        f.close()
+
+        logger.info('[profiler] Memory snapshot written to ' + path)
+
+        return path, None
+
+    def _tracemalloc_snapshot(self, tracemalloc, path):
+        """
+        Take a tracemalloc snapshot, dump it next to the path (readable with
+        tracemalloc.Snapshot.load) and return the report lines
+        """
+
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(10)
+
+        snapshot = tracemalloc.take_snapshot()
+        snapshot.dump(os.path.splitext(path)[0] + '.tracemalloc')
+
+        if None == self._snapshot:
+            stats = snapshot.statistics('lineno')
+        else:
+            stats = snapshot.compare_to(self._snapshot, 'lineno')
+
+        self._snapshot = snapshot
+
+        return [str(s) for s in stats[:100]]
+
+    def _object_snapshot(self):
+        """
+        Count the live objects by type and return the report lines, with the
+        growth since the previous count
+        """
+
+        gc.collect()
+
+        counts = {}
+        for obj in gc.get_objects():
+            name = type(obj).__name__
+            counts[name] = counts.get(name, 0) + 1
+
+        previous = self._snapshot or {}
+        self._snapshot = counts
+
+        rows = sorted(((counts[name] - previous.get(name, 0), counts[name],
+                        name) for name in counts), reverse=True)
+
+        lines = ['%10s %10s  %s' % ('growth', 'count', 'type')]
+        for growth, count, name in rows[:100]:
+            lines.append('%+10d %10d  %s' % (growth, count, name))
+
+        return lines
+
+    def _tracemalloc(self):
+        """ Return the tracemalloc module, None when not available """
+
+        try:
+            import tracemalloc
+        except ImportError:
+            return None
+
+        return tracemalloc
+
+    def _path(self, kind, extension):
+        """ Return the path of a new result file in the profile directory """
+
+        if not os.path.isdir(self.profile_dir):
+            os.makedirs(self.profile_dir, 0o755)
+
+        now = time.time()
+
+        return os.path.join(self.profile_dir, '%s-%s-%03d.%s' % (
+            kind, time.strftime('%Y%m%d-%H%M%S', time.localtime(now)),
+            int(now * 1000) % 1000, extension))
@@ -0,0 +1,429 @@
+# recurrence.py: Local expansion of recurring calendar events
+#
+# Copyright 2013 Sudaraka Wijesinghe <sudaraka.wijesinghe@gmail.com>
+#
+# This file is part of OpenSprinkler Pi Monitor (OSPi Monitor)
+#
+# OSPi Monitor is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# OSPi Monitor is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with OSPi Monitor.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from __future__ import absolute_import
+
+import calendar
+import datetime
+import logging
+import sys
+
+
+# =============================================================================
+# Make sure this script doesn't get executed directly
+if '__main__' == __name__:
+    sys.exit(1)
+
+
+# Log messages of this module, the level can be set per module
+logger = logging.getLogger(__name__)
+
+
+# iCalendar week day names mapped to Python weekday() numbers
+_WEEKDAYS = {'MO': 0, 'TU': 1, 'WE': 2, 'TH': 3, 'FR': 4, 'SA': 5, 'SU': 6}
+
+# Upper limit of consecutive recurrence periods without any occurrence before
+# giving up on a rule (i.e. BYMONTHDAY=31;BYMONTH=2)
+_MAX_EMPTY_PERIODS = 1000
+
+
+def parse_ical_datetime(value, wall_offset=None):
+    """
+    Convert iCalendar DATE or DATE-TIME value (20130601 or 20130601T060000Z)
+    to local Python datetime object, with the same rules as the event start
+    time: UTC values (Z) are converted to local time, the other date-times
+    (TZID or floating) are calendar wall clock time moved by wall_offset
+    (timedelta of local time less the calendar time, none by default).
+    Dates are returned as they are.
+    """
+
+    value = value.strip()
+
+    if 8 == len(value):
+        return datetime.datetime.strptime(value, '%Y%m%d')
+
+    date = datetime.datetime.strptime(value[:15], '%Y%m%dT%H%M%S')
+
+    if value.endswith('Z'):
+        return datetime.datetime.fromtimestamp(
+            calendar.timegm(date.timetuple()))
+
+    if None != wall_offset:
+        date += wall_offset
+
+    return date
+
+
+# =============================================================================
+class OSPiMRecurrenceRule(object):
+
+    """
+    Parsed form of a single RRULE (RFC 5545) that is able to generate the
+    occurrences lazily.
+
+    Supports FREQ (DAILY, WEEKLY, MONTHLY, YEARLY), INTERVAL, COUNT, UNTIL,
+    BYDAY, BYMONTHDAY and BYMONTH, which covers the rules generated by Google
+    Calendar user interface.
+    """
+
+    def __init__(self, rule_string, wall_offset=None):
+        """
+        Parse the rule string (with or without RRULE: prefix), see
+        parse_ical_datetime() for wall_offset
+        """
+
+        if rule_string.upper().startswith('RRULE:'):
+            rule_string = rule_string[6:]
+
+        parts = {}
+        for part in rule_string.strip().split(';'):
+            if '=' in part:
+                key, value = part.split('=', 1)
+                parts[key.upper()] = value.upper()
+
+        self.freq = parts.get('FREQ')
+        if self.freq not in ('DAILY', 'WEEKLY', 'MONTHLY', 'YEARLY'):
+            raise ValueError('Unsupported recurrence frequency: %s' %
+                             self.freq)
+
+        self.interval = max(1, int(parts.get('INTERVAL', 1)))
+
+        self.count = None
+        if 'COUNT' in parts:
+            self.count = int(parts['COUNT'])
+
+        self.until = None
+        if 'UNTIL' in parts:
+            self.until = parse_ical_datetime(parts['UNTIL'], wall_offset)
+
+            # Date only UNTIL includes the whole day
+            if 8 == len(parts['UNTIL']):
+                self.until += datetime.timedelta(days=1, microseconds=-1)
+
+        # List of (ordinal, weekday) tuples, ordinal is 0 when not given
+        self.by_day = []
+        if 'BYDAY' in parts:
+            for day in parts['BYDAY'].split(','):
+                ordinal = day[:-2]
+                self.by_day.append(
+                    (int(ordinal) if ordinal else 0, _WEEKDAYS[day[-2:]]))
+
+        self.by_month_day = []
+        if 'BYMONTHDAY' in parts:
+            self.by_month_day = [int(d) for d in
+                                 parts['BYMONTHDAY'].split(',')]
+
+        self.by_month = []
+        if 'BYMONTH' in parts:
+            self.by_month = [int(m) for m in parts['BYMONTH'].split(',')]
+
+    def iterate(self, dtstart, after=None):
+        """
+        Generate occurrence start times in ascending order, beginning with
+        dtstart.
+
+        When after is given and the rule is not bound by COUNT, periods that
+        end before it are skipped without being evaluated.
+        """
+
+        period = 0
+        if None != after and None == self.count and after > dtstart:
+            period = max(0, self._periods_between(dtstart, after) - 1)
+
+        emitted = 0
+        empty_periods = 0
+
+        while empty_periods < _MAX_EMPTY_PERIODS:
+            candidates = self._period_candidates(dtstart, period)
+            period += 1
+
+            if not candidates:
+                empty_periods += 1
+                continue
+
+            empty_periods = 0
+
+            for occurrence in candidates:
+                if occurrence < dtstart:
+                    continue
+
+                if None != self.until and occurrence > self.until:
+                    return
+
+                if None != self.count and emitted >= self.count:
+                    return
+
+                emitted += 1
+                yield occurrence
+
+    def _periods_between(self, dtstart, moment):
+        """ Number of whole rule periods from dtstart to the given moment """
+
+        if 'DAILY' == self.freq:
+            return (moment - dtstart).days // self.interval
+
+        if 'WEEKLY' == self.freq:
+            return (moment - dtstart).days // (7 * self.interval)
+
+        months = (moment.year - dtstart.year) * 12 + \
+            moment.month - dtstart.month
+
+        if 'MONTHLY' == self.freq:
+            return months // self.interval
+
+        return (months // 12) // self.interval
+
+    def _period_candidates(self, dtstart, period):
+        """ Return the sorted occurrences that belong to the given period """
+
+        time_of_day = datetime.timedelta(
+            hours=dtstart.hour, minutes=dtstart.minute,
+            seconds=dtstart.second)
+        start_date = datetime.datetime(dtstart.year, dtstart.month,
+                                       dtstart.day)
+
+        days = []
+
+        if 'DAILY' == self.freq:
+            day = start_date + datetime.timedelta(days=period * self.interval)
+            if self._match_filters(day):
+                days.append(day)
+
+        elif 'WEEKLY' == self.freq:
+            week_begin = start_date - \
+                datetime.timedelta(days=start_date.weekday()) + \
+                datetime.timedelta(weeks=period * self.interval)
+
+            weekdays = [wd for ordinal, wd in self.by_day] or \
+                [start_date.weekday()]
+
+            for wd in sorted(set(weekdays)):
+                day = week_begin + datetime.timedelta(days=wd)
+                if not self.by_month or day.month in self.by_month:
+                    days.append(day)
+
+        elif 'MONTHLY' == self.freq:
+            months = dtstart.month - 1 + period * self.interval
+            days = self._month_days(dtstart.year + months // 12,
+                                    months % 12 + 1, start_date.day)
+
+        else:
+            year = dtstart.year + period * self.interval
+            for month in (self.by_month or [dtstart.month]):
+                days.extend(self._month_days(year, month, start_date.day))
+
+        return [day + time_of_day for day in sorted(days)]
+
+    def _match_filters(self, day):
+        """ Check a DAILY candidate against BYDAY/BYMONTH/BYMONTHDAY """
+
+        if self.by_month and day.month not in self.by_month:
+            return False
+
+        if self.by_day and \
+                day.weekday() not in [wd for ordinal, wd in self.by_day]:
+            return False
+
+        if self.by_month_day:
+            month_length = calendar.monthrange(day.year, day.month)[1]
+            if day.day not in [d if 0 < d else month_length + d + 1
+                               for d in self.by_month_day]:
+                return False
+
+        return True
+
+    def _month_days(self, year, month, default_day):
+        """ Return the days of the given month selected by the rule """
+
+        if self.by_month and month not in self.by_month:
+            return []
+
+        month_length = calendar.monthrange(year, month)[1]
+        days = set()
+
+        if self.by_month_day:
+            for d in self.by_month_day:
+                if 0 > d:
+                    d = month_length + d + 1
+
+                if 1 <= d <= month_length:
+                    days.add(d)
+
+        elif self.by_day:
+            for ordinal, wd in self.by_day:
+                matches = [d for d in range(1, month_length + 1)
+                           if calendar.weekday(year, month, d) == wd]
+
+                if 0 == ordinal:
+                    days.update(matches)
+                elif len(matches) >= abs(ordinal):
+                    days.add(matches[ordinal - 1 if 0 < ordinal else ordinal])
+
+        elif default_day <= month_length:
+            days.add(default_day)
+
+        return [datetime.datetime(year, month, d) for d in days]
+
+
+# =============================================================================
+class OSPiMRecurrenceCache(object):
+
+    """
+    Expands recurring (master) events into single instances inside a time
+    window, and memoize the result per event and window.
+
+    Memoized expansions of an event are dropped as soon as the master event
+    signature changes.
+    """
+
+    def __init__(self):
+        """ Initialize empty cache """
+
+        # event id => (signature, {(window_start, window_end): instances})
+        self._cache = {}
+
+    def expand(self, event_id, signature, start, end, recurrence,
+               window_start, window_end, wall_offset=None):
+        """
+        Return a list of (start, end) tuples for the instances of the given
+        master event that overlap with the window.
+
+        recurrence is the list of RRULE/EXDATE/RDATE lines of the master,
+        their date-times are converted to local time like the master start
+        (see parse_ical_datetime() for wall_offset).
+        """
+
+        window = (window_start, window_end)
+
+        if event_id in self._cache and \
+                signature == self._cache[event_id][0]:
+            expansions = self._cache[event_id][1]
+        else:
+            expansions = {}
+            self._cache[event_id] = (signature, expansions)
+
+        if window not in expansions:
+            # Only the latest window is useful, since it slides forward
+            expansions.clear()
+            expansions[window] = self._expand(start, end, recurrence,
+                                              window_start, window_end,
+                                              wall_offset)
+
+        return expansions[window]
+
+    def retain(self, event_ids):
+        """ Forget about the events that are not in the given collection """
+
+        for event_id in self._cache.keys():
+            if event_id not in event_ids:
+                self._cache.pop(event_id)
+
+    def last_end(self, start, end, recurrence, wall_offset=None):
+        """
+        Return the end time of the last instance of a master event, None when
+        the recurrence doesn't end (an RRULE without COUNT or UNTIL)
+        """
+
+        duration = end - start
+        last = start
+
+        for line in recurrence:
+            name, value = line.split(':', 1)
+            name = name.split(';', 1)[0].upper()
+
+            try:
+                if 'RRULE' == name:
+                    rule = OSPiMRecurrenceRule(value, wall_offset)
+
+                    if None != rule.until:
+                        last = max(last, rule.until)
+                    elif None != rule.count:
+                        for occurrence in rule.iterate(start):
+                            last = max(last, occurrence)
+                    else:
+                        return None
+                elif 'RDATE' == name:
+                    last = max([last] + self._date_list(value, start,
+                                                        wall_offset))
+            except Exception as e:
+                logger.error('[recurrence:last_end] %s: %s' % (line, str(e)))
+                return None
+
+        return last + duration
+
+    def _expand(self, start, end, recurrence, window_start, window_end,
+                wall_offset):
+        """ Generate the instance list for a master event """
+
+        duration = end - start
+        rules = []
+        extra_dates = set()
+        excluded = set()
+
+        for line in recurrence:
+            name, value = line.split(':', 1)
+            name = name.split(';', 1)[0].upper()
+
+            try:
+                if 'RRULE' == name:
+                    rules.append(OSPiMRecurrenceRule(value, wall_offset))
+                elif 'EXDATE' == name:
+                    excluded.update(self._date_list(value, start,
+                                                    wall_offset))
+                elif 'RDATE' == name:
+                    extra_dates.update(self._date_list(value, start,
+                                                       wall_offset))
+            except Exception as e:
+                logger.error('[recurrence:expand] %s: %s' % (line, str(e)))
+
+        # Only occurrences started after this could be running inside the
+        # window
+        earliest = window_start - duration
+        occurrences = set(d for d in extra_dates if earliest < d < window_end)
+
+        for rule in rules:
+            for occurrence in rule.iterate(start, earliest):
+                if occurrence >= window_end:
+                    break
+
+                if occurrence > earliest:
+                    occurrences.add(occurrence)
+
+        return [(o, o + duration) for o in sorted(occurrences)
+                if o not in excluded]
+
+    def _date_list(self, value, start, wall_offset=None):
+        """
+        Parse comma separated EXDATE/RDATE value list. Date only values get
+        the time of day from the master event start.
+        """
+
+        dates = []
+
+        for item in value.split(','):
+            date = parse_ical_datetime(item, wall_offset)
+
+            if 8 == len(item.strip()):
+                date = date.replace(hour=start.hour, minute=start.minute,
+                                    second=start.second)
+
+            dates.append(date)
+
+        return dates
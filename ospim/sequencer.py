@@ -0,0 +1,266 @@
+# sequencer.py: Limit the number of zones running at the same time
+#
+# Copyright 2013 Sudaraka Wijesinghe <sudaraka.wijesinghe@gmail.com>
+#
+# This file is part of OpenSprinkler Pi Monitor (OSPi Monitor)
+#
+# OSPi Monitor is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# OSPi Monitor is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with OSPi Monitor.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+import datetime
+import sys
+import threading
+
+from .clock import get_clock
+from .config import OSPiMConfigOption
+
+
+# =============================================================================
+# Make sure this script doesn't get executed directly
+if '__main__' == __name__:
+    sys.exit(1)
+
+
+# Format of the event turn on/off times in the schedule
+_TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+# =============================================================================
+class OSPiMSequencer(object):
+
+    """
+    Sits between the schedule and the zones, and decides which of the zones
+    with running events are actually turned on.
+
+    At most max_concurrent zones (0 for no limit) run at the same time, the
+    rest wait in a queue ordered by zone priority and event start time. A
+    queued zone runs for the full length of its event once it gets a slot,
+    so the total watering time is kept. The optional master zone (valve) is
+    turned on whenever any zone is running.
+    """
+
+    # Maximum number of zones running at once, 0 for no limit
+    max_concurrent = OSPiMConfigOption('opensprinkler',
+                                       'max_concurrent')
+
+    # Zone number (1 based) of the master valve, 0 for none
+    master_zone = OSPiMConfigOption('opensprinkler', 'master_zone')
+
+    def __init__(self):
+        """ Initialize with no runs """
+
+        self._lock = threading.Lock()
+        self._created = get_clock().now()
+
+        # zone id => run dictionary
+        self._runs = {}
+
+        # Events (zone id, turn on, turn off) that were already served
+        self._done = set()
+
+    def is_active(self):
+        """ Return True when the sequencer changes anything at all """
+
+        return 0 < self.max_concurrent or 0 < self.master_zone
+
+    def update(self, active, priorities=None, now=None):
+        """
+        Take the running events of the schedule, as returned by
+        OSPiMSchedule.get_active_zones(), and return the zones to be turned
+        on in the same form, with the run time of each zone.
+
+        priorities is an optional dictionary of zone id => priority, lower
+        numbers run first.
+        """
+
+        if not self.is_active():
+            return active
+
+        if None == now:
+            now = get_clock().now()
+
+        with self._lock:
+            self._add_demands(active, now)
+            self._finish_runs(now)
+            self._start_runs(priorities or {}, now)
+
+            return self._desired_zones(active)
+
+    def cancel(self, zone_id):
+        """
+        Drop the run of the zone (i.e. zone was turned off manually), so
+        that its slot is given to the next zone in the queue
+        """
+
+        with self._lock:
+            run = self._runs.pop(zone_id, None)
+
+            if None != run:
+                self._done.update(run['events'])
+
+    def status(self):
+        """ Return the running zones and the queue as a dictionary """
+
+        with self._lock:
+            running = []
+            queued = []
+
+            for run in self._runs.values():
+                if None != run['started']:
+                    running.append({
+                        'zone_id': run['zone_id'],
+                        'started': str(run['started']),
+                        'ends': str(run['started'] + run['duration'])
+                    })
+                else:
+                    queued.append({
+                        'zone_id': run['zone_id'],
+                        'since': str(run['since']),
+                        'duration': int(run['duration'].total_seconds()),
+                        '_order': run['order']
+                    })
+
+            queued.sort(key=lambda q: q.pop('_order'))
+
+            return {
+                'max_concurrent': self.max_concurrent,
+                'master_zone': self.master_zone,
+                'running': sorted(running, key=lambda r: r['started']),
+                'queued': queued
+            }
+
+    def _add_demands(self, active, now):
+        """ Add new events to the runs, and drop cancelled ones """
+
+        seen = set()
+        master_id = self.master_zone - 1
+
+        for zone_id, events in active.items():
+            if zone_id == master_id:
+                continue
+
+            for turn_on, turn_off in events:
+                key = (zone_id, turn_on, turn_off)
+                seen.add(key)
+
+                if key in self._done:
+                    continue
+
+                run = self._runs.get(zone_id)
+                if None != run and key in run['events']:
+                    continue
+
+                self._add_event(zone_id, key, now)
+
+        for zone_id, run in self._runs.items():
+            for key in list(run['events']):
+                # Event removed from the schedule before its end
+                if key not in seen and str(now) < key[2]:
+                    run['events'].remove(key)
+
+            if not run['events']:
+                self._runs.pop(zone_id)
+
+        # Finished events can't be active again
+        self._done = set(k for k in self._done if str(now) <= k[2])
+
+    def _add_event(self, zone_id, key, now):
+        """ Add an event to the run of its zone, create the run if needed """
+
+        turn_on = datetime.datetime.strptime(key[1], _TIME_FORMAT)
+        turn_off = datetime.datetime.strptime(key[2], _TIME_FORMAT)
+
+        # Events already under way when the sequencer started only get the
+        # remaining time
+        if turn_on < self._created:
+            turn_on = max(turn_on, min(now, turn_off))
+
+        run = self._runs.get(zone_id)
+
+        if None == run:
+            self._runs[zone_id] = {
+                'zone_id': zone_id,
+                'since': turn_on,
+                'duration': turn_off - turn_on,
+                'covered_until': turn_off,
+                'started': None,
+                'events': set([key]),
+                'order': None
+            }
+            return
+
+        # Overlapping events of the same zone only add the time that is not
+        # already covered
+        extra = turn_off - max(turn_on, run['covered_until'])
+        if datetime.timedelta() < extra:
+            run['duration'] += extra
+
+        run['covered_until'] = max(run['covered_until'], turn_off)
+        run['events'].add(key)
+
+    def _finish_runs(self, now):
+        """ Remove the runs that have been running for their duration """
+
+        for zone_id, run in self._runs.items():
+            if None != run['started'] and \
+                    now - run['started'] >= run['duration']:
+                self._done.update(run['events'])
+                self._runs.pop(zone_id)
+
+    def _start_runs(self, priorities, now):
+        """ Start the queued runs while there are free slots """
+
+        queued = [r for r in self._runs.values() if None == r['started']]
+
+        for run in queued:
+            run['order'] = (priorities.get(run['zone_id'], 0), run['since'],
+                            run['zone_id'])
+
+        queued.sort(key=lambda r: r['order'])
+
+        running = len(self._runs) - len(queued)
+
+        for run in queued:
+            if 0 < self.max_concurrent and running >= self.max_concurrent:
+                break
+
+            run['started'] = now
+            running += 1
+
+    def _desired_zones(self, active):
+        """ Build the zone => run time list of the zones to be turned on """
+
+        desired = {}
+
+        for zone_id, run in self._runs.items():
+            if None != run['started']:
+                desired[zone_id] = [(
+                    str(run['started'].replace(microsecond=0)),
+                    str(run['started'] + run['duration'])
+                )]
+
+        master_id = self.master_zone - 1
+
+        if 0 <= master_id:
+            if desired:
+                desired[master_id] = [(
+                    min(d[0][0] for d in desired.values()),
+                    max(d[0][1] for d in desired.values())
+                )]
+
+            if master_id in active:
+                desired.setdefault(master_id, []).extend(active[master_id])
+
+        return desired
@@ -0,0 +1,189 @@
+# source.py: Common interface of the schedule event sources
+#
+# Copyright 2013 Sudaraka Wijesinghe <sudaraka.wijesinghe@gmail.com>
+#
+# This file is part of OpenSprinkler Pi Monitor (OSPi Monitor)
+#
+# OSPi Monitor is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# OSPi Monitor is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with OSPi Monitor.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+import datetime
+import email.utils
+import sys
+import time
+
+from .clock import get_clock
+from .config import OSPiMConfigOption
+from .recurrence import OSPiMRecurrenceCache
+
+
+# =============================================================================
+# Make sure this script doesn't get executed directly
+if '__main__' == __name__:
+    sys.exit(1)
+
+
+# =============================================================================
+def parse_retry_after(value):
+    """
+    Convert HTTP Retry-After header value (seconds or HTTP date) to number of
+    seconds. Return None when not available.
+    """
+
+    if not value:
+        return None
+
+    try:
+        return max(0, int(value))
+    except ValueError:
+        pass
+
+    date = email.utils.parsedate_tz(value)
+    if None == date:
+        return None
+
+    return max(0, email.utils.mktime_tz(date) - time.time())
+
+
+# =============================================================================
+class OSPiMEventSource(object):
+
+    """
+    Base class of the event sources that feed the schedule (OSPiMSchedule).
+
+    Sub-classes must implement fetch_events() which build a dictionary of
+    upcoming events keyed by event id and pass it to cache.update()
+    """
+
+    # Number of days ahead to keep in the schedule, events that start later
+    # are added as the window moves on
+    horizon_days = OSPiMConfigOption('calendar', 'horizon_days')
+
+    # Number of seconds to wait for the server of a remote source
+    fetch_timeout = OSPiMConfigOption('calendar', 'fetch_timeout')
+
+    # Number of seconds the daemon waits for itself to stop before it is
+    # killed, the fetches must end well before it
+    stop_timeout = OSPiMConfigOption('daemon', 'stop_timeout')
+
+    # Number of seconds the remote server asked to wait before the next
+    # query, set by the last failed fetch_events()
+    retry_after = None
+
+    def __init__(self):
+        """ Initialize source state """
+
+        # Memoized local expansions of the recurring events
+        self._recurrence = OSPiMRecurrenceCache()
+
+    def is_ready(self, cache):
+        """
+        Return True when the source is configured well enough to fetch
+        events. This method should be overridden in the sub-classes.
+        """
+
+        return True
+
+    def fetch_events(self, cache):
+        """
+        Fetch the upcoming events and update the schedule cache with them.
+        Return True on success, False when the source is not available.
+        This method must be overridden in the sub-classes.
+        """
+
+        raise NotImplementedError()
+
+    def _http_timeout(self):
+        """
+        Return the number of seconds to wait for a remote server, within
+        half of the stop_timeout
+        """
+
+        return max(1, min(self.fetch_timeout, self.stop_timeout / 2.0))
+
+    def _horizon_window(self):
+        """
+        Return (start, end) of the window the schedule covers, the recurring
+        events are expanded in it and later events are left out
+        """
+
+        window_start = datetime.datetime.combine(get_clock().now().date(),
+                                                 datetime.time())
+        window_end = window_start + \
+            datetime.timedelta(days=self.horizon_days)
+
+        return window_start, window_end
+
+    def _add_event(self, return_list, event_id, summary, start_time,
+                   end_time):
+        """
+        Add a single (non-recurring) event to the given event list, unless it
+        is over or starts after the horizon window
+        """
+
+        if get_clock().now() > end_time:
+            return
+
+        if start_time >= self._horizon_window()[1]:
+            return
+
+        # Flag to indicate whether the event is running
+        # (zone is on or not)
+        is_running = 0
+        if get_clock().now() >= start_time and \
+                get_clock().now() <= end_time:
+            is_running = 1
+
+        return_list[event_id] = {
+            'zone_name': summary,
+            'zone_id': None,
+            'turn_on': str(start_time.replace(microsecond=0)),
+            'turn_off': str(end_time.replace(microsecond=0)),
+            'running': is_running
+        }
+
+    def _add_recurring_event(self, return_list, event_id, signature, summary,
+                             start_time, end_time, recurrence,
+                             exceptions=None, wall_offset=None):
+        """
+        Expand a recurring (master) event for the horizon window, and add its
+        instances to the given event list.
+
+        Instances with an id in exceptions are skipped, as they have been
+        modified or cancelled separately. wall_offset is the local start
+        time less the calendar wall clock start time, used to convert the
+        recurrence date-times (see parse_ical_datetime()).
+        """
+
+        window_start, window_end = self._horizon_window()
+
+        instances = self._recurrence.expand(event_id, signature, start_time,
+                                            end_time, recurrence,
+                                            window_start, window_end,
+                                            wall_offset)
+
+        for instance_start, instance_end in instances:
+            instance_id = self._instance_id(event_id, instance_start)
+
+            if None != exceptions and instance_id in exceptions:
+                continue
+
+            self._add_event(return_list, instance_id, summary,
+                            instance_start, instance_end)
+
+    def _instance_id(self, event_id, start_time):
+        """ Build an id for a single instance of a recurring event """
+
+        return '%s_%s' % (event_id, start_time.strftime('%Y%m%dT%H%M%S'))
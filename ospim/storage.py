@@ -27,8 +27,12 @@ import logging
 import os
 import re
 import sys
+import threading
 
-from .config import ospim_conf
+from .clock import get_clock
+from .config import OSPiMConfigOption
+from .isotime import reserve_cache
+from .timeline import OSPiMTimeline
 
 
 # =============================================================================
@@ -37,6 +41,10 @@ if '__main__' == __name__:
     sys.exit(1)
 
 
+# Log messages of this module, the level can be set per module
+logger = logging.getLogger(__name__)
+
+
 # =============================================================================
 class OSPiMStorage(object):
 
@@ -52,6 +60,10 @@ class OSPiMStorage(object):
     # JSON string.
     _data = {}
 
+    # Number of times the data was written, changes with every change of the
+    # data, so the results derived from it can be cached
+    _version = 0
+
     def __init__(self):
         """
         Make sure the path and data file exists in the system, and load the
@@ -62,11 +74,11 @@ class OSPiMStorage(object):
             try:
                 os.makedirs(os.path.dirname(self._data_file), 0o755)
             except:
-                logging.warning(
+                logger.warning(
                     'Failed to create storage file directory %s'
                     % os.path.dirname(self._data_file)
                 )
-                logging.warning(
+                logger.warning(
                     'Changes will not be saved to ' + self._data_file)
 
         # load settings from disk file
@@ -98,13 +110,20 @@ class OSPiMStorage(object):
     def write(self):
         """ Write the current memory snapshot of zone data in to disk file """
 
+        self._version += 1
+
         try:
             f = open(self._data_file, 'w')
             f.write(json.dumps(self._data))
             f.close()
         except Exception as e:
-            logging.warning('Failed to write data to ' + self._data_file)
-            logging.error(str(e))
+            logger.warning('Failed to write data to ' + self._data_file)
+            logger.error(str(e))
+
+    def get_version(self):
+        """ Return the version of the data, see _version """
+
+        return self._version
 
     def get_json(self, hash=None):
         """ Return the memory snapshot as JSON object (string) """
@@ -136,7 +155,7 @@ class OSPiMSchedule(OSPiMStorage):
     """
 
     # Data file path
-    _data_file = ospim_conf.get('calendar', 'schedule_file')
+    _data_file = OSPiMConfigOption('calendar', 'schedule_file')
 
     # Google Calendar Id and event list
     _data = {
@@ -147,36 +166,77 @@ class OSPiMSchedule(OSPiMStorage):
     # Zone data object
     _zone = None
 
+    # Merged watering ranges of each zone (OSPiMTimeline), built on demand
+    # and kept up to date as the events change
+    _timeline = None
+
+    # (data version, hash) of the last hash calculated by get_hash()
+    _data_hash = (None, None)
+
+    # Number of events encoded in to one piece of the iter_json() output
+    _events_per_piece = 50
+
+    def __init__(self):
+        """
+        Create the schedule lock and load the data. The events, the version
+        and the timeline are changed under the lock, as both the web server
+        and the calendar thread change them.
+        """
+
+        self._lock = threading.RLock()
+
+        super(OSPiMSchedule, self).__init__()
+
     def set_zone_data(self, zone_data):
         """ Set zone data store object """
 
         self._zone = zone_data
 
     def update(self, event_list, remove_non_existing=False):
-        """ Add the new events from given list in to the schedule data """
+        """
+        Add the new events from given list in to the schedule data. The data
+        is only written (and its version changed) when any event was added,
+        changed or removed.
+        """
 
-        try:
-            self.remove_past_events()
+        with self._lock:
+            # remove() changes the version of every removed event
+            version = self._version
+            data_changed = False
 
-            for event_id, event in event_list.items():
-                if 'zone_id' not in event:
-                    event['zone_id'] = None
+            try:
+                self.remove_past_events()
 
-                # Get zone it from the name (event summary text)
-                event['zone_id'] = self._zone.get_id(event['zone_name'])
+                # Keep the parsed time stamps of the whole feed, the source and
+                # the local time stamps of every event
+                reserve_cache(4 * len(event_list))
 
-                # Don't add unidentified zones
-                if None == event['zone_id']:
-                    continue
+                for event_id, event in event_list.items():
+                    if 'zone_id' not in event:
+                        event['zone_id'] = None
 
-                self._data['events'][event_id] = event
+                    # Get zone it from the name (event summary text)
+                    event['zone_id'] = self._zone.get_id(event['zone_name'])
 
-            if remove_non_existing:
-                self._remove_non_existing(event_list)
+                    # Don't add unidentified zones
+                    if None == event['zone_id']:
+                        continue
 
-            self.write()
-        except Exception as e:
-            logging.error('[Schedule:update] ' + str(e))
+                    old_event = self._data['events'].get(event_id)
+                    if old_event == event:
+                        continue
+
+                    self._update_timeline(old_event, event)
+                    self._data['events'][event_id] = event
+                    data_changed = True
+
+                if remove_non_existing:
+                    self._remove_non_existing(event_list)
+
+                if data_changed or version != self._version:
+                    self.write()
+            except Exception as e:
+                logger.error('[Schedule:update] ' + str(e))
 
     def _remove_non_existing(self, event_list):
         """
@@ -196,29 +256,63 @@ class OSPiMSchedule(OSPiMStorage):
         time
         """
 
-        try:
-            for event_id, event in self._data['events'].items():
-                end_time = datetime.datetime.strptime(event['turn_off'],
-                                                      '%Y-%m-%d %H:%M:%S')
+        with self._lock:
+            try:
+                for event_id, event in self._data['events'].items():
+                    end_time = datetime.datetime.strptime(
+                        event['turn_off'], '%Y-%m-%d %H:%M:%S')
 
-                if datetime.datetime.now() > end_time:
-                    self.remove(event_id)
+                    if get_clock().now() > end_time:
+                        self.remove(event_id)
 
-        except Exception as e:
-            logging.error('[Schedule:remove_past]' + str(e))
+            except Exception as e:
+                logger.error('[Schedule:remove_past]' + str(e))
+
+    def refresh_running(self):
+        """
+        Update the running flag of the cached events against current time,
+        used when the event source could not be queried.
+        """
+
+        with self._lock:
+            data_changed = False
+
+            try:
+                for event in self._data['events'].values():
+                    start_time = datetime.datetime.strptime(
+                        event['turn_on'], '%Y-%m-%d %H:%M:%S')
+                    end_time = datetime.datetime.strptime(
+                        event['turn_off'], '%Y-%m-%d %H:%M:%S')
+
+                    is_running = 0
+                    if start_time <= get_clock().now() <= end_time:
+                        is_running = 1
+
+                    if is_running != event['running']:
+                        event['running'] = is_running
+                        data_changed = True
+
+            except Exception as e:
+                logger.error('[Schedule:refresh_running]' + str(e))
+
+            if data_changed:
+                self.write()
 
     def remove(self, event_id):
         """ Remove event from the data schedule """
 
-        try:
-            if event_id not in self._data['events']:
-                return
-
-            self._zone.set_status(self._data['events'][event_id]['zone_id'], 0)
+        with self._lock:
+            try:
+                if event_id not in self._data['events']:
+                    return
 
-            self._data['events'].pop(event_id)
-        except Exception as e:
-            logging.error('[Schedule:remove] ' + str(e))
+                # Zones are turned off by the calendar thread once no event
+                # keeps them on, turning it off here would end the next event
+                # of the zone as well (seen as manually turned off)
+                self._update_timeline(self._data['events'].pop(event_id), None)
+                self._version += 1
+            except Exception as e:
+                logger.error('[Schedule:remove] ' + str(e))
 
     def set_calendar_id(self, id):
         """
@@ -227,52 +321,217 @@ class OSPiMSchedule(OSPiMStorage):
         the cache until next fetch cycle.
         """
 
-        if id != self._data['calendar_id']:
-            self._data = {
-                "calendar_id": None,
-                "events": {}
-            }
+        with self._lock:
+            if id != self._data['calendar_id']:
+                self._data = {
+                    "calendar_id": None,
+                    "events": {}
+                }
+                self._timeline = None
 
-        self._data['calendar_id'] = id
+            self._data['calendar_id'] = id
 
-        # Preserver changes by writing them back to the disk file
-        self.write()
+            # Preserver changes by writing them back to the disk file
+            self.write()
+
+    def get_timeline(self):
+        """ Return the merged watering ranges of the zones (OSPiMTimeline) """
+
+        with self._lock:
+            if None == self._timeline:
+                self._timeline = OSPiMTimeline()
+
+                for event in self._data['events'].values():
+                    self._timeline.add(event['zone_id'], event['turn_on'],
+                                       event['turn_off'])
+
+            return self._timeline
+
+    def get_active_zones(self):
+        """
+        Return a dictionary of zone id => [(turn_on, turn_off)] of the
+        watering range running at the current time. Overlapping and back to
+        back events of a zone make one range.
+        """
+
+        with self._lock:
+            return self.get_timeline().get_active(get_clock().now())
+
+    def get_next_change(self, zone_id):
+        """
+        Return the time (datetime) the schedule next turns the zone on or
+        off, None if there are no more events for the zone
+        """
+
+        with self._lock:
+            return self.get_timeline().get_next_change(zone_id,
+                                                       get_clock().now())
+
+    def get_upcoming(self, begin, end):
+        """
+        Return the on/off windows of each zone between begin and end
+        (datetime), as a list of {zone_id, name, windows} for the zones that
+        have any. A window is a dictionary of on, off and type:
+
+            schedule    merged range of the schedule events
+            manual-off  schedule range that was turned off manually, the
+                        rest of it is skipped
+            manual      manually turned on zone, off is the max_run cutoff
+        """
+
+        max_run = datetime.timedelta(hours=self._zone._data['max_run'])
+        upcoming = []
+
+        for zone_id in range(self._zone._data['zone_count']):
+            zone = self._zone._data['zone'][zone_id]
+            windows = []
+
+            with self._lock:
+                ranges = self.get_timeline().get_ranges(zone_id, begin, end)
+
+            for turn_on, turn_off in ranges:
+                window = {'on': turn_on, 'off': turn_off, 'type': 'schedule'}
+
+                if 0 == zone['status'] and 1 == zone['manual_off'] and \
+                        turn_on < zone['start_time'] < turn_off:
+                    window['type'] = 'manual-off'
+
+                windows.append(window)
+
+            if 1 == zone['status'] and 'M' == zone['state_owner']:
+                started = datetime.datetime.strptime(
+                    zone['start_time'][:19], '%Y-%m-%d %H:%M:%S')
+
+                windows.append({
+                    'on': str(started),
+                    'off': str(started + max_run),
+                    'type': 'manual'
+                })
+
+            if windows:
+                upcoming.append({
+                    'zone_id': zone_id,
+                    'name': zone['name'],
+                    'windows': sorted(windows, key=lambda w: w['on'])
+                })
+
+        return upcoming
+
+    def _update_timeline(self, old_event, new_event):
+        """ Replace the old event with the new one (either can be None) """
+
+        if None == self._timeline:
+            return
+
+        old = new = None
+
+        if None != old_event:
+            old = (old_event['zone_id'], old_event['turn_on'],
+                   old_event['turn_off'])
+
+        if None != new_event:
+            new = (new_event['zone_id'], new_event['turn_on'],
+                   new_event['turn_off'])
+
+        if old == new:
+            return
+
+        if None != old:
+            self._timeline.remove(*old)
+
+        if None != new:
+            self._timeline.add(*new)
 
     def get_sorted(self):
         """ Return the schedule data structure sorted by event start time """
 
-        # Work on a separate copy of data
-        data = dict(self._data)
+        with self._lock:
+            # Work on a separate copy of data
+            data = dict(self._data)
+
+            sorted_events = sorted(data['events'].items(),
+                                   key=lambda k: k[1]['turn_on'])
+
+            server_time = get_clock().now().strftime('%Y-%m-%dT%H:%M:%S')
+            data['server_time'] = server_time
+
+            data['events'] = []
+            for id, event in sorted_events:
+                event = dict(event)
+                event['event_id'] = id
+                data['events'].append(event)
+
+            return data
+
+    def get_hash(self):
+        """
+        Return the hash of the current data, calculated one event at a time
+        and only once for each version of the data
+        """
 
-        sorted_events = sorted(data['events'].items(),
-                               key=lambda k: k[1]['turn_on'])
+        with self._lock:
+            version = self._version
 
-        server_time = datetime.datetime.now().strftime('%Y-%m-%dT%H:%M:%S')
-        data['server_time'] = server_time
+            if version != self._data_hash[0]:
+                data_hash = hashlib.md5(json.dumps(self._data['calendar_id']))
 
-        data['events'] = []
-        for id, event in sorted_events:
-            event['event_id'] = id
-            data['events'].append(event)
+                for event_id, event in sorted(self._data['events'].items()):
+                    data_hash.update(json.dumps(event_id))
+                    data_hash.update(json.dumps(event, sort_keys=True))
 
-        return data
+                self._data_hash = (version, data_hash.hexdigest())
+
+            return self._data_hash[1]
 
     def get_json(self, hash=None):
         """ Override parent class to sort by event start time """
 
-        # Calculate the hash of the current data
-        data_hash = hashlib.md5(json.dumps(self._data)).hexdigest()
+        return ''.join(self.iter_json(hash))
+
+    def iter_json(self, hash=None):
+        """
+        Generate the JSON string of get_json() in pieces, the events are
+        encoded a few at a time as the pieces are consumed, so the whole
+        document is never held in memory.
+        """
+
+        data_hash = self.get_hash()
 
         # If the given hash is equal to current data hash we only return a
         # skeleton data structure with the hash indicating that data has not
         # changed
         if hash == data_hash:
-            return json.dumps({'_data_hash': data_hash})
+            yield json.dumps({'_data_hash': data_hash})
+            return
 
-        data = self.get_sorted()
-        data['_data_hash'] = data_hash
+        # Work on a snapshot of the event list, the calendar thread changes
+        # the events while the pieces are being sent
+        with self._lock:
+            events = sorted(self._data['events'].items(),
+                            key=lambda k: k[1]['turn_on'])
 
-        return json.dumps(data)
+        yield '{"calendar_id": %s, "server_time": %s, "_data_hash": %s, ' \
+            '"events": [' % (
+                json.dumps(self._data['calendar_id']),
+                json.dumps(get_clock().now().strftime('%Y-%m-%dT%H:%M:%S')),
+                json.dumps(data_hash))
+
+        separator = ''
+
+        for first in range(0, len(events), self._events_per_piece):
+            last = first + self._events_per_piece
+            piece = []
+
+            for event_id, event in events[first:last]:
+                event = dict(event)
+                event['event_id'] = event_id
+
+                piece.append(separator + json.dumps(event))
+                separator = ', '
+
+            yield ''.join(piece)
+
+        yield ']}'
 
 
 # =============================================================================
@@ -283,14 +542,15 @@ class OSPiMZones(OSPiMStorage):
     """
 
     # Data file path
-    _data_file = ospim_conf.get('opensprinkler', 'zone_file')
+    _data_file = OSPiMConfigOption('opensprinkler', 'zone_file')
 
     # Skeleton data structure for a single zone
     _zone_block = {
         "name": "",
         "status": 0,
         "state_owner": "M",
-        "start_time": ""
+        "start_time": "",
+        "priority": 0
     }
 
     # Default zone configuration, and the memory snapshot of the disk file
@@ -300,6 +560,22 @@ class OSPiMZones(OSPiMStorage):
         "zone": [copy.copy(_zone_block)]
     }
 
+    # Number of zones on each board (main board and the expansion boards)
+    zones_per_board = OSPiMConfigOption('opensprinkler',
+                                        'zones_per_board')
+
+    # Status of all zones packed in to an integer, bit n is zone n. Kept in
+    # sync with the zone status by the methods that change it, under _lock
+    # as both the web server and the calendar thread change the status.
+    _bits = 0
+
+    def __init__(self):
+        """ Create the zone status lock and load the data """
+
+        self._lock = threading.Lock()
+
+        super(OSPiMZones, self).__init__()
+
     def initialize_data(self):
         """ Initialize zone blocks on new data structure """
 
@@ -316,11 +592,19 @@ class OSPiMZones(OSPiMStorage):
                 event['state_owner'] = ''
 
             if 'start_time' not in event:
-                event['start_time'] = str(datetime.datetime.now())
+                event['start_time'] = str(get_clock().now())
 
             if 'manual_off' not in event:
                 event['manual_off'] = 0
 
+            if 'priority' not in event:
+                event['priority'] = 0
+
+        self._bits = 0
+        for zone_id, zone in enumerate(self._data['zone']):
+            if zone['status']:
+                self._bits |= 1 << zone_id
+
     def set_max_run(self, hours):
         """ Set the number of hours a zone can be turned on for """
 
@@ -339,7 +623,7 @@ class OSPiMZones(OSPiMStorage):
             while len(self._data['zone']) < count:
                 self._data['zone'].append(copy.copy(self._zone_block))
         except:
-            logging.warning(
+            logger.warning(
                 'Failed to add adjustment blocks to the zone data list')
 
         # Preserver changes by writing them back to the disk file
@@ -361,44 +645,107 @@ class OSPiMZones(OSPiMStorage):
             self._data['zone'][zone]['name'] = name
             self.write()
 
-    def set_status(self, zone_id, status, owner='M'):
+    def get_bits(self):
+        """ Return the list of zone status bits, first to last zone """
+
+        bits = self._bits
+
+        return [(bits >> i) & 1 for i in range(self._data['zone_count'])]
+
+    def get_bitmask(self):
+        """ Return the zone status as an integer, bit n is zone n """
+
+        return self._bits & ((1 << self._data['zone_count']) - 1)
+
+    def get_boards(self):
+        """
+        Return the list of boards with the range of zone ids on each, the
+        first board is the main board.
+        """
+
+        boards = []
+
+        for first in range(0, self._data['zone_count'], self.zones_per_board):
+            boards.append({
+                'board': len(boards),
+                'first_zone': first,
+                'last_zone': min(first + self.zones_per_board,
+                                 self._data['zone_count']) - 1
+            })
+
+        return boards
+
+    def get_json_page(self, page, page_size):
+        """
+        Return the zone data of a single page of zones as JSON object
+        (string), pages are numbered from 0.
+        """
+
+        page_size = max(1, page_size)
+        first = max(0, page) * page_size
+        last = min(first + page_size, self._data['zone_count'])
+
+        return json.dumps({
+            'zone_count': self._data['zone_count'],
+            'max_run': self._data['max_run'],
+            'zones_per_board': self.zones_per_board,
+            'page': page,
+            'page_size': page_size,
+            'page_count': (self._data['zone_count'] + page_size - 1) //
+            page_size,
+            'first_zone': first,
+            'boards': self.get_boards(),
+            'zone': self._data['zone'][first:last]
+        })
+
+    def set_status(self, zone_id, status, owner='M', write=True):
         """
         Update the current status (on/off) of the given zone.
 
         Status that keep in this data structure merely a representation of what
         the hardware status is. Hardware needs to be update separately.
+
+        When write is False the change is not saved to the disk file, so that
+        the caller can save several changes at once.
         """
 
-        if 'state_owner' not in self._data['zone'][zone_id]:
-            self._data['zone'][zone_id]['state_owner'] = owner
+        with self._lock:
+            if 'state_owner' not in self._data['zone'][zone_id]:
+                self._data['zone'][zone_id]['state_owner'] = owner
 
-        # Manually turned on zones can't be turned off by the calendar
-        if 0 == status and \
-                'M' == self._data['zone'][zone_id]['state_owner'] and \
-                'S' == owner:
-            return
+            # Manually turned on zones can't be turned off by the calendar
+            if 0 == status and \
+                    'M' == self._data['zone'][zone_id]['state_owner'] and \
+                    'S' == owner:
+                return
 
-        # When chanting the zone status on or off set the start time to track
-        # maximum allowable run time.
-        if status != self._data['zone'][zone_id]['status']:
-            self._data['zone'][zone_id]['start_time'] = \
-                str(datetime.datetime.now())
+            # When chanting the zone status on or off set the start time to
+            # track maximum allowable run time.
+            if status != self._data['zone'][zone_id]['status']:
+                self._data['zone'][zone_id]['start_time'] = \
+                    str(get_clock().now())
 
-        self._data['zone'][zone_id]['manual_off'] = 0
+            self._data['zone'][zone_id]['manual_off'] = 0
 
-        if 0 == status and \
-                1 == self._data['zone'][zone_id]['status'] and \
-                'S' == self._data['zone'][zone_id]['state_owner'] and \
-                'M' == owner:
-            self._data['zone'][zone_id]['manual_off'] = 1
+            if 0 == status and \
+                    1 == self._data['zone'][zone_id]['status'] and \
+                    'S' == self._data['zone'][zone_id]['state_owner'] and \
+                    'M' == owner:
+                self._data['zone'][zone_id]['manual_off'] = 1
 
-        try:
-            self._data['zone'][zone_id]['status'] = status
-            self._data['zone'][zone_id]['state_owner'] = owner
+            try:
+                self._data['zone'][zone_id]['status'] = status
+                self._data['zone'][zone_id]['state_owner'] = owner
 
-            self.write()
-        except Exception as e:
-            logging.error('[zone:set_status]: %s' % str(e))
+                if status:
+                    self._bits |= 1 << zone_id
+                else:
+                    self._bits &= ~(1 << zone_id)
+
+                if write:
+                    self.write()
+            except Exception as e:
+                logger.error('[zone:set_status]: %s' % str(e))
 
     def get_id(self, zone_name):
         """
@@ -434,17 +781,23 @@ class OSPiMZones(OSPiMStorage):
 
         data_changed = False
 
-        for event in self._data['zone']:
-            if 'M' == event['state_owner'] and 1 == event['status']:
-                start = datetime.datetime.strptime(
-                    event['start_time'],
-                    '%Y-%m-%d %H:%M:%S.%f'
-                )
-
-                if datetime.timedelta(hours=self._data['max_run']) <= \
-                        datetime.datetime.now() - start:
-                    event['status'] = 0
-                    data_changed = True
+        with self._lock:
+            for zone_id, event in enumerate(self._data['zone']):
+                if 'M' == event['state_owner'] and 1 == event['status']:
+                    # Clocks that return whole seconds leave out the
+                    # microseconds
+                    start = datetime.datetime.strptime(
+                        event['start_time'][:19],
+                        '%Y-%m-%d %H:%M:%S'
+                    )
+
+                    if datetime.timedelta(hours=self._data['max_run']) <= \
+                            get_clock().now() - start:
+                        event['status'] = 0
+                        self._bits &= ~(1 << zone_id)
+                        data_changed = True
 
         if data_changed:
             self.write()
+
+        return data_changed
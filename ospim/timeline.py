@@ -0,0 +1,244 @@
+# timeline.py: Watering time ranges of each zone merged from the events
+#
+# Copyright 2013 Sudaraka Wijesinghe <sudaraka.wijesinghe@gmail.com>
+#
+# This file is part of OpenSprinkler Pi Monitor (OSPi Monitor)
+#
+# OSPi Monitor is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# OSPi Monitor is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with OSPi Monitor.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+import bisect
+import sys
+import time
+
+from .isotime import epoch_to_local, iso_to_epoch
+
+
+# =============================================================================
+# Make sure this script doesn't get executed directly
+if '__main__' == __name__:
+    sys.exit(1)
+
+
+# =============================================================================
+class OSPiMTimeline(object):
+
+    """
+    Keeps the events of each zone as sorted, non-overlapping time ranges.
+    Overlapping events, and events that start within a second of the end of
+    another (turn off times are inclusive), are merged in to one range, so
+    the zone stays on across them.
+
+    Adding an event merges it with its neighbours, removing one merges
+    again only the events of the range it was in. Finding the range running
+    at a given time, or the next change of a zone, is a binary search.
+
+    Times are the schedule event time stamps ('YYYY-MM-DD HH:MM:SS', local)
+    and ranges are returned as (turn_on, turn_off) time stamp pairs.
+    """
+
+    def __init__(self):
+        """ Initialize an empty timeline """
+
+        # zone id => sorted list of (start, end, turn_on, turn_off) of the
+        # events, start and end are seconds since the epoch
+        self._events = {}
+
+        # zone id => sorted list of the merged ranges, in the same form
+        self._ranges = {}
+
+        # zone id => list of the range start times, to search in
+        self._starts = {}
+
+    def add(self, zone_id, turn_on, turn_off):
+        """ Add an event of the zone """
+
+        entry = self._entry(turn_on, turn_off)
+
+        bisect.insort(self._events.setdefault(zone_id, []), entry)
+
+        ranges = self._ranges.setdefault(zone_id, [])
+        starts = self._starts.setdefault(zone_id, [])
+
+        # Ranges from first to last (exclusive) are merged with the event
+        first = bisect.bisect_left(starts, entry[0])
+        if 0 < first and entry[0] <= ranges[first - 1][1] + 1:
+            first -= 1
+
+        last = first
+        while last < len(ranges) and ranges[last][0] <= entry[1] + 1:
+            last += 1
+
+        merged = entry
+        for item in ranges[first:last]:
+            merged = self._merge(merged, item)
+
+        ranges[first:last] = [merged]
+        starts[first:last] = [merged[0]]
+
+    def remove(self, zone_id, turn_on, turn_off):
+        """ Remove an event of the zone, added earlier with add() """
+
+        entry = self._entry(turn_on, turn_off)
+        events = self._events.get(zone_id, [])
+
+        index = bisect.bisect_left(events, entry)
+        if index >= len(events) or entry != events[index]:
+            return
+
+        events.pop(index)
+
+        ranges = self._ranges[zone_id]
+        starts = self._starts[zone_id]
+
+        # Merge the remaining events of the range the event was in again
+        position = bisect.bisect_right(starts, entry[0]) - 1
+        current = ranges[position]
+
+        begin = bisect.bisect_left(events, (current[0],))
+        end = bisect.bisect_right(events, (current[1], float('inf')))
+
+        replacement = []
+        for item in events[begin:end]:
+            if replacement and item[0] <= replacement[-1][1] + 1:
+                replacement[-1] = self._merge(replacement[-1], item)
+            else:
+                replacement.append(item)
+
+        ranges[position:position + 1] = replacement
+        starts[position:position + 1] = [item[0] for item in replacement]
+
+        if not events:
+            del self._events[zone_id]
+            del self._ranges[zone_id]
+            del self._starts[zone_id]
+
+    def clear(self):
+        """ Remove all events """
+
+        self._events = {}
+        self._ranges = {}
+        self._starts = {}
+
+    def get_range(self, zone_id, now):
+        """
+        Return (turn_on, turn_off) of the range of the zone running at the
+        given time (datetime), None if the zone is not scheduled to run
+        """
+
+        position = self._find(zone_id, now)
+        if None == position:
+            return None
+
+        current = self._ranges[zone_id][position]
+
+        if self._epoch(now) > current[1]:
+            return None
+
+        return current[2], current[3]
+
+    def get_next_change(self, zone_id, now):
+        """
+        Return the time (datetime) the zone is next turned on or off after
+        the given time, None if nothing is scheduled
+        """
+
+        ranges = self._ranges.get(zone_id, [])
+        position = self._find(zone_id, now)
+
+        if None != position and self._epoch(now) <= ranges[position][1]:
+            # Turned off after the last second of the range
+            return epoch_to_local(ranges[position][1] + 1)
+
+        position = 0 if None == position else position + 1
+
+        if position >= len(ranges):
+            return None
+
+        return epoch_to_local(ranges[position][0])
+
+    def get_active(self, now):
+        """
+        Return zone id => [(turn_on, turn_off)] of the ranges running at the
+        given time (datetime)
+        """
+
+        active = {}
+
+        for zone_id in self._ranges:
+            current = self.get_range(zone_id, now)
+
+            if None != current:
+                active[zone_id] = [current]
+
+        return active
+
+    def get_ranges(self, zone_id, begin, end):
+        """
+        Return the (turn_on, turn_off) ranges of the zone that overlap the
+        window from begin to end (datetime)
+        """
+
+        ranges = self._ranges.get(zone_id, [])
+        starts = self._starts.get(zone_id, [])
+
+        first = max(0, bisect.bisect_right(starts, self._epoch(begin)) - 1)
+        last = bisect.bisect_right(starts, self._epoch(end))
+
+        return [(item[2], item[3]) for item in ranges[first:last]
+                if item[1] >= self._epoch(begin)]
+
+    def zones(self):
+        """ Return the ids of the zones that have events """
+
+        return sorted(self._ranges)
+
+    def _find(self, zone_id, now):
+        """
+        Return the position of the last range of the zone that starts at or
+        before the given time, None if there is none
+        """
+
+        position = bisect.bisect_right(self._starts.get(zone_id, []),
+                                       self._epoch(now)) - 1
+
+        if 0 > position:
+            return None
+
+        return position
+
+    def _entry(self, turn_on, turn_off):
+        """ Build the sortable entry of an event """
+
+        return (iso_to_epoch(turn_on), iso_to_epoch(turn_off), turn_on,
+                turn_off)
+
+    def _merge(self, first, second):
+        """ Return the entry covering both entries """
+
+        merged = list(first)
+
+        if second[0] < merged[0]:
+            merged[0], merged[2] = second[0], second[2]
+
+        if second[1] > merged[1]:
+            merged[1], merged[3] = second[1], second[3]
+
+        return tuple(merged)
+
+    def _epoch(self, value):
+        """ Convert datetime to seconds since the epoch, whole seconds """
+
+        return time.mktime(value.timetuple())
@@ -0,0 +1,131 @@
+# wakeup.py: Self-pipe event to wake up sleeping threads and select loops
+#
+# Copyright 2013 Sudaraka Wijesinghe <sudaraka.wijesinghe@gmail.com>
+#
+# This file is part of OpenSprinkler Pi Monitor (OSPi Monitor)
+#
+# OSPi Monitor is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# OSPi Monitor is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with OSPi Monitor.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+import errno
+import fcntl
+import os
+import select
+import signal
+import sys
+
+
+# =============================================================================
+# Make sure this script doesn't get executed directly
+if '__main__' == __name__:
+    sys.exit(1)
+
+
+# =============================================================================
+class OSPiMWakeup(object):
+
+    """
+    Event flag backed by a pipe. Once set, the read end of the pipe stays
+    readable, so it can be waited on with select() together with sockets.
+
+    Unlike threading.Event.wait(timeout) of Python 2, which polls, waiting
+    sleeps in the kernel until the flag is set or the timeout passes. set()
+    only writes to the pipe, so it is safe to call from a signal handler.
+    """
+
+    def __init__(self):
+        """ Create the pipe, the flag is cleared """
+
+        self._read_fd, self._write_fd = os.pipe()
+
+        for fd in (self._read_fd, self._write_fd):
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+        self._set = False
+
+    def fileno(self):
+        """ Read end of the pipe, readable once the flag is set """
+
+        return self._read_fd
+
+    def set(self):
+        """ Set the flag and wake up the waiters """
+
+        if self._set:
+            return
+
+        self._set = True
+
+        try:
+            os.write(self._write_fd, 'x')
+        except OSError as e:
+            # Pipe is already full, waiters wake up anyway
+            if errno.EAGAIN != e.errno:
+                raise
+
+    def is_set(self):
+        """ Return True if the flag is set """
+
+        return self._set
+
+    def wait(self, timeout=None):
+        """
+        Sleep until the flag is set or timeout seconds pass. Return True if
+        the flag is set.
+        """
+
+        if self._set:
+            return True
+
+        try:
+            select.select([self._read_fd], [], [], timeout)
+        except select.error as e:
+            # Interrupted by a signal, the handler may have set the flag
+            if errno.EINTR != e.args[0]:
+                raise
+
+        return self._set
+
+    def wake_on_signals(self):
+        """
+        Make the pipe readable on every signal that has a Python handler.
+
+        Python runs the signal handlers in the main thread only, but the
+        signal may be delivered to any thread, leaving the main thread asleep
+        in select(). With this the main thread wakes up and runs the handler.
+        Must be called from the main thread.
+        """
+
+        signal.set_wakeup_fd(self._write_fd)
+
+    def drain(self):
+        """ Empty the pipe of signal wakeups while the flag is not set """
+
+        if self._set:
+            return
+
+        try:
+            while os.read(self._read_fd, 512):
+                pass
+        except OSError as e:
+            if errno.EAGAIN != e.errno:
+                raise
+
+    def close(self):
+        """ Close the pipe """
+
+        os.close(self._read_fd)
+        os.close(self._write_fd)
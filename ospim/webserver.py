@@ -22,7 +22,7 @@
 # https://github.com/rayshobby/opensprinkler
 #
 
-import hashlib
+import datetime
 import json
 import logging
 import mimetypes
@@ -31,7 +31,8 @@ import random
 import sys
 
 from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
-from .config import ospim_conf
+from .clock import get_clock
+from .config import OSPiMConfigOption, get_config
 from cgi import parse_header, parse_multipart, parse_qs
 
 
@@ -41,6 +42,10 @@ if '__main__' == __name__:
     sys.exit(1)
 
 
+# Log messages of this module, the level can be set per module
+logger = logging.getLogger(__name__)
+
+
 # =============================================================================
 class OSPiMHTTPServer(HTTPServer):
 
@@ -58,6 +63,19 @@ class OSPiMHTTPServer(HTTPServer):
     # Zone data object
     _zone = None
 
+    # Calender lookup thread
+    _cal_thread = None
+
+    # Concurrent zone sequencer
+    _sequencer = None
+
+    # CPU and memory profiler
+    _profiler = None
+
+    # get-timeline responses of the current data versions and minute,
+    # {'version': ..., 'responses': {hours: JSON string}}
+    _timeline_cache = None
+
     def set_gpio_handler(self, gpio_handler):
         """ Set GPIO handler object """
 
@@ -73,6 +91,21 @@ class OSPiMHTTPServer(HTTPServer):
 
         self._schedule = schedule_data
 
+    def set_calendar_thread(self, cal_thread):
+        """ Set calendar lookup thread object """
+
+        self._cal_thread = cal_thread
+
+    def set_sequencer(self, sequencer):
+        """ Set concurrent zone sequencer object """
+
+        self._sequencer = sequencer
+
+    def set_profiler(self, profiler):
+        """ Set daemon profiler object """
+
+        self._profiler = profiler
+
 
 # =============================================================================
 class OSPiMRequestHandler(BaseHTTPRequestHandler):
@@ -85,6 +118,18 @@ class OSPiMRequestHandler(BaseHTTPRequestHandler):
     # Web root directory location
     _root = None
 
+    # Maximum number of zones allowed
+    _max_zones = OSPiMConfigOption('opensprinkler', 'max_zones')
+
+    # Number of days the timeline can cover, as far as the schedule goes
+    _max_timeline_days = OSPiMConfigOption('calendar', 'horizon_days')
+
+    # Commands that stream their response, see _send_stream()
+    _streamed_commands = ('get-schedule',)
+
+    # Minimum size of the chunks written by _send_stream()
+    _chunk_size = 16384
+
     def version_string(self):
         """ Override version string use in "Server" HTTP header to be empty """
         return ''
@@ -128,8 +173,8 @@ class OSPiMRequestHandler(BaseHTTPRequestHandler):
             self._process_command(command[0].lower(), post)
 
         except Exception as e:
-            logging.error('Error handling request %s' % self.path)
-            logging.error(str(e))
+            logger.error('Error handling request %s' % self.path)
+            logger.error(str(e))
             self._report_error(str(e))
 
     def do_GET(self):
@@ -163,8 +208,8 @@ class OSPiMRequestHandler(BaseHTTPRequestHandler):
         except IOError:
             self._send_404(self.path)
         except Exception as e:
-            logging.error('Error handling request %s' % self.path)
-            logging.error(str(e))
+            logger.error('Error handling request %s' % self.path)
+            logger.error(str(e))
             self._report_error(str(e))
 
     def _get_index(self):
@@ -228,14 +273,68 @@ class OSPiMRequestHandler(BaseHTTPRequestHandler):
         if response:
             self.send_response(response)
 
+        self._send_cache_headers()
+        self.end_headers()
+
+        self.wfile.write(document)
+
+    def _send_stream(self, pieces):
+        """
+        Send the document generated in pieces as they come, with chunked
+        transfer encoding when the response is HTTP/1.1 (otherwise up to the
+        end of the connection). Only a chunk is kept in memory at a time.
+        The response code and content type must be sent already.
+        """
+
+        chunked = 'HTTP/1.1' == self.protocol_version
+
+        if chunked:
+            self.send_header('Transfer-Encoding', 'chunked')
+
+        self.send_header('Connection', 'close')
+        self._send_cache_headers()
+        self.end_headers()
+
+        try:
+            buffered = []
+            size = 0
+
+            for piece in pieces:
+                buffered.append(piece)
+                size += len(piece)
+
+                if size >= self._chunk_size:
+                    self._write_chunk(''.join(buffered), chunked)
+                    buffered = []
+                    size = 0
+
+            self._write_chunk(''.join(buffered), chunked)
+
+            if chunked:
+                self.wfile.write('0\r\n\r\n')
+        except Exception as e:
+            # Headers are gone already, the client sees a cut off response
+            logger.error('[webserver:send_stream] ' + str(e))
+
+    def _write_chunk(self, data, chunked):
+        """ Write a piece of the streamed response """
+
+        if not data:
+            return
+
+        if chunked:
+            self.wfile.write('%x\r\n%s\r\n' % (len(data), data))
+        else:
+            self.wfile.write(data)
+
+    def _send_cache_headers(self):
+        """ Send the headers that keep the clients from caching responses """
+
         self.send_header(
             'Cache-Control', 'max-age=3600, no-cache, must-revalidate')
         self.send_header('Etag', random.randrange(100000, 999999))
         self.send_header('Expires', self.date_time_string())
         self.send_header('Last-Modified', self.date_time_string())
-        self.end_headers()
-
-        self.wfile.write(document)
 
     def _start_json_response(self):
         """
@@ -253,7 +352,7 @@ class OSPiMRequestHandler(BaseHTTPRequestHandler):
         """
 
         if None == self._root:
-            self._root = ospim_conf.get('server', 'root_directory')
+            self._root = get_config().server.root_directory
 
         # Check for a valid web _root
         if not os.path.isdir(self._root):
@@ -266,6 +365,11 @@ class OSPiMRequestHandler(BaseHTTPRequestHandler):
     def _process_command(self, command, post):
         """ Process commands """
 
+        # Streamed responses are chunked, which needs HTTP/1.1
+        if command in self._streamed_commands and \
+                'HTTP/1.1' == self.request_version:
+            self.protocol_version = 'HTTP/1.1'
+
         self._start_json_response()
 
         if 'get-schedule' == command:
@@ -273,8 +377,20 @@ class OSPiMRequestHandler(BaseHTTPRequestHandler):
             self._command_get_schedule(post)
 
         elif 'get-zones' == command:
-            # Send complete zone data
-            self._send(self.server._zone.get_json(), None)
+            # Send complete zone data, or a page of it
+            self._command_get_zones(post)
+
+        elif 'get-timeline' == command:
+            # Send the upcoming on/off windows of each zone
+            self._command_get_timeline(post)
+
+        elif 'get-status' == command:
+            # Send the status of the daemon components
+            self._command_get_status(post)
+
+        elif 'profile' == command:
+            # Control the CPU and memory profiling of the daemon
+            self._command_profile(post)
 
         elif 'save-calendar-id' == command:
             # Update the Google calendar id
@@ -307,30 +423,144 @@ class OSPiMRequestHandler(BaseHTTPRequestHandler):
         if 'hash' in post:
             hash = post['hash'][0]
 
-        # Get the current zone state signature and remove any passed
-        # events (if exists), then get the new state signature for the
-        # with the changes.
-        before_hash = hashlib.md5(
-            json.dumps(self.server._zone._data)
-        )
+        # Remove any passed events (if exists), the zones are left to the
+        # calendar thread
         self.server._schedule.remove_past_events()
-        after_hash = hashlib.md5(
-            json.dumps(self.server._zone._data)
-        )
-
-        # If the state has changed during the cleanup of passed events,
-        # flush the changes to device
-        if before_hash.hexdigest() != after_hash.hexdigest():
-            self.server._gpio.shift_register_write()
 
         # Send fresh data to the client
-        self._send(self.server._schedule.get_json(hash), None)
+        self._send_stream(self.server._schedule.iter_json(hash))
+
+    def _command_get_zones(self, post):
+        """
+        Send complete zone data, or a single page of zones when page
+        parameter is given
+        """
+
+        if 'page' not in post:
+            self._send(self.server._zone.get_json(), None)
+            return
+
+        try:
+            page = int(post['page'][0])
+        except:
+            page = 0
+
+        try:
+            page_size = int(post['page_size'][0])
+        except:
+            page_size = self.server._zone.zones_per_board
+
+        self._send(self.server._zone.get_json_page(page, page_size), None)
+
+    def _command_get_timeline(self, post):
+        """
+        Send the on/off windows of each zone for the next hours (or days)
+        given, 24 hours by default. The response is built once for each
+        version of the schedule and zone data in a minute, and shared by all
+        the requests.
+        """
+
+        try:
+            if 'days' in post:
+                hours = int(post['days'][0]) * 24
+            elif 'hours' in post:
+                hours = int(post['hours'][0])
+            else:
+                hours = 24
+        except ValueError:
+            self._send(json.dumps({
+                "error": 1,
+                "desc": "'hours' and 'days' must be whole numbers."
+            }))
+            return
+
+        hours = max(1, min(hours, self._max_timeline_days * 24))
+
+        now = get_clock().now().replace(second=0, microsecond=0)
+        version = (self.server._schedule.get_version(),
+                   self.server._zone.get_version(), now)
+
+        cache = self.server._timeline_cache
+        if None == cache or version != cache['version']:
+            cache = {'version': version, 'responses': {}}
+            self.server._timeline_cache = cache
+
+        if hours not in cache['responses']:
+            until = now + datetime.timedelta(hours=hours)
+
+            cache['responses'][hours] = json.dumps({
+                'server_time': str(now),
+                'from': str(now),
+                'until': str(until),
+                'zones': self.server._schedule.get_upcoming(now, until)
+            })
+
+        self._send(cache['responses'][hours], None)
+
+    def _command_get_status(self, post):
+        """ Send the status of the daemon components """
+
+        status = {}
+
+        if None != self.server._gpio:
+            status['gpio'] = self.server._gpio.get_status()
+
+        if None != self.server._cal_thread:
+            status['calendar'] = self.server._cal_thread.get_status()
+
+        if None != self.server._sequencer:
+            status['sequencer'] = self.server._sequencer.status()
+
+        self._send(json.dumps(status), None)
+
+    def _command_profile(self, post):
+        """
+        Start (action=cpu-start) or stop (action=cpu-stop) the CPU profile, or
+        take a memory snapshot (action=memory). Send the profiler status when
+        no action is given.
+        """
+
+        profiler = self.server._profiler
+
+        if None == profiler or not profiler.is_enabled():
+            self._send(json.dumps({
+                "error": 1,
+                "desc": "Profiling is not enabled."
+            }))
+            return
+
+        if 'action' not in post:
+            self._send(json.dumps(profiler.status()), None)
+            return
+
+        action = post['action'][0]
+
+        if 'cpu-start' == action:
+            error = profiler.start_cpu()
+            if None == error:
+                self._send(json.dumps({"error": 0, "desc": "Ok"}))
+                return
+
+        elif 'cpu-stop' == action or 'memory' == action:
+            if 'cpu-stop' == action:
+                path, error = profiler.stop_cpu()
+            else:
+                path, error = profiler.memory_snapshot()
+
+            if None == error:
+                self._send(json.dumps({"error": 0, "desc": path}))
+                return
+
+        else:
+            error = "Unknown action '%s'." % action
+
+        self._send(json.dumps({"error": 2, "desc": error}))
 
     def _command_save_calendar_id(self, post):
         """ Update the Google calendar id """
 
         if 'id' not in post:
-            logging.error(
+            logger.error(
                 '/save-calendar-id called without id parameter')
             self._send(json.dumps({
                 "error": 1,
@@ -348,7 +578,7 @@ class OSPiMRequestHandler(BaseHTTPRequestHandler):
         """
 
         if 'hours' not in post:
-            logging.error(
+            logger.error(
                 '/save-max-run called without hours parameter')
             self._send(json.dumps({
                 "error": 1,
@@ -369,7 +599,7 @@ class OSPiMRequestHandler(BaseHTTPRequestHandler):
         """ Update the zone count """
 
         if 'count' not in post:
-            logging.error(
+            logger.error(
                 '/save-zone-count called without count parameter')
             self._send(json.dumps({
                 "error": 1,
@@ -383,6 +613,8 @@ class OSPiMRequestHandler(BaseHTTPRequestHandler):
         except:
             zone_count = 1
 
+        zone_count = max(1, min(zone_count, self._max_zones))
+
         self.server._zone.set_count(zone_count)
         self._send(json.dumps({"error": 0, "desc": "Ok"}))
 
@@ -390,7 +622,7 @@ class OSPiMRequestHandler(BaseHTTPRequestHandler):
         """ Update zone names """
 
         if 'zone_name' not in post:
-            logging.error(
+            logger.error(
                 '/save-zone-names called without zone_name parameter list')
             self._send(json.dumps({
                 "error": 1,
@@ -406,7 +638,7 @@ class OSPiMRequestHandler(BaseHTTPRequestHandler):
         """ Update the zone status """
 
         if 'zone' not in post:
-            logging.error(
+            logger.error(
                 '/update-zone-status called without zone parameter')
             self._send(json.dumps({
                 "error": 1,
@@ -422,7 +654,7 @@ class OSPiMRequestHandler(BaseHTTPRequestHandler):
             if 0 > zone_id or zone_count <= zone_id:
                 raise Exception('Zone id out of range')
         except:
-            logging.error(
+            logger.error(
                 '/update-zone-status called with invalid zone (id) parameter')
             self._send(json.dumps({
                 "error": 2,
@@ -432,7 +664,7 @@ class OSPiMRequestHandler(BaseHTTPRequestHandler):
             return
 
         if 'status' not in post:
-            logging.error(
+            logger.error(
                 '/update-zone-status called without status parameter')
             self._send(json.dumps({
                 "error": 3,
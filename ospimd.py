@@ -27,7 +27,8 @@ import logging
 import sys
 
 from ospim.daemon import OSPiMDaemon
-from ospim.config import ospim_conf
+from ospim.config import get_config
+from ospim.logger import setup_logging
 
 
 def exit_usage():
@@ -35,7 +36,7 @@ def exit_usage():
     Print usage instructions and exit
     """
 
-    print 'usage: %s start|stop|restart' % sys.argv[0]
+    print 'usage: %s start|stop|restart|reload' % sys.argv[0]
     sys.exit(2)
 
 
@@ -48,14 +49,10 @@ if '__main__' == __name__:
 
     # Initialize logging
     try:
-        logging.basicConfig(
-            filename=ospim_conf.get('daemon', 'log_file'),
-            format='%(asctime)s [%(levelname)s] %(message)s',
-            datefmt='%Y-%m-%d %I:%M:%S %p',
-            level=logging.INFO)
+        setup_logging(get_config())
     except IOError:
         print 'Failed to open log file: %s' % \
-            ospim_conf.get('daemon', 'log_file')
+            get_config().daemon.log_file
         sys.exit(1)
 
     daemon = OSPiMDaemon()
@@ -69,5 +66,8 @@ if '__main__' == __name__:
     elif 'restart' == sys.argv[1]:
         logging.info('ospimd restarting...')
         daemon.restart()
+    elif 'reload' == sys.argv[1]:
+        logging.info('ospimd reloading configuration...')
+        daemon.reload()
     else:
         exit_usage()